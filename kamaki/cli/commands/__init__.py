@@ -34,11 +34,12 @@
 from kamaki.cli.logger import get_logger
 from kamaki.cli.utils import (
     print_list, print_dict, print_json, print_items, ask_user, pref_enc,
-    filter_dicts_by_dict)
+    filter_dicts_by_dict, to_bytes)
 from kamaki.cli.argument import FlagArgument, ValueArgument
 from kamaki.cli.errors import CLIInvalidArgument, CLIBaseUrlError
 from sys import stdin, stdout, stderr
 import codecs
+import os
 
 
 log = get_logger(__name__)
@@ -123,7 +124,60 @@ class _command_init(object):
                 TOKEN = TOKEN or astakos.token
             else:
                 raise CLIBaseUrlError(service=service)
-        return cls(URL, TOKEN)
+        client = cls(URL, TOKEN)
+        client.poolsize = self._connection_setting('connection_pool_size')
+        client.CONNECTION_PREWARM = self._connection_setting(
+            'connection_prewarm') or client.CONNECTION_PREWARM
+        return client
+
+    def _connection_setting(self, option):
+        """:returns: (int) the option of the current cloud, or else the global
+            option, None if neither is set
+        """
+        for getter, args in (
+                (self.config.get_cloud, (self.cloud, option)),
+                (self.config.get, ('global', option))):
+            try:
+                value = getter(*args)
+            except (AttributeError, KeyError):
+                continue
+            if value:
+                try:
+                    return int(value)
+                except ValueError:
+                    log.warning('WARNING: %s is not an int (%s), ignored' % (
+                        option, value))
+        return None
+
+    def _hashmap_cache(self):
+        """:returns: (HashmapCache) the cache of local file hashmaps, None if
+            the hashmap_cache option is off
+        """
+        path = self.config.get('global', 'hashmap_cache')
+        if not path or path.lower() == 'off':
+            return None
+        from kamaki.clients.pithos.cache import HashmapCache
+        partial = self.config.get('global', 'hashmap_cache_partial') or ''
+        return HashmapCache(
+            os.path.expanduser(path), partial=partial.lower() == 'on')
+
+    def _block_cache(self):
+        """:returns: (BlockCache) the local store of downloaded blocks, None
+            if the block_cache option is off
+        """
+        path = self.config.get('global', 'block_cache')
+        if not path or path.lower() == 'off':
+            return None
+        from kamaki.clients.pithos.cache import BlockCache
+        size = (self.config.get('global', 'block_cache_size') or '').strip()
+        digits, max_bytes = size.rstrip('BbKkMmGgTtIi'), None
+        try:
+            if size:
+                max_bytes = to_bytes(digits, size[len(digits):] or 'B')
+        except (ValueError, TypeError):
+            log.warning('WARNING: block_cache_size %s is invalid, ignored' % (
+                size))
+        return BlockCache(os.path.expanduser(path), max_bytes)
 
     def write(self, s):
         self._out.write(s.encode(pref_enc, errors='replace'))
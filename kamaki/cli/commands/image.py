@@ -462,6 +462,8 @@ class image_register(_init_image, _optional_json):
     def _get_pithos_client(self, locator):
         pithos = self.get_client(PithosClient, 'pithos')
         pithos.account, pithos.container = locator.uuid, locator.container
+        pithos.hashmap_cache = self._hashmap_cache()
+        pithos.block_cache = self._block_cache()
         return pithos
 
     def _load_params_from_file(self, location):
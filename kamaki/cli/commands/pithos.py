@@ -36,7 +36,7 @@ from io import StringIO
 from pydoc import pager
 from os import path, walk, makedirs
 
-from kamaki.clients.pithos import PithosClient, ClientError
+from kamaki.clients.pithos import PithosClient, ClientError, BlockIndex
 
 from kamaki.cli import command
 from kamaki.cli.command_tree import CommandTree
@@ -89,6 +89,8 @@ class _pithos_init(_command_init):
     @addLogSettings
     def _run(self):
         self.client = self.get_client(PithosClient, 'pithos')
+        self.client.hashmap_cache = self._hashmap_cache()
+        self.client.block_cache = self._block_cache()
         self.base_url, self.token = self.client.base_url, self.client.token
         self._set_account()
         self.client.account = self.account
@@ -109,10 +111,13 @@ class _pithos_account(_pithos_init):
         self.arguments['account'].account_client = auth_base
 
     def print_objects(self, object_list):
+        #  Listings printed while they are decoded are numbered unpadded
+        width = len(str(len(object_list))) if (
+            hasattr(object_list, '__len__')) else 0
         for index, obj in enumerate(object_list):
             pretty_obj = obj.copy()
             index += 1
-            empty_space = ' ' * (len(str(len(object_list))) - len(str(index)))
+            empty_space = ' ' * (width - len(str(index)))
             if 'subdir' in obj:
                 continue
             if self._is_dir(obj):
@@ -285,24 +290,31 @@ class file_list(_pithos_container, _optional_json, _name_filter):
             if_modified_since=self['if_modified_since'],
             if_unmodified_since=self['if_unmodified_since'],
             until=self['until'],
-            meta=self['meta'])
+            meta=self['meta'],
+            stream=True)
+        listed = dict(objects=0)
 
-        if not r.json:
-            self.error('Container "%s" is empty' % self.client.container)
+        def files():
+            for obj in r.iter_json():
+                listed['objects'] += 1
+                for item in self._filter_by_name([obj]):
+                    yield item
 
-        files = self._filter_by_name(r.json)
         if self['more']:
             outbu, self._out = self._out, StringIO()
         try:
             if self['json_output'] or self['output_format']:
-                self._print(files)
+                self._print(list(files()))
             else:
-                self.print_objects(files)
+                self.print_objects(files())
         finally:
             if self['more']:
                 pager(self._out.getvalue())
                 self._out = outbu
 
+        if not listed['objects']:
+            self.error('Container "%s" is empty' % self.client.container)
+
     def main(self, path_or_url=''):
         super(self.__class__, self)._run(path_or_url)
         self._run()
@@ -854,6 +866,12 @@ class file_upload(_pithos_container, _optional_output_cmd):
             'Confirm upload with a custom checksum (MD5)', '--etag'),
         use_hashes=FlagArgument(
             'Source file contains hashmap not data', '--source-is-hashmap'),
+        max_files=IntArgument(
+            'Files to upload at once, when recursive (default: 8)',
+            '--parallel-files'),
+        max_bytes=DataSizeArgument(
+            'Total size of files to upload at once, when recursive '
+            '(default: 256MiB)', '--max-bytes-in-flight'),
     )
 
     def _sharing(self):
@@ -934,7 +952,7 @@ class file_upload(_pithos_container, _optional_output_cmd):
                     if path.isfile(fpath):
                         rel_path = rel_path.replace(path.sep, '/')
                         pathfix = f.replace(path.sep, '/')
-                        yield open(fpath, 'rb'), '%s/%s' % (rel_path, pathfix)
+                        yield fpath, '%s/%s' % (rel_path, pathfix)
                     else:
                         self.error('%s is not a regular file' % fpath)
         else:
@@ -955,7 +973,36 @@ class file_upload(_pithos_container, _optional_output_cmd):
                 if ce.status not in (404, ):
                     raise
             self._check_container_limit(lpath)
-            yield open(lpath, 'rb'), rpath
+            yield lpath, rpath
+
+    def _params(self, lpath, params):
+        """Guess the content type and encoding of a file, if not set"""
+        params = dict(params)
+        if not (self['content_type'] and self['content_encoding']):
+            ctype, cenc = guess_mime_type(lpath)
+            params['content_type'] = self['content_type'] or ctype
+            params['content_encoding'] = self['content_encoding'] or cenc
+        return params
+
+    def _upload_all(self, sources, container_info_cache):
+        """Upload many files concurrently, with aggregated progress"""
+        progress_bar, upload_cb = self._safe_progress_bar(
+            'Uploading %s files' % len(sources))
+        try:
+            r = self.client.upload_objects(
+                sources,
+                max_files=self['max_files'],
+                max_bytes=self['max_bytes'],
+                upload_cb=upload_cb,
+                container_info_cache=container_info_cache)
+        finally:
+            self._safe_progress_bar_finish(progress_bar)
+        uploaded = []
+        if self['with_output'] or self['json_output']:
+            for lpath, rpath, params in sources:
+                r[rpath]['name'] = '/%s/%s' % (self.client.container, rpath)
+                uploaded.append(r[rpath])
+        return uploaded
 
     def _run(self, local_path, remote_path):
         self.client.MAX_THREADS = int(self['max_threads'] or 5)
@@ -965,39 +1012,42 @@ class file_upload(_pithos_container, _optional_output_cmd):
             content_disposition=self['content_disposition'],
             sharing=self._sharing(),
             public=self['public'])
-        uploaded, container_info_cache = list, dict()
+        uploaded, container_info_cache, sources = list(), dict(), list()
         rpref = 'pithos://%s' if self['account'] else ''
-        for f, rpath in self._src_dst(local_path, remote_path):
+        for lpath, rpath in self._src_dst(local_path, remote_path):
             self.error('%s --> %s/%s/%s' % (
-                f.name, rpref, self.client.container, rpath))
-            if not (self['content_type'] and self['content_encoding']):
-                ctype, cenc = guess_mime_type(f.name)
-                params['content_type'] = self['content_type'] or ctype
-                params['content_encoding'] = self['content_encoding'] or cenc
+                lpath, rpref, self.client.container, rpath))
+            if self['recursive'] and not self['unchunked']:
+                sources.append((lpath, rpath, self._params(lpath, params)))
+                continue
+            kwargs = self._params(lpath, params)
             if self['unchunked']:
-                r = self.client.upload_object_unchunked(
-                    rpath, f,
-                    etag=self['md5_checksum'], withHashFile=self['use_hashes'],
-                    **params)
+                with open(lpath, 'rb') as f:
+                    r = self.client.upload_object_unchunked(
+                        rpath, f,
+                        etag=self['md5_checksum'],
+                        withHashFile=self['use_hashes'],
+                        **kwargs)
                 if self['with_output'] or self['json_output']:
                     r['name'] = '/%s/%s' % (self.client.container, rpath)
                     uploaded.append(r)
             else:
                 try:
                     (progress_bar, upload_cb) = self._safe_progress_bar(
-                        'Uploading %s' % f.name.split(path.sep)[-1])
+                        'Uploading %s' % lpath.split(path.sep)[-1])
                     if progress_bar:
                         hash_bar = progress_bar.clone()
                         hash_cb = hash_bar.get_generator(
                             'Calculating block hashes')
                     else:
                         hash_cb = None
-                    r = self.client.upload_object(
-                        rpath, f,
-                        hash_cb=hash_cb,
-                        upload_cb=upload_cb,
-                        container_info_cache=container_info_cache,
-                        **params)
+                    with open(lpath, 'rb') as f:
+                        r = self.client.upload_object(
+                            rpath, f,
+                            hash_cb=hash_cb,
+                            upload_cb=upload_cb,
+                            container_info_cache=container_info_cache,
+                            **kwargs)
                     if self['with_output'] or self['json_output']:
                         r['name'] = '/%s/%s' % (self.client.container, rpath)
                         uploaded.append(r)
@@ -1006,6 +1056,8 @@ class file_upload(_pithos_container, _optional_output_cmd):
                     raise
                 finally:
                     self._safe_progress_bar_finish(progress_bar)
+        if sources:
+            uploaded += self._upload_all(sources, container_info_cache)
         self._optional_output(uploaded)
         self.error('Upload completed')
 
@@ -1259,7 +1311,7 @@ class file_download(_pithos_container):
     @errors.pithos.local_path_download
     def _run(self, local_path):
         self.client.MAX_THREADS = int(self['max_threads'] or 5)
-        progress_bar = None
+        progress_bar, block_index = None, BlockIndex()
         try:
             for rpath, output_file in self._src_dst(local_path):
                 if not rpath:
@@ -1279,22 +1331,12 @@ class file_download(_pithos_container):
                     resume=self['resume'],
                     if_none_match=self['non_matching_etag'],
                     if_modified_since=self['modified_since_date'],
-                    if_unmodified_since=self['unmodified_since_date'])
+                    if_unmodified_since=self['unmodified_since_date'],
+                    block_index=block_index)
         except KeyboardInterrupt:
-            from threading import activeCount, enumerate as activethreads
-            timeout = 0.5
-            while activeCount() > 1:
-                self._out.write('\nCancel %s threads: ' % (activeCount() - 1))
-                self._out.flush()
-                for thread in activethreads():
-                    try:
-                        thread.join(timeout)
-                        self._out.write('.' if thread.isAlive() else '*')
-                    except RuntimeError:
-                        continue
-                    finally:
-                        self._out.flush()
-                        timeout += 0.1
+            self._out.write('\nCancel pending block downloads ... ')
+            self._out.flush()
+            self.client.workers.shutdown(cancel=True)
             self.error('\nDownload canceled by user')
             if local_path is not None:
                 self.error('to resume, re-run with --resume')
@@ -1307,6 +1349,72 @@ class file_download(_pithos_container):
         self._run(local_path=local_path)
 
 
+@command(file_cmds)
+class file_sync(_pithos_container):
+    """Synchronize a local directory with a remote directory object
+    By default, local changes are uploaded. Only new or modified files are
+    transfered, and only the blocks of them that changed.
+    """
+
+    arguments = dict(
+        download=FlagArgument(
+            'Sync the local directory from the remote one', '--download'),
+        delete=FlagArgument(
+            'Delete files missing from the source directory', '--delete'),
+        dry_run=FlagArgument(
+            'Show what would be done and how many bytes would be transfered'
+            ' but change nothing', '--dry-run'),
+        max_threads=IntArgument('default: 5', '--threads'),
+        progress_bar=ProgressBarArgument(
+            'do not show progress bar', ('-N', '--no-progress-bar'),
+            default=False),
+    )
+
+    @errors.generic.all
+    @errors.pithos.connection
+    @errors.pithos.container
+    @errors.pithos.object_path
+    @errors.pithos.local_path
+    def _run(self, local_path):
+        if not path.isdir(local_path):
+            raise CLIError('%s is not a directory' % local_path, details=[
+                'To transfer a single file, use file upload/download'])
+        self.client.MAX_THREADS = int(self['max_threads'] or 5)
+        sync = self.client.sync_download if (
+            self['download']) else self.client.sync_upload
+        plan = sync(local_path, self.path, self['delete'], dry_run=True)
+        if not plan:
+            self.error('Nothing to sync')
+            return
+        remote = '/%s/%s' % (self.container, self.path.strip('/'))
+        for entry in plan:
+            target = local_path if self['download'] else remote
+            self.writeln('%s %s/%s%s' % (
+                entry['action'], target.rstrip('/'), entry['path'], (
+                    ' (%s)' % format_size(entry['bytes'])) if (
+                        entry['action'] in ('upload', 'download')) else ''))
+        self.error('%s to transfer' % format_size(
+            sum(entry['bytes'] for entry in plan)))
+        if self['dry_run']:
+            return
+        progress_bar, sync_cb = self._safe_progress_bar('Synchronizing')
+        try:
+            sync(
+                local_path, self.path, self['delete'],
+                sync_cb=sync_cb, plan=plan)
+        except KeyboardInterrupt:
+            self.client.workers.shutdown(cancel=True)
+            self.error('\nSync canceled by user, re-run to continue')
+            return
+        finally:
+            self._safe_progress_bar_finish(progress_bar)
+        self.error('Sync completed')
+
+    def main(self, local_path, remote_path_or_url):
+        super(self.__class__, self)._run(remote_path_or_url)
+        self._run(local_path=local_path)
+
+
 @command(container_cmds)
 class container_info(_pithos_account, _optional_json):
     """Get information about a container"""
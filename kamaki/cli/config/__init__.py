@@ -79,6 +79,10 @@ DEFAULTS = {
         'log_pid': 'off',
         'history_file': HISTORY_PATH,
         'history_limit': 0,
+        'hashmap_cache': os.path.expanduser('~/.kamaki/hashmaps.db'),
+        'hashmap_cache_partial': 'off',
+        'block_cache': 'off',
+        'block_cache_size': '1GiB',
         'user_cli': 'astakos',
         'quota_cli': 'astakos',
         'resource_cli': 'astakos',
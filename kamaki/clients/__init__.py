@@ -32,24 +32,43 @@
 
 from urllib2 import quote, unquote
 from urlparse import urlparse
-from threading import Thread
-from json import dumps, loads
+from threading import Thread, local, Lock, Event, Condition, current_thread
+from Queue import Queue, Empty
+from json import dumps
+try:
+    from simplejson import loads, JSONDecoder
+except ImportError:
+    from json import loads, JSONDecoder
 from time import time
-from httplib import ResponseNotReady, HTTPException
+from httplib import HTTPException
 from time import sleep
-from random import random
 from logging import getLogger
+from socket import timeout as SocketTimeout, error as SocketError
+from errno import ECONNREFUSED
+from os import fstat
+from stat import S_ISREG
+from random import random
+from bisect import bisect_left
+from email.utils import parsedate_tz, mktime_tz
 
-from objpool.http import PooledHTTPConnection
+from objpool.http import PooledHTTPConnection, HTTPConnectionPool
+
+from kamaki.clients.utils import iter_json_list
 
 
 TIMEOUT = 60.0   # seconds
+WAIT_STEP = 1.0   # seconds, keeps waits in the main thread interruptible
+CHUNK_SIZE = 64 * 1024   # bytes
 HTTP_METHODS = ['GET', 'POST', 'PUT', 'HEAD', 'DELETE', 'COPY', 'MOVE']
+_BUFFER_TYPES = (basestring, bytearray, buffer, memoryview)
 
 log = getLogger(__name__)
 sendlog = getLogger('%s.send' % __name__)
 recvlog = getLogger('%s.recv' % __name__)
 
+DEFAULT_POOL_SIZE = 100
+_connection_pools, _connection_pools_lock = dict(), Lock()
+
 
 def _encode(v):
     if v and isinstance(v, unicode):
@@ -57,6 +76,71 @@ def _encode(v):
     return v
 
 
+def _body_size(data):
+    """:returns: (int) the size of a request body or None if unknown"""
+    try:
+        return len(data)
+    except (AttributeError, TypeError):
+        pass
+    try:
+        st = fstat(data.fileno())
+        if S_ISREG(st.st_mode):
+            return st.st_size - data.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class _BodyStream(object):
+    """Feed a request body to httplib in bounded chunks
+    Body sources may be file-like objects or iterables of data chunks. If
+    chunked is set, the chunks are framed for chunked transfer encoding. The
+    size attribute counts the body bytes read so far. If rewind is given, it
+    resets the source so that the body can be read again.
+    """
+
+    def __init__(self, data, chunked=False, rewind=None):
+        self._data, self._rewind, self.chunked = data, rewind, chunked
+        self._start()
+
+    def _start(self):
+        data = self._data
+        if hasattr(data, 'read'):
+            self._chunks = iter(lambda: data.read(CHUNK_SIZE), '')
+        else:
+            self._chunks = iter(data)
+        self._done, self.size = False, 0
+
+    def rewind(self):
+        """Start the body over, e.g., to send it again
+
+        :returns: (bool) False if the body is (partly) read and its source
+            cannot be read again
+        """
+        if self.size and self._rewind is None:
+            return False
+        if self.size or self._done:
+            if self._rewind:
+                self._rewind()
+            self._start()
+        return True
+
+    def read(self, size=None):
+        if self._done:
+            return ''
+        for chunk in self._chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            if not chunk:
+                continue
+            self.size += len(chunk)
+            if self.chunked:
+                return '%x\r\n%s\r\n' % (len(chunk), chunk)
+            return chunk
+        self._done = True
+        return '0\r\n\r\n' if self.chunked else ''
+
+
 class ClientError(Exception):
     def __init__(self, message, status=0, details=None):
         log.debug('ClientError: msg[%s], sts[%s], dtl[%s]' % (
@@ -101,6 +185,183 @@ class Logged(object):
     _token = None
 
 
+class ConnectionPool(HTTPConnectionPool):
+    """A pool of keep-alive HTTP(S) connections to a netloc, which counts
+
+    - gets: connections acquired from the pool
+    - hits: acquired connections that were already open
+    - misses: acquired connections that had to be opened
+    - waits: acquisitions that had to wait for a free connection
+    - discarded: connections closed as stale or not reusable
+    - max_age, total_discarded_age: seconds since connections were created
+    """
+
+    def __init__(self, scheme, netloc, size=None):
+        super(ConnectionPool, self).__init__(
+            scheme, netloc, size=size or DEFAULT_POOL_SIZE)
+        self.counters = dict(
+            gets=0, hits=0, misses=0, waits=0, discarded=0, prewarmed=0,
+            max_age=0.0, total_discarded_age=0.0)
+        self._counters_lock, self._acquired = Lock(), 0
+
+    def _count(self, conn=None, **increments):
+        with self._counters_lock:
+            for k, v in increments.items():
+                self.counters[k] += v
+            if conn is not None:
+                age = time() - conn._kamaki_created
+                self.counters['max_age'] = max(self.counters['max_age'], age)
+                if increments.get('discarded'):
+                    self.counters['total_discarded_age'] += age
+
+    def _pool_create(self):
+        conn = super(ConnectionPool, self)._pool_create()
+        conn._kamaki_created = time()
+        #  On a BadStatusLine, objpool sends the request again with the same
+        #  arguments, so a streamed body has to start over
+        send = conn._old_request
+
+        def request(*args, **kwargs):
+            body = kwargs.get('body')
+            if isinstance(body, _BodyStream) and not body.rewind():
+                raise ClientError(
+                    'Connection to %s closed, the request body cannot be '
+                    'sent again' % self.netloc)
+            send(*args, **kwargs)
+        conn._old_request = request
+        return conn
+
+    def _pool_verify(self, conn):
+        verified = super(ConnectionPool, self)._pool_verify(conn)
+        if conn is not None and not verified:
+            self._count(conn, discarded=1)
+        return verified
+
+    def _pool_cleanup(self, conn):
+        discard = super(ConnectionPool, self)._pool_cleanup(conn)
+        if discard:
+            self._count(conn, discarded=1)
+        return discard
+
+    def pool_get(self, *args, **kwargs):
+        with self._counters_lock:
+            waits = 1 if self._acquired >= self.size else 0
+        conn = super(ConnectionPool, self).pool_get(*args, **kwargs)
+        with self._counters_lock:
+            self._acquired += 1
+        if conn is not None:
+            hit = 1 if conn.sock else 0
+            self._count(conn, gets=1, hits=hit, misses=1 - hit, waits=waits)
+        return conn
+
+    def pool_put(self, conn):
+        with self._counters_lock:
+            self._acquired -= 1
+        super(ConnectionPool, self).pool_put(conn)
+
+    def grow(self, size):
+        """Let up to size connections be acquired, if the pool is smaller,
+        while the connections of the pool stay in use
+
+        :returns: (bool) False if the pool was already that large
+        """
+        with self._counters_lock:
+            if size <= self.size:
+                return False
+            for i in range(size - self.size):
+                self._semaphore.release()
+            self.size = size
+        return True
+
+    def prewarm(self, count, timeout=TIMEOUT):
+        """Open up to count connections in parallel (including TLS
+        handshakes), and keep them in the pool for the following requests
+
+        :returns: (int) the number of connections opened
+        """
+        conns = []
+        for i in range(min(count, self.size)):
+            try:
+                conns.append(self.pool_get(blocking=False))
+            except Exception:
+                break
+        cold = [c for c in conns if c.sock is None]
+
+        def connect(conn):
+            try:
+                conn.timeout = timeout
+                conn.connect()
+            except Exception as e:
+                log.debug('Failed to prewarm %s: %s' % (self.netloc, e))
+                conn.close()
+        threads = [Thread(target=connect, args=(c, )) for c in cold]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        opened = len([c for c in cold if c.sock])
+        self._count(prewarmed=opened)
+        for conn in conns:
+            self.pool_put(conn)
+        return opened
+
+    def stats(self):
+        """:returns: (dict) the counters, as well as the pool size and the
+            number of idle connections
+        """
+        with self._counters_lock:
+            stats = dict(self.counters)
+        stats.update(size=self.size, idle=len(self._set))
+        return stats
+
+
+def get_connection_pool(scheme, netloc, size=None):
+    """:returns: (ConnectionPool) for scheme://netloc, grown in place if size
+        is larger than the existing pool (pools are shared and never shrink)
+    """
+    key = (scheme, netloc)
+    with _connection_pools_lock:
+        pool = _connection_pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(scheme, netloc, size)
+            _connection_pools[key] = pool
+        elif size and size != pool.size and not pool.grow(size):
+            log.debug('Pool for %s://%s keeps size %s, not %s' % (
+                scheme, netloc, pool.size, size))
+        return pool
+
+
+def get_connection_pool_stats():
+    """:returns: (dict) {scheme://netloc: stats} of all connection pools"""
+    with _connection_pools_lock:
+        pools = _connection_pools.items()
+    return dict([(
+        '%s://%s' % key, pool.stats()) for key, pool in pools])
+
+
+class PooledConnection(PooledHTTPConnection):
+    """A PooledHTTPConnection from the kamaki connection pools"""
+
+    def get_pool(self):
+        kwargs = self._pool_kwargs
+        return get_connection_pool(
+            kwargs['scheme'], kwargs['netloc'], kwargs.get('size'))
+
+
+def _body_rewinder(data):
+    """:returns: a callable that resets the request body so that it can be
+        sent again, None if this is not possible (e.g., a pipe or iterable)
+    """
+    if data is None or isinstance(data, _BUFFER_TYPES):
+        return lambda: None
+    try:
+        start = data.tell()
+        data.seek(start)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    return lambda: data.seek(start)
+
+
 class RequestManager(Logged):
     """Handle http request information"""
 
@@ -131,7 +392,21 @@ class RequestManager(Logged):
 
     def __init__(
             self, method, url, path,
-            data=None, headers={}, params={}):
+            data=None, headers={}, params={},
+            connect_timeout=TIMEOUT, read_timeout=TIMEOUT, total_timeout=None,
+            started=None):
+        """
+        :param connect_timeout: (float) seconds to wait for a connection
+
+        :param read_timeout: (float) seconds to wait for the server while the
+            connection is idle (e.g., waiting for a response or a data chunk)
+
+        :param total_timeout: (float) seconds for the whole request, including
+            retries and body transfer, None means no limit
+
+        :param started: (float) when the request started (epoch seconds),
+            i.e., its first attempt, default: when this attempt is sent
+        """
         method = method.upper()
         assert method in HTTP_METHODS, 'Invalid http method %s' % method
         if headers:
@@ -140,6 +415,11 @@ class RequestManager(Logged):
         self.method, self.data = method, data
         self.scheme, self.netloc = self._connection_info(url, path, params)
         self._headers_to_quote, self._header_prefices = [], []
+        self.connect_timeout, self.read_timeout = connect_timeout, read_timeout
+        self.total_timeout, self.started = total_timeout, started
+        self.connect_time, self.send_time, self.ttfb = 0.0, 0.0, 0.0
+        self.sent = 0
+        self._rewind, self._body_read = _body_rewinder(data), False
 
     def dump_log(self):
         plog = ('\t[%s]' % self) if self.LOG_PID else ''
@@ -151,8 +431,10 @@ class RequestManager(Logged):
                 self._token, val = val, '...'
             sendlog.info('  %s: %s%s' % (key, val, plog))
         if self.data:
-            sendlog.info('data size: %s%s' % (len(self.data), plog))
-            if self.LOG_DATA:
+            size = _body_size(self.data)
+            sendlog.info('data size: %s%s' % (
+                'unknown (streamed)' if size is None else size, plog))
+            if self.LOG_DATA and isinstance(self.data, basestring):
                 sendlog.info(self.data.replace(self._token, '...') if (
                     self._token) else self.data)
         else:
@@ -169,32 +451,91 @@ class RequestManager(Logged):
             headers[k] = quote(val) if quotable else val
         self.headers = headers
 
+    def _get_body(self):
+        """:returns: the body in a form that httplib can send"""
+        chunked = 'chunked' in [v.lower() for k, v in self.headers.items() if (
+            k.lower() == 'transfer-encoding')]
+        if self.data is None:
+            return None
+        if self._body_read:
+            #  The connection failed and the request is sent again
+            if self._rewind is None:
+                raise ClientError(
+                    'Connection to %s failed, the request body cannot be '
+                    'sent again' % self.netloc)
+            self._rewind()
+        self._body_read = True
+        if isinstance(self.data, _BUFFER_TYPES):
+            return _BodyStream(
+                [self.data], True, self._rewind) if chunked else self.data
+        return _BodyStream(self.data, chunked, self._rewind)
+
     def perform(self, conn):
-        """
+        """Send the request and wait for the response headers
+        Keep the connect_time, send_time (request and body) and ttfb (waiting
+        for the response headers) in seconds, and the body bytes sent
+
         :param conn: (httplib connection object)
 
         :returns: (HTTPResponse)
         """
         self._encode_headers()
         self.dump_log()
-        conn.request(
-            method=self.method.upper(),
-            url=self.path.encode('utf-8'),
-            headers=self.headers,
-            body=self.data)
-        sendlog.info('')
-        keep_trying = TIMEOUT
-        while keep_trying > 0:
-            try:
-                return conn.getresponse()
-            except ResponseNotReady:
-                wait = 0.03 * random()
-                sleep(wait)
-                keep_trying -= wait
+        self.started = self.started or time()
+        try:
+            if conn.sock is None:
+                start = time()
+                conn.timeout = self.timeout(self.connect_timeout)
+                conn.connect()
+                self.connect_time = time() - start
+            self.settimeout(conn.sock)
+            start, body = time(), self._get_body()
+            conn.request(
+                method=self.method.upper(),
+                url=self.path.encode('utf-8'),
+                headers=self.headers,
+                body=body)
+            self.sent = body.size if isinstance(body, _BodyStream) else (
+                len(body or ''))
+            sendlog.info('')
+            self.settimeout(conn.sock)
+            sent = time()
+            self.send_time = sent - start
+            r = conn.getresponse()
+            self.ttfb = time() - sent
+            return r
+        except SocketTimeout as err:
+            raise self.timeout_error(err)
+
+    def timeout(self, timeout):
+        """
+        :param timeout: (float) a connect or read timeout
+
+        :returns: (float) the timeout, limited by the time left until the
+            total timeout expires
+
+        :raises ClientError: if the total timeout has expired
+        """
+        if not (self.total_timeout and self.started):
+            return timeout
+        time_left = self.started + self.total_timeout - time()
+        if time_left <= 0:
+            raise self.timeout_error('total timeout %ss expired' % (
+                self.total_timeout))
+        return min(timeout, time_left) if timeout else time_left
+
+    def settimeout(self, sock):
+        """Set the read timeout of a (connected) socket"""
+        if sock is not None:
+            sock.settimeout(self.timeout(self.read_timeout))
+
+    def timeout_error(self, err):
         plog = ('\t[%s]' % self) if self.LOG_PID else ''
         logmsg = 'Kamaki Timeout %s %s%s' % (self.method, self.path, plog)
         recvlog.debug(logmsg)
-        raise ClientError('HTTPResponse takes too long - kamaki timeout')
+        return ClientError(
+            'HTTPResponse takes too long - kamaki timeout',
+            details=['%s %s: %s' % (self.method, self.url, err)])
 
     @property
     def headers_to_quote(self):
@@ -215,21 +556,72 @@ class RequestManager(Logged):
         self._header_prefices = list(set(self._header_prefices))
 
 
+class RequestEvent(object):
+    """The outcome of an http request, as reported to the client observers
+    Timings are in seconds: queued waiting for a pooled connection, connect,
+    ttfb waiting for the response headers after the request is sent and
+    transfer sending the request body and receiving the response body.
+    """
+    PHASES = ('queued', 'connect', 'ttfb', 'transfer', 'total')
+
+    def __init__(self, method, path, netloc='', operation=None):
+        """
+        :param path: (str) the path or a path template (e.g., /{account})
+
+        :param operation: (str) the type of the operation, default method
+        """
+        self.method, self.path, self.netloc = method, path, netloc
+        self.operation = operation or method
+        self.status, self.error, self.retries = None, None, 0
+        self.sent, self.received, self.started = 0, 0, None
+        self.queued, self.connect, self.ttfb, self.transfer, self.total = (
+            0.0, 0.0, 0.0, 0.0, 0.0)
+
+    def __repr__(self):
+        return '<RequestEvent %s %s %s %s %.3fs>' % (
+            self.operation, self.method, self.path,
+            self.status or self.error, self.total)
+
+
 class ResponseManager(Logged):
     """Manage the http request and handle the response data, headers, etc."""
 
-    def __init__(self, request, poolsize=None, connection_retry_limit=0):
+    def __init__(
+            self, request,
+            poolsize=None, connection_retry_limit=0, stream=False,
+            concurrency=None, observers=None):
         """
         :param request: (RequestManager)
 
         :param poolsize: (int) the size of the connection pool
 
         :param connection_retry_limit: (int)
+
+        :param stream: (bool) if set, do not read the response body at once,
+            keep the connection until the body is consumed (e.g., with
+            iter_content) or the response is closed
+
+        :param concurrency: (ConcurrencyController) to report the outcome of
+            the request to
+
+        :param observers: (list of callables) called with a RequestEvent
+            when the request is completed or fails
         """
         self.CONNECTION_TRY_LIMIT = 1 + connection_retry_limit
         self.request = request
         self._request_performed = False
         self.poolsize = poolsize
+        self.stream = stream
+        self.concurrency = concurrency
+        self.observers = observers or []
+        self.event = RequestEvent(
+            request.method, request.path.split('?')[0], request.netloc)
+        self._pooled, self._response, self._content = None, None, None
+        self._offset = 0
+        self._started, self._rtt, self._streamed, self._failed = (
+            None, None, 0, False)
+        self._body_started = None
+        self._json_source, self._json = None, None
         self._headers_to_decode, self._header_prefices = [], []
 
     def _get_headers_to_decode(self, headers):
@@ -243,20 +635,70 @@ class ResponseManager(Logged):
             return False
         return encodable + filter(has_prefix, keys.difference(encodable))
 
+    def _log_content(self, plog=''):
+        recvlog.info('data size: %s%s' % (
+            len(self._content) if self._content else 0, plog))
+        if self.LOG_DATA and self._content:
+            data = '%s%s' % (self._content, plog)
+            if self._token:
+                data = data.replace(self._token, '...')
+            recvlog.info(data)
+
+    def _report(self, size=0):
+        """Report the outcome of the request to the concurrency controller
+        and the observers
+        """
+        started, self._started = self._started, None
+        if not started:
+            return
+        status = getattr(self, '_status_code', None)
+        if self.concurrency:
+            self.concurrency.record(
+                self.request.netloc, started,
+                status=status, rtt=self._rtt, size=size, failed=self._failed)
+        if not self.observers:
+            return
+        now, event, req = time(), self.event, self.request
+        event.started, event.total = started, now - started
+        event.status = status
+        event.sent, event.received = req.sent, size
+        event.connect, event.ttfb = req.connect_time, req.ttfb
+        event.transfer = req.send_time + (
+            (now - self._body_started) if self._body_started else 0.0)
+        for observer in self.observers:
+            try:
+                observer(event)
+            except Exception as err:
+                log.warning('Request observer %s failed: %s' % (observer, err))
+
     def _get_response(self):
         if self._request_performed:
             return
 
+        self._started = time()
+        try:
+            self._perform_with_retries()
+        except Exception as err:
+            self._failed, self.event.error = True, err
+            self._report()
+            raise
+
+    def _perform_with_retries(self):
         pool_kw = dict(size=self.poolsize) if self.poolsize else dict()
         for retries in range(1, self.CONNECTION_TRY_LIMIT + 1):
             try:
-                with PooledHTTPConnection(
-                        self.request.netloc, self.request.scheme,
-                        **pool_kw) as connection:
+                pooled = PooledConnection(
+                    self.request.netloc, self.request.scheme, **pool_kw)
+                queued = time()
+                connection = pooled.acquire()
+                self.event.queued += time() - queued
+                try:
                     self.request.LOG_TOKEN = self.LOG_TOKEN
                     self.request.LOG_DATA = self.LOG_DATA
                     self.request.LOG_PID = self.LOG_PID
                     r = self.request.perform(connection)
+                    self._body_started = time()
+                    self._rtt = self._body_started - self._started
                     plog = ''
                     if self.LOG_PID:
                         recvlog.info('\n%s <-- %s <-- [req: %s]\n' % (
@@ -276,15 +718,19 @@ class ResponseManager(Logged):
                         self._headers[k] = unquote(v).decode('utf-8') if (
                             k.lower()) in enc_headers else v
                         recvlog.info('  %s: %s%s' % (k, v, plog))
-                    self._content = r.read()
-                    recvlog.info('data size: %s%s' % (
-                        len(self._content) if self._content else 0, plog))
-                    if self.LOG_DATA and self._content:
-                        data = '%s%s' % (self._content, plog)
-                        if self._token:
-                            data = data.replace(self._token, '...')
-                        recvlog.info(data)
+                    if self.stream:
+                        #  The connection is released when body is consumed
+                        self._pooled, self._response = pooled, r
+                        self._connection, pooled = connection, None
+                        recvlog.info('data: streamed%s' % plog)
+                    else:
+                        self._content = r.read()
+                        self._log_content(plog)
+                        self._report(len(self._content))
                     recvlog.info('-             -        -     -   -  - -')
+                finally:
+                    if pooled:
+                        pooled.release()
                 break
             except Exception as err:
                 if isinstance(err, HTTPException):
@@ -298,6 +744,95 @@ class ResponseManager(Logged):
                         '\n'.join(['%s' % type(err)] + format_stack()))
                     raise
 
+    def _release(self, discard=False):
+        """Return a streaming connection to the pool
+        :param discard: (bool) the body is not fully consumed, so the
+            connection cannot be reused as is
+        """
+        pooled, self._pooled = self._pooled, None
+        if pooled:
+            if discard:
+                self._connection.close()
+            self._response, self._connection = None, None
+            pooled.release()
+            self._report(self._streamed)
+
+    def _read_chunk(self, size):
+        """Read from a streamed response, respecting the request timeouts"""
+        try:
+            self.request.settimeout(self._connection.sock)
+            chunk = self._response.read(size)
+        except SocketTimeout as err:
+            self._failed = True
+            self.event.error = self.request.timeout_error(err)
+            raise self.event.error
+        self._streamed += len(chunk)
+        return chunk
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        """Iterate over the response body in chunks
+        If the response is not streamed, iterate over the (already read)
+        content
+
+        :param chunk_size: (int) maximum size of each chunk in bytes
+
+        :returns: (generator of str)
+        """
+        self._get_response()
+        if self._response is None:
+            content = self._content or ''
+            for pos in xrange(0, len(content), chunk_size):
+                yield content[pos:pos + chunk_size]
+            return
+        size, exhausted = 0, False
+        try:
+            while True:
+                chunk = self._read_chunk(chunk_size)
+                if not chunk:
+                    exhausted = True
+                    break
+                size += len(chunk)
+                yield chunk
+        finally:
+            recvlog.debug('streamed data size: %s' % size)
+            self._release(discard=not exhausted)
+
+    def read(self, size=None):
+        """File-like read on the response body
+
+        :param size: (int) read up to size bytes, if None read everything
+
+        :returns: (str) empty string means the body is consumed
+        """
+        self._get_response()
+        if self._response is None:
+            content, start = self._content or '', self._offset
+            end = len(content) if size is None else start + size
+            self._offset = min(end, len(content))
+            return content[start:end]
+        if size is None:
+            return ''.join(self.iter_content())
+        data = self._read_chunk(size)
+        if not data:
+            self._release()
+        return data
+
+    def readinto(self, buf):
+        """Read response body data into a pre-allocated writable buffer
+
+        :param buf: (bytearray or memoryview)
+
+        :returns: (int) number of bytes read, 0 means the body is consumed
+        """
+        data = self.read(len(buf))
+        size = len(data)
+        buf[:size] = data
+        return size
+
+    def close(self):
+        """Stop streaming and release the connection"""
+        self._release(discard=True)
+
     @property
     def status_code(self):
         self._get_response()
@@ -316,6 +851,9 @@ class ResponseManager(Logged):
     @property
     def content(self):
         self._get_response()
+        if self._response is not None:
+            self._content = ''.join(self.iter_content())
+            self._log_content()
         return self._content
 
     @property
@@ -323,8 +861,7 @@ class ResponseManager(Logged):
         """
         :returns: (str) content
         """
-        self._get_response()
-        return '%s' % self._content
+        return '%s' % self.content
 
     @property
     def headers_to_decode(self):
@@ -347,13 +884,42 @@ class ResponseManager(Logged):
     @property
     def json(self):
         """
-        :returns: (dict) squeezed from json-formated content
+        :returns: (dict) squeezed from json-formated content, decoded once
+        """
+        content = self.content
+        if content is not self._json_source:
+            try:
+                self._json = loads(content)
+            except ValueError as err:
+                raise ClientError('Response not formated in JSON - %s' % err)
+            self._json_source = content
+        return self._json
+
+    def iter_json(self, chunk_size=CHUNK_SIZE):
+        """Decode a JSON list response item by item
+        Streamed responses are decoded while the body arrives, without
+        keeping the whole body or list in memory
+
+        :returns: (generator) the items of the list
         """
-        self._get_response()
         try:
-            return loads(self._content)
+            for item in iter_json_list(
+                    self.iter_content(chunk_size), JSONDecoder()):
+                yield item
         except ValueError as err:
             raise ClientError('Response not formated in JSON - %s' % err)
+        finally:
+            self.close()
+
+
+class RequestContext(object):
+    """The settings of a single call: request headers and parameters, as well
+    as the response headers to decode. Clients keep one context per thread.
+    """
+
+    def __init__(self):
+        self.headers, self.params = dict(), dict()
+        self.response_headers, self.response_header_prefices = [], []
 
 
 class SilentEvent(Thread):
@@ -382,22 +948,687 @@ class SilentEvent(Thread):
             self._exception = e
 
 
+class ConcurrencyController(object):
+    """Additive increase, multiplicative decrease (AIMD) control of the number
+    of concurrent requests
+
+    Starting from min_limit, the limit doubles with every round of successful
+    requests (slow start) until the first congestion signal, and then grows
+    by increase per round. Congestion signals (responses with a status in
+    CONGESTION_STATUSES, timeouts and connection failures) multiply the limit
+    by decrease, at most once for each round of requests in flight.
+    Round trip times and throughput are tracked per endpoint.
+    """
+
+    CONGESTION_STATUSES = (413, 502, 503)
+    SMOOTHING = 0.125
+
+    def __init__(
+            self, max_limit=1, min_limit=1, increase=1.0, decrease=0.5):
+        assert 0 < min_limit <= max_limit, 'Bad concurrency limits'
+        assert 0.0 < decrease < 1.0, 'Decrease factor not in (0, 1)'
+        self.max_limit, self.min_limit = max_limit, min_limit
+        self.increase, self.decrease = increase, decrease
+        self.limit, self.slow_start = float(min_limit), True
+        self.endpoints = dict()
+        self._last_decrease = 0.0
+        self._lock = Lock()
+
+    @property
+    def window(self):
+        """:returns: (int) the number of requests allowed to run in parallel"""
+        return min(int(self.limit), self.max_limit)
+
+    def _smooth(self, old, new):
+        return new if old is None else old + self.SMOOTHING * (new - old)
+
+    def record(
+            self, endpoint, started,
+            status=None, rtt=None, size=0, failed=False):
+        """Adjust the limit to the outcome of a request
+
+        :param endpoint: (str) the netloc the request was sent to
+
+        :param started: (float) when the request started (epoch seconds)
+
+        :param status: (int) the response status, if any
+
+        :param rtt: (float) seconds until the response headers arrived
+
+        :param size: (int) response body bytes
+
+        :param failed: (bool) the request timed out or failed to connect
+        """
+        elapsed = time() - started
+        congested = failed or status in self.CONGESTION_STATUSES
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, dict(
+                requests=0, congested=0, rtt=None, throughput=None))
+            stats['requests'] += 1
+            window = self.window
+            if congested:
+                stats['congested'] += 1
+                if started > self._last_decrease:
+                    self._last_decrease = time()
+                    self.slow_start = False
+                    self.limit = max(
+                        self.min_limit, self.limit * self.decrease)
+            else:
+                if rtt is not None:
+                    stats['rtt'] = self._smooth(stats['rtt'], rtt)
+                if size and elapsed > 0:
+                    stats['throughput'] = self._smooth(
+                        stats['throughput'], size / elapsed)
+                if status and status < 500:
+                    self.limit = min(self.max_limit, self.limit + (
+                        self.increase if self.slow_start else (
+                            self.increase / self.limit)))
+            if window != self.window:
+                log.debug('concurrency limit %s -> %s (%s %s)' % (
+                    window, self.window, endpoint,
+                    'failed' if failed else status))
+
+    def state(self):
+        """:returns: (dict) limit, window, slow_start and per endpoint stats
+            (requests, congested, rtt in seconds, throughput in bytes/sec)
+        """
+        with self._lock:
+            return dict(
+                limit=self.limit,
+                window=self.window,
+                slow_start=self.slow_start,
+                endpoints=dict([
+                    (k, dict(v)) for k, v in self.endpoints.items()]))
+
+
+class RequestStats(object):
+    """In-memory aggregation of request events, per operation type
+    Register an instance as a client observer (client.add_observer) and get
+    the latency histograms and throughput of each operation with summary().
+
+    Latencies are counted in buckets with the upper bounds of BUCKETS
+    (seconds), plus an overflow bucket. Compare the phases of an operation to
+    tell where time goes: queued is spent in the client, connect and transfer
+    on the network and ttfb mostly on the server.
+    """
+
+    BUCKETS = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.operations = dict()
+
+    def __call__(self, event):
+        with self._lock:
+            stats = self.operations.get(event.operation)
+            if stats is None:
+                stats = self.operations[event.operation] = dict(
+                    requests=0, errors=0, retries=0, sent=0, received=0,
+                    statuses=dict(), histograms=dict([(
+                        phase, [0] * (len(self.BUCKETS) + 1)) for phase in (
+                            RequestEvent.PHASES)]),
+                    time=dict([(p, 0.0) for p in RequestEvent.PHASES]))
+            stats['requests'] += 1
+            stats['retries'] += 1 if event.retries else 0
+            stats['sent'] += event.sent
+            stats['received'] += event.received
+            if event.error is not None or (event.status or 0) >= 400:
+                stats['errors'] += 1
+            key = event.status or 'error'
+            stats['statuses'][key] = stats['statuses'].get(key, 0) + 1
+            for phase in RequestEvent.PHASES:
+                value = getattr(event, phase)
+                stats['time'][phase] += value
+                stats['histograms'][phase][
+                    bisect_left(self.BUCKETS, value)] += 1
+
+    def percentile(self, operation, phase, percent):
+        """:returns: (float) the upper bound of the histogram bucket with the
+            given percentile, None if there is no such operation, inf if in
+            the overflow bucket
+        """
+        with self._lock:
+            stats = self.operations.get(operation)
+            if not stats:
+                return None
+            histogram = stats['histograms'][phase]
+            rank, count = stats['requests'] * percent / 100.0, 0
+            for i, bucket in enumerate(histogram):
+                count += bucket
+                if count >= rank and count:
+                    break
+            return self.BUCKETS[i] if i < len(self.BUCKETS) else float('inf')
+
+    def summary(self):
+        """:returns: (dict) {operation: {requests, errors, retries, sent,
+            received, statuses, throughput (bytes per second of transfer),
+            mean: {phase: seconds}, p50, p90, p99: {phase: seconds},
+            histograms: {phase: [(upper bound, count), ...]}}}
+        """
+        with self._lock:
+            operations = dict([(k, dict(v, statuses=dict(v['statuses']))) for (
+                k, v) in self.operations.items()])
+        bounds = self.BUCKETS + (float('inf'), )
+        for operation, stats in operations.items():
+            n, total_time = stats['requests'], stats.pop('time')
+            stats['mean'] = dict([(p, t / n) for p, t in total_time.items()])
+            transfer = total_time['transfer']
+            stats['throughput'] = (
+                stats['sent'] + stats['received']) / transfer if (
+                    transfer) else None
+            for percent in (50, 90, 99):
+                stats['p%s' % percent] = dict([(
+                    p, self.percentile(operation, p, percent)) for p in (
+                        RequestEvent.PHASES)])
+            stats['histograms'] = dict([(p, zip(bounds, h)) for p, h in (
+                stats['histograms'].items())])
+        return operations
+
+
+class RetryPolicy(object):
+    """Decide if and when a failed request should be retried
+
+    Idempotent requests (IDEMPOTENT_METHODS, or as set per call) are retried
+    on responses with a status in statuses, on timeouts and on connection
+    failures. Other requests are retried only if the server has not
+    processed them, i.e., on responses with a status in unsafe_statuses or
+    on refused connections.
+    Retries wait for an exponentially growing, randomized (full jitter) delay,
+    from backoff up to max_backoff seconds, or as long as the Retry-After
+    response header asks, if it is not longer than max_retry_after.
+    """
+
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'COPY')
+
+    def __init__(
+            self, retries=0,
+            statuses=(429, 502, 503, 504), unsafe_statuses=(429, 503),
+            backoff=0.5, max_backoff=30.0, max_retry_after=300.0):
+        """
+        :param retries: (int) max number of retries of a request
+        """
+        self.retries = retries
+        self.statuses, self.unsafe_statuses = statuses, unsafe_statuses
+        self.backoff, self.max_backoff = backoff, max_backoff
+        self.max_retry_after = max_retry_after
+        self.stats = dict(attempts=0, retries=0, failures=0, outcomes=dict())
+        self._lock = Lock()
+
+    @staticmethod
+    def parse_retry_after(value):
+        """:returns: (float) seconds to wait, from delay-seconds or HTTP-date
+            Retry-After header values, None if the value is invalid
+        """
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            date = parsedate_tz(value)
+            return max(mktime_tz(date) - time(), 0.0) if date else None
+
+    def delay(self, attempt, retry_after=None):
+        """:returns: (float) seconds to wait before the next attempt, None if
+            the server asks for more than max_retry_after seconds
+        """
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_retry_after else (
+                None)
+        return random() * min(
+            self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+
+    def is_retriable(self, method, status=None, error=None, idempotent=None):
+        if idempotent is None:
+            idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        if error is None:
+            return status in (
+                self.statuses if idempotent else self.unsafe_statuses)
+        if getattr(error, 'errno', None) == ECONNREFUSED:
+            return True
+        #  timeouts and broken connections, the request may have been served
+        return idempotent and (isinstance(error, (
+            SocketError, HTTPException)) or (
+                isinstance(error, ClientError) and not error.status))
+
+    def retry_delay(
+            self, attempt, method,
+            status=None, error=None, retry_after=None, idempotent=None):
+        """Record the outcome of an attempt and decide on retrying
+
+        :param attempt: (int) the number of the failed attempt, starting at 1
+
+        :param method: (str) the HTTP method of the request
+
+        :param status: (int) the response status, if there is a response
+
+        :param error: (Exception) raised while performing the request
+
+        :param retry_after: (str) the Retry-After header of the response
+
+        :param idempotent: (bool) override the method based decision
+
+        :returns: (float) seconds to wait before retrying, None to give up
+        """
+        delay = None
+        if attempt <= self.retries and self.is_retriable(
+                method, status, error, idempotent):
+            delay = self.delay(attempt, self.parse_retry_after(retry_after))
+        outcome = status or type(error).__name__
+        with self._lock:
+            self.stats['attempts'] += 1
+            self.stats['retries' if delay is not None else 'failures'] += 1
+            outcomes = self.stats['outcomes']
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        return delay
+
+    def record_success(self, attempt):
+        with self._lock:
+            self.stats['attempts'] += 1
+
+
+class Future(object):
+    """The result of a method call submitted to a WorkerPool"""
+
+    def __init__(self, method, *args, **kwargs):
+        self.method, self.args, self.kwargs = method, args, kwargs
+        self._state, self._value, self._exception = 'pending', None, None
+        self._callbacks, self._lock, self._done = [], Lock(), Event()
+
+    def _set_state(self, state, expected=None):
+        with self._lock:
+            if expected and self._state != expected:
+                return False
+            self._state = state
+            if state not in ('done', 'cancelled'):
+                return True
+            callbacks, self._callbacks = self._callbacks, []
+        self._done.set()
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def _run(self):
+        if not self._set_state('running', 'pending'):
+            return
+        try:
+            self._value = self.method(*(self.args), **(self.kwargs))
+        except Exception as e:
+            recvlog.debug('Worker %s got exception %s\n<%s %s' % (
+                current_thread().name,
+                type(e),
+                e.status if isinstance(e, ClientError) else '',
+                e))
+            self._exception = e
+        finally:
+            #  Do not keep (possibly large) arguments, e.g. data blocks, alive
+            self.method, self.args, self.kwargs = None, (), {}
+            self._set_state('done')
+
+    def running(self):
+        return self._state == 'running'
+
+    def done(self):
+        return self._state in ('done', 'cancelled')
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def cancel(self):
+        """Cancel the call, unless it is already running or done
+
+        :returns: (bool) True if the call is cancelled
+        """
+        return self._set_state('cancelled', 'pending') or self.cancelled()
+
+    def add_done_callback(self, callback):
+        """Call callback(future) when the call is done or cancelled"""
+        with self._lock:
+            if self._state not in ('done', 'cancelled'):
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        """:returns: (bool) True if the call is done or cancelled"""
+        if timeout is not None:
+            return self._done.wait(timeout)
+        while not self._done.wait(WAIT_STEP):
+            pass
+        return True
+
+    def result(self, timeout=None):
+        """:returns: the value returned by the method
+
+        :raises ClientError: if the call timed out or was cancelled
+
+        :raises Exception: whatever the method raised
+        """
+        if not self.wait(timeout):
+            raise ClientError('Timed out waiting for %s' % self)
+        if self.cancelled():
+            raise ClientError('Call %s was cancelled' % self)
+        if self._exception:
+            raise self._exception
+        return self._value
+
+    def exception(self, timeout=None):
+        """:returns: the exception raised by the method, if any"""
+        if not self.wait(timeout):
+            raise ClientError('Timed out waiting for %s' % self)
+        return self._exception
+
+
+class WorkerBatch(object):
+    """A group of calls submitted to a WorkerPool, collected in the order
+    they are completed
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.futures = set()
+        self._done = Queue()
+
+    def __len__(self):
+        return len(self.futures)
+
+    def submit(self, method, *args, **kwargs):
+        """:returns: (Future) of method(*args, **kwargs)"""
+        future = self.pool.submit(method, *args, **kwargs)
+        self.futures.add(future)
+        future.add_done_callback(self._done.put)
+        return future
+
+    def completed(self, wait=False):
+        """Yield the futures of the batch that are done
+
+        :param wait: (bool) if set, wait until all futures are done, otherwise
+            yield only the ones done so far
+        """
+        while self.futures:
+            try:
+                future = self._done.get(wait, WAIT_STEP)
+            except Empty:
+                if wait:
+                    continue
+                return
+            self.futures.discard(future)
+            yield future
+
+    def cancel(self):
+        """Cancel pending calls and wait for the running ones to finish"""
+        futures = list(self.futures)
+        for future in futures:
+            future.cancel()
+        for future in futures:
+            future.wait()
+
+
+class WorkerPool(object):
+    """A bounded pool of persistent worker threads
+
+    Submitted calls are queued and run by at most size worker threads, which
+    are started on demand and reused until the pool is shut down. Submitting
+    blocks while max_pending calls (default: size) are waiting in the queue.
+    If a ConcurrencyController is given, its window further limits the number
+    of workers.
+    Calls that wait on futures of the same pool must not run in the pool.
+    """
+
+    def __init__(self, size=1, max_pending=None, controller=None):
+        assert isinstance(size, int) and size > 0, 'Pool size not a +int'
+        self.size, self.max_pending = size, max_pending
+        self.controller = controller
+        self._queue, self._lock = Queue(), Lock()
+        self._slots, self._pending = Condition(Lock()), 0
+        self._workers, self._idle = [], 0
+        self.is_shut_down = False
+
+    @property
+    def limit(self):
+        """:returns: (int) the number of workers allowed to run"""
+        if self.controller:
+            return max(1, min(self.size, self.controller.window))
+        return self.size
+
+    def resize(self, size):
+        """Change the number of workers, idle workers in excess stop"""
+        assert isinstance(size, int) and size > 0, 'Pool size not a +int'
+        with self._lock:
+            surplus = len(self._workers) - size
+            self.size = size
+        for i in range(surplus):
+            self._queue.put(None)
+        with self._slots:
+            self._slots.notify_all()
+
+    def _work(self):
+        me = current_thread()
+        while True:
+            with self._lock:
+                if len(self._workers) > self.limit:
+                    self._workers.remove(me)
+                    return
+                self._idle += 1
+            future = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+                if future is None and self.is_shut_down:
+                    self._workers.remove(me)
+                    return
+            if future is not None:
+                with self._slots:
+                    self._pending -= 1
+                    self._slots.notify()
+                future._run()
+
+    def submit(self, method, *args, **kwargs):
+        """Queue method(*args, **kwargs) to run on a worker thread
+
+        :returns: (Future)
+        """
+        assert not self.is_shut_down, 'Worker pool is shut down'
+        future = Future(method, *args, **kwargs)
+        with self._slots:
+            while self._pending >= (self.max_pending or self.size):
+                self._slots.wait(WAIT_STEP)
+            self._pending += 1
+        self._queue.put(future)
+        with self._lock:
+            if self._queue.qsize() > self._idle and (
+                    len(self._workers) < self.limit):
+                worker = Thread(target=self._work)
+                worker.daemon = True
+                self._workers.append(worker)
+                worker.start()
+        return future
+
+    def batch(self):
+        """:returns: (WorkerBatch) to submit calls and collect them as done"""
+        return WorkerBatch(self)
+
+    def map(self, method, kwarg_list, ordered=True):
+        """Run method(**kwargs) for each kwargs in kwarg_list
+
+        :param ordered: (bool) yield results in kwarg_list order, otherwise
+            as soon as they are ready
+
+        :returns: (generator) the results, calls not yet run are cancelled if
+            a call raises or the generator is closed
+        """
+        batch = self.batch()
+        futures = []
+        try:
+            for kwargs in kwarg_list:
+                futures.append(batch.submit(method, **kwargs))
+            for future in (futures if ordered else batch.completed(True)):
+                yield future.result()
+        finally:
+            batch.cancel()
+
+    def shutdown(self, wait=True, cancel=False):
+        """Stop the workers once the queue is empty
+
+        :param wait: (bool) wait for the workers to stop
+
+        :param cancel: (bool) cancel the calls that are still in the queue
+        """
+        with self._lock:
+            self.is_shut_down = True
+            workers = list(self._workers)
+        while cancel:
+            try:
+                future = self._queue.get_nowait()
+            except Empty:
+                break
+            if future is not None:
+                with self._slots:
+                    self._pending -= 1
+                    self._slots.notify()
+                future.cancel()
+        for worker in workers:
+            self._queue.put(None)
+        for worker in workers if wait else []:
+            while worker.is_alive():
+                worker.join(WAIT_STEP)
+
+
 class Client(Logged):
     service_type = ''
     MAX_THREADS = 1
     DATE_FORMATS = ['%a %b %d %H:%M:%S %Y', ]
     CONNECTION_RETRY_LIMIT = 0
+    CONNECTION_PREWARM = 0
+    RETRIES = 0
+    CONNECT_TIMEOUT = TIMEOUT
+    READ_TIMEOUT = TIMEOUT
+    TOTAL_TIMEOUT = None
 
     def __init__(self, base_url, token):
         assert base_url, 'No base_url for client %s' % self
         self.base_url = base_url
         self.token = token
-        self.headers, self.params = dict(), dict()
+        self._contexts = local()
+        self._workers, self._workers_lock = None, Lock()
+        self._concurrency = None
+        self.retry_policy = RetryPolicy(self.RETRIES)
+        self.observers = []
         self.poolsize = None
         self.request_headers_to_quote = []
         self.request_header_prefices_to_quote = []
-        self.response_headers = []
-        self.response_header_prefices = []
+        self.response_headers_to_decode = []
+        self.response_header_prefices_to_decode = []
+
+    @property
+    def context(self):
+        """:returns: (RequestContext) the next call of the current thread"""
+        try:
+            return self._contexts.context
+        except AttributeError:
+            self._contexts.context = RequestContext()
+            return self._contexts.context
+
+    def _reset_context(self):
+        self._contexts.context = RequestContext()
+
+    @property
+    def headers(self):
+        return self.context.headers
+
+    @headers.setter
+    def headers(self, headers):
+        self.context.headers = headers
+
+    @property
+    def params(self):
+        return self.context.params
+
+    @params.setter
+    def params(self, params):
+        self.context.params = params
+
+    @property
+    def response_headers(self):
+        return self.context.response_headers
+
+    @response_headers.setter
+    def response_headers(self, header_keys):
+        self.context.response_headers = header_keys
+
+    @property
+    def response_header_prefices(self):
+        return self.context.response_header_prefices
+
+    @response_header_prefices.setter
+    def response_header_prefices(self, header_key_prefices):
+        self.context.response_header_prefices = header_key_prefices
+
+    @property
+    def workers(self):
+        """:returns: (WorkerPool) the persistent pool of up to MAX_THREADS
+            threads, shared by all concurrent operations of the client
+        """
+        concurrency = self.concurrency
+        with self._workers_lock:
+            if self._workers is None or self._workers.is_shut_down:
+                self._workers = WorkerPool(
+                    self.MAX_THREADS, controller=concurrency)
+            elif self._workers.size != self.MAX_THREADS:
+                self._workers.resize(self.MAX_THREADS)
+            return self._workers
+
+    @property
+    def concurrency(self):
+        """:returns: (ConcurrencyController) adapts the number of workers, up
+            to MAX_THREADS, to the responses of the services
+        """
+        with self._workers_lock:
+            if self._concurrency is None:
+                self._concurrency = ConcurrencyController(self.MAX_THREADS)
+            self._concurrency.max_limit = self.MAX_THREADS
+            return self._concurrency
+
+    def prewarm_connections(self, count=None):
+        """Open keep-alive connections to the service in the background, so
+        that the following requests start on already open connections
+
+        :param count: (int) number of connections, default CONNECTION_PREWARM
+
+        :returns: (Thread) the thread that opens the connections, if any
+        """
+        count = count or self.CONNECTION_PREWARM
+        if not count:
+            return None
+        url = urlparse(self.base_url)
+        pool = get_connection_pool(url.scheme, url.netloc, self.poolsize)
+        thread = Thread(
+            target=pool.prewarm, args=(count, self.CONNECT_TIMEOUT))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def add_observer(self, observer):
+        """Call observer with a RequestEvent after each request
+
+        :param observer: (callable) e.g., a RequestStats instance
+        """
+        if observer not in self.observers:
+            self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        if observer in self.observers:
+            self.observers.remove(observer)
+
+    def _classify_request(self, method, path, params, headers):
+        """:returns: (path template, operation type) of a request, as reported
+            to the observers
+        """
+        return path, method.upper()
 
     @staticmethod
     def _unquote_header_keys(headers, prefices):
@@ -417,36 +1648,8 @@ class Client(Logged):
         for old, new in new_keys.items():
             headers[new] = headers.pop(old)
 
-    def _init_thread_limit(self, limit=1):
-        assert isinstance(limit, int) and limit > 0, 'Thread limit not a +int'
-        self._thread_limit = limit
-        self._elapsed_old = 0.0
-        self._elapsed_new = 0.0
-
-    def _watch_thread_limit(self, threadlist):
-        self._thread_limit = getattr(self, '_thread_limit', 1)
-        self._elapsed_new = getattr(self, '_elapsed_new', 0.0)
-        self._elapsed_old = getattr(self, '_elapsed_old', 0.0)
-        recvlog.debug('# running threads: %s' % len(threadlist))
-        if self._elapsed_old and self._elapsed_old >= self._elapsed_new and (
-                self._thread_limit < self.MAX_THREADS):
-            self._thread_limit += 1
-        elif self._elapsed_old <= self._elapsed_new and self._thread_limit > 1:
-            self._thread_limit -= 1
-
-        self._elapsed_old = self._elapsed_new
-        if len(threadlist) >= self._thread_limit:
-            self._elapsed_new = 0.0
-            for thread in threadlist:
-                begin_time = time()
-                thread.join()
-                self._elapsed_new += time() - begin_time
-            self._elapsed_new = self._elapsed_new / len(threadlist)
-            return []
-        return threadlist
-
     def async_run(self, method, kwarg_list):
-        """Fire threads of operations
+        """Run operations concurrently, on the worker pool of the client
 
         :param method: the method to run in each thread
 
@@ -456,29 +1659,7 @@ class Client(Logged):
         :returns: (list) the results of each method call w.r. to the order of
             kwarg_list
         """
-        flying, results = {}, {}
-        self._init_thread_limit()
-        for index, kwargs in enumerate(kwarg_list):
-            self._watch_thread_limit(flying.values())
-            flying[index] = SilentEvent(method=method, **kwargs)
-            flying[index].start()
-            unfinished = {}
-            for key, thread in flying.items():
-                if thread.isAlive():
-                    unfinished[key] = thread
-                elif thread.exception:
-                    raise thread.exception
-                else:
-                    results[key] = thread.value
-            flying = unfinished
-        sendlog.info('- - - wait for threads to finish')
-        for key, thread in flying.items():
-            if thread.isAlive():
-                thread.join()
-            if thread.exception:
-                raise thread.exception
-            results[key] = thread.value
-        return results.values()
+        return list(self.workers.map(method, kwarg_list))
 
     def _raise_for_status(self, r):
         log.debug('raise err from [%s] of type[%s]' % (r, type(r)))
@@ -491,11 +1672,12 @@ class Client(Logged):
         raise ClientError(message, status=status)
 
     def set_header(self, name, value, iff=True):
-        """Set a header 'name':'value'"""
+        """Set a header 'name':'value' for the next call of this thread"""
         if value is not None and iff:
             self.headers['%s' % name] = '%s' % value
 
     def set_param(self, name, value=None, iff=True):
+        """Set a parameter for the next call of this thread"""
         if iff:
             self.params[name] = '%s' % value
 
@@ -508,50 +1690,125 @@ class Client(Logged):
         These classes perform a lazy http request. Present method, by default,
         enforces them to perform the http call. Hint: call present method with
         success=None to get a non-performed ResponseManager object.
+        Call with stream=True to consume the response body in chunks (e.g.,
+        with r.iter_content()) instead of loading it in memory.
+        The data kwarg may be a string, a buffer, a file-like object or an
+        iterable of chunks. Bodies of unknown size are sent with chunked
+        transfer encoding.
+        The connect_timeout, read_timeout and total_timeout kwargs override
+        the CONNECT_TIMEOUT, READ_TIMEOUT and TOTAL_TIMEOUT of the client.
+        Failed requests are retried according to the retry_policy kwarg or
+        the retry_policy of the client. Set idempotent=True/False to override
+        the method based decision on whether retrying is safe. The number of
+        attempts is kept in the attempts attribute of the response.
+        The observers of the client get a RequestEvent for each attempt, the
+        operation kwarg overrides the operation type of the events.
         """
         assert isinstance(method, str) or isinstance(method, unicode)
         assert method
         assert isinstance(path, str) or isinstance(path, unicode)
+        context = self.context
         try:
-            headers = dict(self.headers)
+            headers = dict(context.headers)
             headers.update(async_headers)
-            params = dict(self.params)
+            params = dict(context.params)
             params.update(async_params)
             success = kwargs.pop('success', 200)
+            stream = kwargs.pop('stream', False)
+            retry_policy = kwargs.pop('retry_policy', self.retry_policy)
+            idempotent = kwargs.pop('idempotent', None)
+            operation = kwargs.pop('operation', None)
+            timeouts = dict(
+                connect_timeout=kwargs.pop(
+                    'connect_timeout', self.CONNECT_TIMEOUT),
+                read_timeout=kwargs.pop('read_timeout', self.READ_TIMEOUT),
+                total_timeout=kwargs.pop('total_timeout', self.TOTAL_TIMEOUT))
             data = kwargs.pop('data', None)
             headers.setdefault('X-Auth-Token', self.token)
             if 'json' in kwargs:
                 data = dumps(kwargs.pop('json'))
                 headers.setdefault('Content-Type', 'application/json')
-            if data:
-                headers.setdefault('Content-Length', '%s' % len(data))
-            plog = ('\t[%s]' % self) if self.LOG_PID else ''
+            if data and not [k for k in headers if k.lower() in (
+                    'content-length', 'transfer-encoding')]:
+                size = _body_size(data)
+                if size is None:
+                    headers['Transfer-Encoding'] = 'chunked'
+                else:
+                    headers['Content-Length'] = '%s' % size
+            rewind = _body_rewinder(data)
+            headers_to_decode = (
+                self.response_headers_to_decode + context.response_headers)
+            header_prefices = (
+                self.response_header_prefices_to_decode +
+                context.response_header_prefices)
+            template, default_operation = self._classify_request(
+                method, path, params, headers) if (
+                    self.observers) else (path, None)
+            operation = operation or default_operation
+        finally:
+            self._reset_context()
+
+        plog = ('\t[%s]' % self) if self.LOG_PID else ''
+        attempt, started = 0, time()
+        while True:
+            attempt += 1
             sendlog.debug('\n\nCMT %s@%s%s', method, self.base_url, plog)
             req = RequestManager(
                 method, self.base_url, path,
-                data=data, headers=headers, params=params)
+                data=data, headers=headers, params=params, started=started,
+                **timeouts)
             req.headers_to_quote = self.request_headers_to_quote
             req.header_prefices = self.request_header_prefices_to_quote
             #  req.log()
             r = ResponseManager(
                 req,
                 poolsize=self.poolsize,
-                connection_retry_limit=self.CONNECTION_RETRY_LIMIT)
-            r.headers_to_decode = self.response_headers
-            r.header_prefices = self.response_header_prefices
+                connection_retry_limit=self.CONNECTION_RETRY_LIMIT,
+                stream=stream,
+                concurrency=self.concurrency,
+                observers=self.observers)
+            r.event.path, r.event.retries = template, attempt - 1
+            r.event.operation = operation or r.event.operation
+            r.headers_to_decode = headers_to_decode
+            r.header_prefices = header_prefices
             r.LOG_TOKEN, r.LOG_DATA, r.LOG_PID = (
                 self.LOG_TOKEN, self.LOG_DATA, self.LOG_PID)
             r._token = headers['X-Auth-Token']
-        finally:
-            self.headers = dict()
-            self.params = dict()
+            r.attempts = attempt
 
-        if success is not None:
+            if success is None:
+                return r
             # Success can either be an int or a collection
             success = (success,) if isinstance(success, int) else success
-            if r.status_code not in success:
+            status, error, retry_after = None, None, None
+            try:
+                status = r.status_code
+            except Exception as err:
+                error = err
+            if error is None and status in success:
+                retry_policy.record_success(attempt)
+                return r
+            if error is None:
+                retry_after = dict([(
+                    k.lower(), v) for k, v in r.headers.items()]).get(
+                        'retry-after')
+            delay = retry_policy.retry_delay(
+                attempt, method, status, error, retry_after, idempotent) if (
+                    rewind) else None
+            total_timeout = timeouts['total_timeout']
+            if delay is not None and total_timeout and (
+                    started + total_timeout - time() <= delay):
+                #  The total timeout would expire before the next attempt
+                delay = None
+            if delay is None:
+                if error is not None:
+                    raise error
                 self._raise_for_status(r)
-        return r
+            sendlog.info('%s %s attempt %s failed (%s), retry in %.2fs' % (
+                method, path, attempt, status or error, delay))
+            r.close()
+            sleep(delay)
+            rewind()
 
     def delete(self, path, **kwargs):
         return self.request('delete', path, **kwargs)
@@ -41,6 +41,8 @@ import json
 class CycladesClient(CycladesRestClient, Waiter):
     """Synnefo Cyclades Compute API client"""
 
+    RETRIES = 3
+
     def create_server(
             self, name, flavor_id, image_id,
             metadata=None, personality=None, networks=None, project=None):
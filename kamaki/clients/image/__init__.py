@@ -59,10 +59,10 @@ class ImageClient(Client):
         super(ImageClient, self).__init__(base_url, token)
         self.request_headers_to_quote = ['X-Image-Meta-Name', ]
         self.request_header_prefices_to_quote = ['X-Image-Meta-Property-', ]
-        self.response_headers = [
+        self.response_headers_to_decode = [
             'X-Image-Meta-Name', 'X-Image-Meta-Location',
             'X-Image-Meta-Description']
-        self.response_header_prefices = ['X-Image-Meta-Property-', ]
+        self.response_header_prefices_to_decode = ['X-Image-Meta-Property-', ]
 
     def list_public(self, detail=False, filters={}, order=''):
         """
@@ -31,81 +31,521 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
-from threading import enumerate as activethreads
+from threading import Lock
 
-from os import fstat
+from os import fstat, walk, path, makedirs, remove, utime, lseek
+from os import SEEK_SET, SEEK_CUR
 from hashlib import new as newhashlib
-from time import time
-from StringIO import StringIO
-
-from binascii import hexlify
-
-from kamaki.clients import SilentEvent, sendlog
+from binascii import hexlify, unhexlify
+from calendar import timegm
+from time import time, strptime
+from collections import deque
+from bisect import bisect_left, bisect_right
+from multiprocessing import cpu_count
+from errno import ENXIO
+from sys import platform
+import os
+
+from kamaki.clients import sendlog, WorkerPool
 from kamaki.clients.pithos.rest_api import PithosRestClient
+from kamaki.clients.pithos.cache import HashmapCache
 from kamaki.clients.storage import ClientError
-from kamaki.clients.utils import path4url, filter_in, readall
+from kamaki.clients.utils import path4url, filter_in, readall, FileSlice
+
+try:
+    #  Copy file ranges in the kernel (Linux, glibc >= 2.27), with reflinks
+    #  where the file system supports them
+    import ctypes
+    _libc_copy_file_range = ctypes.CDLL(None, use_errno=True).copy_file_range
+    _libc_copy_file_range.restype = ctypes.c_ssize_t
+    _libc_copy_file_range.argtypes = [
+        ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_size_t, ctypes.c_uint]
+except Exception:
+    _libc_copy_file_range = None
+
+#  lseek whences to find the data and the holes of sparse files (not in the
+#  os module of python 2)
+_SEEK_DATA, _SEEK_HOLE = (3, 4) if platform.startswith('linux') else (
+    None, None)
+_SEEK_DATA = getattr(os, 'SEEK_DATA', _SEEK_DATA)
+_SEEK_HOLE = getattr(os, 'SEEK_HOLE', _SEEK_HOLE)
+
+
+_ZEROS = '\x00' * 4096
+
+
+def _data_size(block):
+    """:returns: (int) the size of block without its trailing zeros"""
+    end = len(block)
+    if not end or block[end - 1] != '\x00':
+        return end
+    step = len(_ZEROS)
+    while end >= step and block[end - step:end] == _ZEROS:
+        end -= step
+    start = max(end - step, 0)
+    return start + len(memoryview(block)[start:end].tobytes().rstrip('\x00'))
 
 
 def _pithos_hash(block, blockhash):
+    """Hash a block the Pithos+ way (trailing zeros are ignored), without
+    copying it
+    """
     h = newhashlib(blockhash)
-    h.update(block.rstrip('\x00'))
+    h.update(memoryview(block)[:_data_size(block)])
     return h.hexdigest()
 
 
-def _range_up(start, end, max_value, a_range):
+def _zero_hash(blockhash):
+    """:returns: (str) the hash of all-zero blocks, of any size"""
+    return _pithos_hash('', blockhash) if blockhash else None
+
+
+def _readinto(fileobj, buf):
+    """Fill a writable buffer (e.g., a memoryview of a bytearray) from the
+    current position of a file, or up to the end of the file, without
+    intermediate strings (file-like objects without readinto are read)
+
+    :returns: (int) the number of bytes read
+    """
+    readinto, size, got = getattr(fileobj, 'readinto', None), len(buf), 0
+    while got < size:
+        if readinto:
+            read = readinto(buf[got:]) or 0
+        else:
+            data = fileobj.read(size - got)
+            read = len(data)
+            buf[got:got + read] = data
+        if not read:
+            break
+        got += read
+    return got
+
+
+def _block_buffers(size, count=None):
+    """:returns: (generator of memoryview) writable buffers of size bytes,
+        up to count of them reused in turn, or new ones if count is None
+    """
+    ring = []
+    while True:
+        if count is not None and len(ring) >= count:
+            for buf in ring:
+                yield buf
+            continue
+        buf = memoryview(bytearray(size))
+        if count is not None:
+            ring.append(buf)
+        yield buf
+
+
+def _data_extents(fileobj, start, end):
+    """Find the data of a sparse file with SEEK_DATA and SEEK_HOLE
+
+    :returns: (list) the (start, end) positions of the data between start
+        and end, in order, None if the file system cannot tell
+    """
+    if _SEEK_DATA is None:
+        return None
+    extents, fd = [], fileobj.fileno()
+    position = lseek(fd, 0, SEEK_CUR)
+    try:
+        while start < end:
+            start = lseek(fd, start, _SEEK_DATA)
+            if start >= end:
+                break
+            hole = lseek(fd, start, _SEEK_HOLE)
+            extents.append((start, min(hole, end)))
+            start = hole
+    except OSError as err:
+        if err.errno != ENXIO:
+            #  ENXIO: no data after start
+            return None
+    finally:
+        lseek(fd, position, SEEK_SET)
+    return extents
+
+
+class _BlockSource(object):
+    """Read-only access to the blocks of a local file
+    Blocks are read straight into bytearrays and handed out as memoryviews,
+    so hashing and sending them copies no data. The file is not
+    memory-mapped: a file truncated while it is read would kill the process
+    (SIGBUS), while a short read is a clean error.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj, self._lock = fileobj, Lock()
+
+    def block(self, offset, size, buf=None):
+        """:param buf: (memoryview) a writable buffer of at least size bytes
+            to read into, default: a new one
+
+        :returns: (memoryview) size bytes from offset (less at the end of the
+            file)
+        """
+        if buf is None:
+            buf = memoryview(bytearray(size))
+        with self._lock:
+            self.fileobj.seek(offset)
+            return buf[:_readinto(self.fileobj, buf[:size])]
+
+    def blocks(self, blocksize, size, start=0, sparse=False, buffers=None):
+        """:returns: (generator of memoryview) the blocks of the file from
+            start up to size, stops early at the end of the file
+
+        :param sparse: (bool) if set, blocks which lie in holes of a sparse
+            file are not read, they are yielded as empty strings (they hash
+            like all-zero blocks)
+
+        :param buffers: (int) read the blocks into this many buffers, reused
+            in turn, so that a block is overwritten after as many more blocks
+            are read, default: a new buffer for each block
+        """
+        bufs = _block_buffers(max(min(blocksize, size - start), 0), buffers)
+        extents = None
+        if sparse:
+            try:
+                end = min(size, fstat(self.fileobj.fileno()).st_size)
+                extents = _data_extents(self.fileobj, start, end)
+            except (AttributeError, EnvironmentError, ValueError) as err:
+                #  e.g., file-like objects
+                sendlog.debug('Cannot find holes in %s: %s' % (
+                    self.fileobj, err))
+        if extents is None:
+            try:
+                self.fileobj.seek(start)
+            except (AttributeError, EnvironmentError):
+                #  e.g., pipes, read from where they are
+                if start:
+                    raise
+            return self._read_blocks(blocksize, size - start, bufs)
+        return self._sparse_blocks(blocksize, size, start, end, extents, bufs)
+
+    def _read_blocks(self, blocksize, size, bufs):
+        """Read size bytes from the current position of the file"""
+        offset = 0
+        while offset < size:
+            buf = next(bufs)[:min(blocksize, size - offset)]
+            block = buf[:_readinto(self.fileobj, buf)]
+            if not block:
+                return
+            offset += len(block)
+            yield block
+
+    def _sparse_blocks(self, blocksize, size, start, end, extents, bufs):
+        extents = deque(extents)
+        for offset in xrange(start, end, blocksize):
+            block_end = min(offset + blocksize, size)
+            while extents and extents[0][1] <= offset:
+                extents.popleft()
+            if extents and extents[0][0] < block_end:
+                block = self.block(offset, block_end - offset, next(bufs))
+                if not block:
+                    return
+                yield block
+            else:
+                yield ''
+
+
+def _seekable(fileobj):
+    """:returns: (bool) whether data can be written at random positions of a
+        file, e.g., False for terminals, pipes and sockets
     """
-    :param start: (int) the window bottom
+    try:
+        if fileobj.isatty():
+            return False
+        fileobj.seek(fileobj.tell())
+    except (AttributeError, EnvironmentError):
+        return False
+    return True
 
-    :param end: (int) the window top
 
-    :param max_value: (int) maximum accepted value
+def _plan_fetches(blocks, max_bytes, max_ranges=1):
+    """Group block downloads into fewer requests: contiguous blocks are
+    fetched as one range, and up to max_ranges ranges (multi-range requests)
+    are fetched together, as long as a request is up to max_bytes
 
-    :param a_range: (str) a range string in the form X[,X'[,X''[...]]]
-        where X: x|x-y|-x where x < y and x, y natural numbers
+    :param blocks: (list) (object position, size, ...) of the blocks to
+        download, in order of position
 
-    :returns: (str) a range string cut-off for the start-end range
-        an empty response means this window is out of range
+    :returns: (list) the requests, each a list of ranges, each a list of
+        contiguous blocks
     """
-    assert start >= 0, '_range_up called w. start(%s) < 0' % start
-    assert end >= start, '_range_up called w. end(%s) < start(%s)' % (
-        end, start)
-    assert end <= max_value, '_range_up called w. max_value(%s) < end(%s)' % (
-        max_value, end)
-    if not a_range:
-        return '%s-%s' % (start, end)
-    selected = []
-    for some_range in a_range.split(','):
-        v0, sep, v1 = some_range.partition('-')
-        if v0:
-            v0 = int(v0)
-            if sep:
-                v1 = int(v1)
-                if v1 < start or v0 > end or v1 < v0:
-                    continue
-                v0 = v0 if v0 > start else start
-                v1 = v1 if v1 < end else end
-                selected.append('%s-%s' % (v0, v1))
-            elif v0 < start:
-                continue
+    requests, ranges, size = [], [], 0
+    for block in blocks:
+        start, bytes = block[:2]
+        if ranges and size + bytes > max_bytes:
+            requests.append(ranges)
+            ranges, size = [], 0
+        elif ranges and start == sum(ranges[-1][-1][:2]):
+            ranges[-1].append(block)
+            size += bytes
+            continue
+        elif len(ranges) >= max_ranges:
+            requests.append(ranges)
+            ranges, size = [], 0
+        ranges.append([block])
+        size += bytes
+    if ranges:
+        requests.append(ranges)
+    return requests
+
+
+def _byteranges(response, start=0):
+    """Split the body of a response to a (multi-)range request
+
+    :param start: (int) the object position of the body, if the response
+        does not tell
+
+    :returns: (generator) (object position, data) of the parts of the body
+    """
+    content_type = response.headers.get('content-type', '')
+    if not content_type.startswith('multipart/byteranges'):
+        content_range = response.headers.get('content-range')
+        if content_range:
+            #  e.g., bytes 0-99/1000
+            start = int(content_range.split()[1].split('-')[0])
+        for chunk in response.iter_content():
+            yield start, chunk
+            start += len(chunk)
+        return
+    boundary = content_type.split('boundary=')[-1].strip('"')
+    for part in response.content.split('--%s' % boundary)[1:]:
+        if part.startswith('--'):
+            break
+        head, sep, data = part.partition('\r\n\r\n')
+        for line in head.split('\r\n'):
+            name, sep, value = line.partition(':')
+            if name.strip().lower() == 'content-range':
+                first, last = value.split()[1].split('/')[0].split('-')
+                yield int(first), data[:int(last) + 1 - int(first)]
+
+
+def _hash_blocks(blocks, blockhash, pool):
+    """Hash blocks in parallel, while they are read (hashlib releases the
+    GIL). Up to twice the pool size blocks are kept in memory.
+
+    :param blocks: (iterable of str) the data blocks, in order
+
+    :param pool: (WorkerPool) the threads that calculate the hashes
+
+    :returns: (generator of str) the hash of each block, in order
+    """
+    pending, window = deque(), 2 * pool.size
+    try:
+        for block in blocks:
+            pending.append(pool.submit(_pithos_hash, block, blockhash))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class _BlockRegistry(object):
+    """The block uploads of a run of uploads (e.g., of a directory tree), so
+    that each unique block is sent once, even by concurrent file uploads"""
+
+    def __init__(self):
+        self._lock, self._uploads = Lock(), dict()
+
+    def __len__(self):
+        return len(self._uploads)
+
+    def claim(self, hash, submit):
+        """Get the upload of a block, submit it if there is none (or if the
+        previous one failed)
+
+        :param submit: (callable) submit(hash) returns the Future of a new
+            upload of the block
+
+        :returns: (Future, bool) the upload and whether it was submitted now
+        """
+        with self._lock:
+            future = self._uploads.get(hash)
+            if future is None or future.done() and (
+                    future.cancelled() or future.exception()):
+                future = self._uploads[hash] = submit(hash)
+                return future, True
+            return future, False
+
+
+def _copy_range(src, src_offset, dst, dst_offset, size):
+    """Copy size bytes from a file position to another, in the kernel if
+    possible, else with reads and writes. Both files must be flushed.
+    Bytes beyond the end of src are copied as zeros.
+    """
+    if _libc_copy_file_range and size:
+        src_off, dst_off = ctypes.c_int64(src_offset), ctypes.c_int64(
+            dst_offset)
+        while size > 0:
+            copied = _libc_copy_file_range(
+                src.fileno(), ctypes.byref(src_off),
+                dst.fileno(), ctypes.byref(dst_off), size, 0)
+            if copied <= 0:
+                #  e.g., EXDEV, ENOSYS or end of src: copy the rest below
+                break
+            size -= copied
+        src_offset, dst_offset = src_off.value, dst_off.value
+    if size > 0:
+        src.seek(src_offset)
+        data = readall(src, size)
+        dst.seek(dst_offset)
+        dst.write(data + '\x00' * (size - len(data)))
+
+
+class BlockIndex(object):
+    """Where the blocks of a run of downloads (e.g., of a directory tree)
+    were written, so that the next occurrences of a block in other objects
+    are copied from the local files instead of downloaded again"""
+
+    def __init__(self):
+        self._lock, self._blocks = Lock(), dict()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def add(self, hash, local_path, offset, size):
+        """Register a block written at offset of a local file"""
+        with self._lock:
+            self._blocks.setdefault(hash, (local_path, offset, size))
+
+    def find(self, hash):
+        """:returns: (local path, offset, size) of a block, None if unknown
+        """
+        with self._lock:
+            return self._blocks.get(hash)
+
+
+def _top_hash(hashes, blockhash):
+    """The hash of a whole hashmap, as reported by Pithos in x_object_hash:
+    the root of a binary hash tree over the block hashes, padded with zero
+    digests up to a power of two
+
+    :param hashes: (list of str) the block hashes, in hex
+
+    :returns: (str) the top hash, in hex
+    """
+    if not hashes:
+        return newhashlib(blockhash, '').hexdigest()
+    if len(hashes) == 1:
+        return hashes[0]
+    level, width = [unhexlify(hash) for hash in hashes], 2
+    while width < len(level):
+        width *= 2
+    level += ['\x00' * len(level[0])] * (width - len(level))
+    while len(level) > 1:
+        level = [newhashlib(blockhash, level[i] + level[i + 1]).digest() for (
+            i) in xrange(0, len(level), 2)]
+    return hexlify(level[0])
+
+
+def _utc_timestamp(last_modified):
+    """:returns: (int) the seconds since the epoch of a listing date, e.g.,
+        2013-02-07T11:51:55.702751+00:00 (Pithos lists dates in UTC)
+    """
+    return timegm(strptime(last_modified[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+def _complete_progress(progress_cb, nblocks):
+    """Run a progress bar of nblocks steps to the end, for work done without
+    going through the blocks one by one"""
+    if progress_cb:
+        try:
+            progress_gen = progress_cb(nblocks)
+            for i in xrange(nblocks + 1):
+                progress_gen.next()
+        except Exception:
+            pass
+
+
+class _RangeSet(object):
+    """The bytes of an object selected by a range string, parsed once into
+    sorted, disjoint intervals, so that the part of each block in the set is
+    found with a binary search
+
+    Range strings are in the form X[,X'[,X''[...]]], where X is x-y (bytes x
+    to y), x (bytes 0 to x) or -x (the last x bytes), x <= y natural numbers.
+    An empty range string selects the whole object.
+    """
+
+    def __init__(self, a_range, size):
+        intervals = []
+        for some_range in (a_range or '-%s' % size).split(','):
+            v0, sep, v1 = some_range.partition('-')
+            if not v0:
+                v0, v1 = size - int(v1), size - 1
+            elif sep:
+                v0, v1 = int(v0), int(v1)
             else:
-                v1 = v0 if v0 <= end else end
-                selected.append('%s-%s' % (start, v1))
-        else:
-            v1 = int(v1)
-            if max_value - v1 > end:
-                continue
-            v0 = (max_value - v1) if max_value - v1 > start else start
-            selected.append('%s-%s' % (v0, end))
-    return ','.join(selected)
+                v0, v1 = 0, int(v0)
+            v0, v1 = max(v0, 0), min(v1, size - 1)
+            if v0 <= v1:
+                intervals.append((v0, v1))
+        self.starts, self.ends = [], []
+        for v0, v1 in sorted(intervals):
+            if self.ends and v0 <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], v1)
+            else:
+                self.starts.append(v0)
+                self.ends.append(v1)
+
+    def __len__(self):
+        """:returns: (int) the number of intervals"""
+        return len(self.starts)
+
+    def intersect(self, start, end):
+        """:returns: (list) the (first, last) byte positions of the intervals
+            of the set, cut-off for the start-end window, in order
+        """
+        selected = []
+        for i in xrange(bisect_left(self.ends, start), len(self.starts)):
+            if self.starts[i] > end:
+                break
+            selected.append((max(self.starts[i], start), min(
+                self.ends[i], end)))
+        return selected
+
+    def range_str(self, start, end):
+        """:returns: (str) a range string of the part of the set in the
+            start-end window, empty if there is none
+        """
+        return ','.join(['%s-%s' % i for i in self.intersect(start, end)])
 
 
 class PithosClient(PithosRestClient):
     """Synnefo Pithos+ API client"""
 
+    RETRIES = 5
+    HASH_THREADS = cpu_count()
+    SMALL_OBJECT_SIZE = 64 * 1024
+    UPLOAD_FILES = 8
+    UPLOAD_BYTES_IN_FLIGHT = 256 * 1024 * 1024
+    DOWNLOAD_REQUEST_BYTES = 4 * 1024 * 1024
+    DOWNLOAD_RANGES = 1     # more need multipart/byteranges server support
+
     def __init__(self, base_url, token, account=None, container=None):
         super(PithosClient, self).__init__(base_url, token, account, container)
         #  All kamaki-set headers are quoted
         self.request_header_prefices_to_quote = ['', ]
+        self._hashers = None
+        self.hashmap_cache = None
+        self.block_cache = None
+
+    @property
+    def hashers(self):
+        """:returns: (WorkerPool) HASH_THREADS threads to calculate block
+            hashes, separate from the network workers
+        """
+        with self._workers_lock:
+            if self._hashers is None or self._hashers.is_shut_down:
+                self._hashers = WorkerPool(self.HASH_THREADS)
+            elif self._hashers.size != self.HASH_THREADS:
+                self._hashers.resize(self.HASH_THREADS)
+            return self._hashers
 
     def create_container(
             self,
@@ -156,11 +596,13 @@ class PithosClient(PithosRestClient):
         """
         :param obj: (str) remote object path
 
-        :param f: open file descriptor
+        :param f: open file descriptor, its contents are streamed to the
+            server
 
         :param withHashFile: (bool)
 
-        :param size: (int) size of data to upload
+        :param size: (int) size of data to upload, if not given, upload until
+            EOF (with chunked transfer encoding if the size cannot be found)
 
         :param etag: (str)
 
@@ -180,18 +622,17 @@ class PithosClient(PithosRestClient):
         self._assert_container()
 
         if withHashFile:
-            data = f.read()
+            start = f.tell()
             try:
                 import json
-                data = json.dumps(json.loads(data))
+                json.load(f)
             except ValueError:
                 raise ClientError('"%s" is not json-formated' % f.name, 1)
             except SyntaxError:
                 msg = '"%s" is not a valid hashmap file' % f.name
                 raise ClientError(msg, 1)
-            f = StringIO(data)
-        else:
-            data = readall(f, size) if size else f.read()
+            f.seek(start)
+        data = FileSlice(f, size) if size else f
         r = self.object_put(
             obj,
             data=data,
@@ -244,28 +685,22 @@ class PithosClient(PithosRestClient):
         return r.headers
 
     # upload_* auxiliary methods
-    def _put_block_async(self, data, hash):
-        event = SilentEvent(method=self._put_block, data=data, hash=hash)
-        event.start()
-        return event
-
     def _put_block(self, data, hash):
         r = self.container_post(
             update=True,
             content_type='application/octet-stream',
             content_length=len(data),
             data=data,
-            format='json')
+            format='json',
+            idempotent=True)
         assert r.json[0] == hash, 'Local hash does not match server'
 
-    def _get_file_block_info(self, fileobj, size=None, cache=None):
+    def _get_container_block_info(self, cache=None):
         """
-        :param fileobj: (file descriptor) source
-
-        :param size: (int) size of data to upload from source
-
         :param cache: (dict) if provided, cache container info response to
         avoid redundant calls
+
+        :returns: (int, str) the block size and block hash algorithm
         """
         if isinstance(cache, dict):
             try:
@@ -275,8 +710,19 @@ class PithosClient(PithosRestClient):
                 cache[self.container] = meta
         else:
             meta = self.get_container_info()
-        blocksize = int(meta['x-container-block-size'])
-        blockhash = meta['x-container-block-hash']
+        return int(meta['x-container-block-size']), meta[
+            'x-container-block-hash']
+
+    def _get_file_block_info(self, fileobj, size=None, cache=None):
+        """
+        :param fileobj: (file descriptor) source
+
+        :param size: (int) size of data to upload from source
+
+        :param cache: (dict) if provided, cache container info response to
+        avoid redundant calls
+        """
+        blocksize, blockhash = self._get_container_block_info(cache)
         size = size if size is not None else fstat(fileobj.fileno()).st_size
         nblocks = 1 + (size - 1) // blocksize
         return (blocksize, blockhash, size, nblocks)
@@ -309,6 +755,38 @@ class PithosClient(PithosRestClient):
             success=success)
         return (None if r.status_code == 201 else r.json), r.headers
 
+    def _file_hashes(self, fileobj, blocksize, blockhash, size):
+        """Hash the blocks of the first size bytes of a file, in parallel
+        Hashes found in the hashmap_cache are not calculated again, the
+        hashmaps of whole files are stored there.
+
+        :returns: (generator of (hash, block size) tuples)
+        """
+        cache, key, hashes, sizes = self.hashmap_cache, None, [], deque()
+        if cache:
+            key, hashes = cache.lookup(fileobj, blocksize, blockhash)
+            if key and key[4] != size:
+                #  Only a part of the file is hashed
+                key, hashes = None, []
+        for offset, hash in zip(xrange(0, size, blocksize), hashes):
+            yield hash, min(blocksize, size - offset)
+
+        def blocks():
+            offset = len(hashes) * blocksize
+            #  _hash_blocks keeps up to 2 * pool size blocks being hashed
+            for block in _BlockSource(fileobj).blocks(
+                    blocksize, size, offset, sparse=True,
+                    buffers=2 * self.hashers.size + 1):
+                sizes.append(len(block) or min(blocksize, size - offset))
+                offset += sizes[-1]
+                yield block
+
+        for hash in _hash_blocks(blocks(), blockhash, self.hashers):
+            hashes.append(hash)
+            yield hash, sizes.popleft()
+        if key:
+            cache.store(fileobj, key, hashes)
+
     def _calculate_blocks_for_upload(
             self, blocksize, blockhash, size, nblocks, hashes, hmap, fileobj,
             hash_cb=None):
@@ -317,12 +795,8 @@ class PithosClient(PithosRestClient):
             hash_gen = hash_cb(nblocks)
             hash_gen.next()
 
-        for i in xrange(nblocks):
-            block = readall(fileobj, min(blocksize, size - offset))
-            bytes = len(block)
-            if bytes <= 0:
-                break
-            hash = _pithos_hash(block, blockhash)
+        for hash, bytes in self._file_hashes(
+                fileobj, blocksize, blockhash, size):
             hashes.append(hash)
             hmap[hash] = (offset, bytes)
             offset += bytes
@@ -332,47 +806,67 @@ class PithosClient(PithosRestClient):
                'read bytes(%s) != requested size (%s)' % (offset, size))
         assert offset == size, msg
 
-    def _upload_missing_blocks(self, missing, hmap, fileobj, upload_gen=None):
-        """upload missing blocks asynchronously"""
+    def _upload_missing_blocks(
+            self, missing, hmap, fileobj, upload_gen=None, registry=None):
+        """upload missing blocks asynchronously, each block upload is retried
+        according to the retry policy of the client
 
-        self._init_thread_limit()
+        :param registry: (_BlockRegistry) if given, blocks already uploaded or
+            being uploaded by other files of the run are not sent again
 
-        flying = []
-        failures = []
-        for hash in missing:
-            offset, bytes = hmap[hash]
-            fileobj.seek(offset)
-            data = readall(fileobj, bytes)
-            r = self._put_block_async(data, hash)
-            flying.append(r)
-            unfinished = self._watch_thread_limit(flying)
-            for thread in set(flying).difference(unfinished):
-                if thread.exception:
-                    failures.append(thread)
-                    if isinstance(
-                            thread.exception,
-                            ClientError) and thread.exception.status == 502:
-                        self.POOLSIZE = self._thread_limit
-                elif thread.isAlive():
-                    flying.append(thread)
-                elif upload_gen:
-                    try:
-                        upload_gen.next()
-                    except:
-                        pass
-            flying = unfinished
-
-        for thread in flying:
-            thread.join()
-            if thread.exception:
-                failures.append(thread)
-            elif upload_gen:
+        :returns: (dict) {hash: error} for blocks that failed to upload
+        """
+        batch, hashes, failures = self.workers.batch(), dict(), dict()
+        source, shared = _BlockSource(fileobj), dict()
+
+        def progress():
+            if upload_gen:
                 try:
                     upload_gen.next()
                 except:
                     pass
 
-        return [failure.kwargs['hash'] for failure in failures]
+        def collect(futures):
+            for future in futures:
+                if future.exception():
+                    failures[hashes[future]] = future.exception()
+                else:
+                    progress()
+
+        def put(hash):
+            offset, bytes = hmap[hash]
+            data = source.block(offset, bytes)
+            future = batch.submit(self._put_block, data, hash)
+            hashes[future] = hash
+            return future
+
+        try:
+            for hash in missing:
+                if registry is None:
+                    put(hash)
+                else:
+                    future, submitted = registry.claim(hash, put)
+                    if not submitted:
+                        shared[future] = hash
+                collect(batch.completed())
+            while shared:
+                future, hash = shared.popitem()
+                future.wait()
+                if future.cancelled() or future.exception():
+                    #  The other upload failed, send the block from here
+                    future, submitted = registry.claim(hash, put)
+                    if not submitted:
+                        shared[future] = hash
+                else:
+                    progress()
+                collect(batch.completed())
+            collect(batch.completed(wait=True))
+        except (Exception, KeyboardInterrupt):
+            sendlog.info('- - - wait for threads to finish')
+            batch.cancel()
+            raise
+
+        return failures
 
     def upload_object(
             self, obj, f,
@@ -387,7 +881,9 @@ class PithosClient(PithosRestClient):
             content_type=None,
             sharing=None,
             public=None,
-            container_info_cache=None):
+            container_info_cache=None,
+            block_registry=None,
+            block_hashes=None):
         """Upload an object using multiple connections (threads)
 
         :param obj: (str) remote object path
@@ -421,6 +917,12 @@ class PithosClient(PithosRestClient):
 
         :param container_info_cache: (dict) if given, avoid redundant calls to
             server for container info (block size and hash information)
+
+        :param block_registry: (_BlockRegistry) the blocks uploaded by a run of
+            uploads, e.g., upload_objects, to send each block once
+
+        :param block_hashes: (list) (hash, bytes) of the blocks of f, if they
+            are already calculated for its current contents
         """
         self._assert_container()
 
@@ -429,13 +931,38 @@ class PithosClient(PithosRestClient):
                 f, size, container_info_cache)
         (hashes, hmap, offset) = ([], {}, 0)
         content_type = content_type or 'application/octet-stream'
+        put_args = dict(
+            etag=etag,
+            if_etag_match=if_etag_match,
+            if_etag_not_match='*' if if_not_exist else None,
+            content_encoding=content_encoding,
+            content_disposition=content_disposition,
+            content_type=content_type,
+            permissions=sharing,
+            public=public)
 
-        self._calculate_blocks_for_upload(
-            *block_info,
-            hashes=hashes,
-            hmap=hmap,
-            fileobj=f,
-            hash_cb=hash_cb)
+        if size <= min(blocksize, self.SMALL_OBJECT_SIZE):
+            #  Sending the data costs less than asking for the missing block
+            _complete_progress(hash_cb, nblocks)
+            headers = self._put_object_data(obj, f, size, **put_args)
+            _complete_progress(upload_cb, nblocks)
+            return headers
+
+        #  Open connections for the block uploads while hashing (opt-in)
+        self.prewarm_connections()
+        if block_hashes is None:
+            self._calculate_blocks_for_upload(
+                *block_info,
+                hashes=hashes,
+                hmap=hmap,
+                fileobj=f,
+                hash_cb=hash_cb)
+        else:
+            for hash, bytes in block_hashes:
+                hashes.append(hash)
+                hmap[hash] = (offset, bytes)
+                offset += bytes
+            _complete_progress(hash_cb, nblocks)
 
         hashmap = dict(bytes=size, hashes=hashes)
         missing, obj_headers = self._create_object_or_get_missing_hashes(
@@ -450,7 +977,14 @@ class PithosClient(PithosRestClient):
             public=public)
 
         if missing is None:
+            _complete_progress(upload_cb, nblocks)
             return obj_headers
+        if nblocks == 1:
+            #  Send the only block as object data, instead of block POST and
+            #  hashmap PUT
+            headers = self._put_object_data(obj, f, size, **put_args)
+            _complete_progress(upload_cb, nblocks)
+            return headers
 
         if upload_cb:
             upload_gen = upload_cb(len(missing))
@@ -462,33 +996,13 @@ class PithosClient(PithosRestClient):
         else:
             upload_gen = None
 
-        retries = 7
-        try:
-            while retries:
-                sendlog.info('%s blocks missing' % len(missing))
-                num_of_blocks = len(missing)
-                missing = self._upload_missing_blocks(
-                    missing, hmap, f, upload_gen)
-                if missing:
-                    if num_of_blocks == len(missing):
-                        retries -= 1
-                    else:
-                        num_of_blocks = len(missing)
-                else:
-                    break
-            if missing:
-                try:
-                    details = ['%s' % thread.exception for thread in missing]
-                except Exception:
-                    details = ['Also, failed to read thread exceptions']
-                raise ClientError(
-                    '%s blocks failed to upload' % len(missing),
-                    details=details)
-        except KeyboardInterrupt:
-            sendlog.info('- - - wait for threads to finish')
-            for thread in activethreads():
-                thread.join()
-            raise
+        sendlog.info('%s blocks missing' % len(missing))
+        failures = self._upload_missing_blocks(
+            missing, hmap, f, upload_gen, block_registry)
+        if failures:
+            raise ClientError(
+                '%s blocks failed to upload' % len(failures),
+                details=['%s: %s' % item for item in failures.items()])
 
         r = self.object_put(
             obj,
@@ -505,6 +1019,106 @@ class PithosClient(PithosRestClient):
             success=201)
         return r.headers
 
+    def _put_object_data(self, obj, fileobj, size, **kwargs):
+        """Create an object of up to one block from the first size bytes
+        of a file, in a single request
+
+        :param kwargs: object_put arguments (e.g., content_type, etag)
+
+        :returns: (dict) created object metadata
+        """
+        data = _BlockSource(fileobj).block(0, size) if size else ''
+        r = self.object_put(obj, data=data, success=201, **kwargs)
+        return r.headers
+
+    def _upload_source(self, f, obj, kwargs):
+        """Upload an open file or, if f is a path, the file it points to"""
+        if isinstance(f, basestring):
+            with open(f, 'rb') as fileobj:
+                return self.upload_object(obj, fileobj, **kwargs)
+        return self.upload_object(obj, f, **kwargs)
+
+    def upload_objects(
+            self, sources,
+            max_files=None,
+            max_bytes=None,
+            upload_cb=None,
+            container_info_cache=None):
+        """Upload many files at once. Up to max_files files are uploaded
+        concurrently, while the size of the files in progress fits in
+        max_bytes (a larger file is uploaded alone). The next files are hashed
+        while the blocks of the current ones are uploaded, and blocks shared
+        by many files are sent once.
+
+        :param sources: (list) of (file, obj) or (file, obj, kwargs), where
+            file is an open file descriptor (rb) or a local path to open while
+            uploading, obj the remote object path and kwargs upload_object
+            arguments (e.g., content_type, sharing)
+
+        :param max_files: (int) default: UPLOAD_FILES
+
+        :param max_bytes: (int) default: UPLOAD_BYTES_IN_FLIGHT
+
+        :param upload_cb: optional progress.bar object for uploaded files
+
+        :param container_info_cache: (dict) if given, avoid redundant calls to
+            server for container info (block size and hash information)
+
+        :returns: (dict) {obj: response headers}
+        """
+        self._assert_container()
+        cache = container_info_cache if isinstance(
+            container_info_cache, dict) else dict()
+        self._get_container_block_info(cache)
+        budget = max_bytes or self.UPLOAD_BYTES_IN_FLIGHT
+        pool, registry = WorkerPool(max_files or self.UPLOAD_FILES), (
+            _BlockRegistry())
+        batch, uploads, results = pool.batch(), dict(), dict()
+        in_flight = 0
+
+        if upload_cb:
+            upload_gen = upload_cb(len(sources))
+            upload_gen.next()
+
+        def collect(future):
+            obj, size = uploads.pop(future)
+            if future.exception():
+                raise future.exception()
+            results[obj] = future.result()
+            if upload_cb:
+                upload_gen.next()
+            return size
+
+        try:
+            for source in sources:
+                f, obj, kwargs = (tuple(source) + (dict(), ))[:3]
+                kwargs = dict(
+                    kwargs,
+                    container_info_cache=cache,
+                    block_registry=registry)
+                size = kwargs.get('size')
+                if size is None:
+                    size = path.getsize(f) if isinstance(
+                        f, basestring) else fstat(f.fileno()).st_size
+                for future in batch.completed():
+                    in_flight -= collect(future)
+                while uploads and in_flight + size > budget:
+                    for future in batch.completed(wait=True):
+                        in_flight -= collect(future)
+                        break
+                future = batch.submit(self._upload_source, f, obj, kwargs)
+                uploads[future] = (obj, size)
+                in_flight += size
+            for future in batch.completed(wait=True):
+                collect(future)
+        except (Exception, KeyboardInterrupt):
+            sendlog.info('- - - wait for threads to finish')
+            batch.cancel()
+            raise
+        finally:
+            pool.shutdown(wait=False)
+        return results
+
     def upload_from_string(
             self, obj, input_str,
             hash_cb=None,
@@ -560,13 +1174,11 @@ class PithosClient(PithosRestClient):
         if not content_type:
             content_type = 'application/octet-stream'
 
-        hashes = []
-        hmap = {}
-        for blockid in range(nblocks):
-            start = blockid * blocksize
-            block = input_str[start: (start + blocksize)]
-            hashes.append(_pithos_hash(block, blockhash))
-            hmap[hashes[blockid]] = (start, block)
+        blocks = [buffer(input_str, start, blocksize) for start in xrange(
+            0, size, blocksize)]
+        hashes = list(_hash_blocks(blocks, blockhash, self.hashers))
+        hmap = dict([(hash, (blockid * blocksize, blocks[blockid])) for (
+            blockid, hash) in enumerate(hashes)])
 
         hashmap = dict(bytes=size, hashes=hashes)
         missing, obj_headers = self._create_object_or_get_missing_hashes(
@@ -588,41 +1200,24 @@ class PithosClient(PithosRestClient):
             for i in range(nblocks + 1 - num_of_missing):
                 self._cb_next()
 
-        tries = 7
-        old_failures = 0
+        batch, blocks, failures = self.workers.batch(), dict(), dict()
         try:
-            while tries and missing:
-                flying = []
-                failures = []
-                for hash in missing:
-                    offset, block = hmap[hash]
-                    bird = self._put_block_async(block, hash)
-                    flying.append(bird)
-                    unfinished = self._watch_thread_limit(flying)
-                    for thread in set(flying).difference(unfinished):
-                        if thread.exception:
-                            failures.append(thread.kwargs['hash'])
-                        if thread.isAlive():
-                            flying.append(thread)
-                        else:
-                            self._cb_next()
-                    flying = unfinished
-                for thread in flying:
-                    thread.join()
-                    if thread.exception:
-                        failures.append(thread.kwargs['hash'])
+            for hash in missing:
+                offset, block = hmap[hash]
+                blocks[batch.submit(self._put_block, block, hash)] = hash
+            for future in batch.completed(wait=True):
+                if future.exception():
+                    failures[blocks[future]] = future.exception()
+                else:
                     self._cb_next()
-                missing = failures
-                if missing and len(missing) == old_failures:
-                    tries -= 1
-                old_failures = len(missing)
-            if missing:
-                raise ClientError('%s blocks failed to upload' % len(missing))
-        except KeyboardInterrupt:
+        except (Exception, KeyboardInterrupt):
             sendlog.info('- - - wait for threads to finish')
-            for thread in activethreads():
-                thread.join()
+            batch.cancel()
             raise
+        if failures:
+            raise ClientError(
+                '%s blocks failed to upload' % len(failures),
+                details=['%s: %s' % item for item in failures.items()])
         self._cb_next()
 
         r = self.object_put(
@@ -659,97 +1254,356 @@ class PithosClient(PithosRestClient):
                 map_dict[h] = [i]
         return (blocksize, blockhash, total_size, hashmap['hashes'], map_dict)
 
-    def _dump_blocks_sync(
+    def _cached_block(self, hash, blockhash, size):
+        """:returns: (str) size bytes of a block from the block_cache, None
+            if the block is not cached
+        """
+        if not (self.block_cache and blockhash):
+            return None
+        data = self.block_cache.get(hash, blockhash)
+        if data is None:
+            return None
+        #  Trailing zeros do not count in block hashes
+        return data[:size].ljust(size, '\x00')
+
+    def _cache_block(self, hash, blockhash, data):
+        if self.block_cache and blockhash:
+            self.block_cache.put(hash, blockhash, data)
+
+    def _dump_blocks_ordered(
             self, obj, remote_hashes, blocksize, total_size, dst, crange,
-            **args):
+            blockhash=None, window=None, **args):
+        """Write the blocks of an object to a stream, in order, without
+        seeking (e.g., to a pipe, a socket or a terminal). Up to window blocks
+        (default: twice the worker threads) are fetched ahead in parallel and
+        kept until it is their turn, so memory use does not depend on the
+        object size.
+
+        :param remote_hashes: (list) the hashes of the blocks, in order
+        """
         if not total_size:
             return
-        for blockid, blockhash in enumerate(remote_hashes):
-            if blockhash:
+        window, pending = window or 2 * self.workers.size, deque()
+        zero_hash = None if crange else _zero_hash(blockhash)
+        run, max_bytes = [], self.DOWNLOAD_REQUEST_BYTES
+        selected = _RangeSet(crange, total_size)
+
+        def write(blocks, data):
+            if not isinstance(data, basestring):
+                data = data.result().content
+                if not crange:
+                    start = 0
+                    for block_hash, size in blocks:
+                        self._cache_block(
+                            block_hash, blockhash, data[start:start + size])
+                        start += size
+            dst.write(data)
+            dst.flush()
+            self._cb_next(len(blocks))
+
+        def submit(blocks, data_range):
+            args['data_range'] = 'bytes=%s' % data_range
+            pending.append((blocks, self.workers.submit(
+                self.object_get, obj, success=(200, 206), **args)))
+
+        def fetch_run():
+            if run:
+                submit([block[1:] for block in run], '%s-%s' % (
+                    run[0][0], run[-1][0] + run[-1][2] - 1))
+                del run[:]
+
+        try:
+            for blockid, block_hash in enumerate(remote_hashes):
                 start = blocksize * blockid
                 is_last = start + blocksize > total_size
                 end = (total_size - 1) if is_last else (start + blocksize - 1)
-                data_range = _range_up(start, end, total_size, crange)
-                if not data_range:
-                    self._cb_next()
-                    continue
-                args['data_range'] = 'bytes=%s' % data_range
-                r = self.object_get(obj, success=(200, 206), **args)
-                self._cb_next()
-                dst.write(r.content)
-                dst.flush()
-
-    def _get_block_async(self, obj, **args):
-        event = SilentEvent(self.object_get, obj, success=(200, 206), **args)
-        event.start()
-        return event
-
-    def _hash_from_file(self, fp, start, size, blockhash):
-        fp.seek(start)
-        block = readall(fp, size)
-        h = newhashlib(blockhash)
-        h.update(block.strip('\x00'))
-        return hexlify(h.digest())
-
-    def _thread2file(self, flying, blockids, local_file, offset=0, **restargs):
-        """write the results of a greenleted rest call to a file
-
-        :param offset: the offset of the file up to blocksize
-        - e.g. if the range is 10-100, all blocks will be written to
-        normal_position - 10
-        """
-        for key, g in flying.items():
-            if g.isAlive():
-                continue
-            if g.exception:
-                raise g.exception
-            block = g.value.content
-            for block_start in blockids[key]:
-                local_file.seek(block_start + offset)
-                local_file.write(block)
-                self._cb_next()
-            flying.pop(key)
-            blockids.pop(key)
+                size = end + 1 - start
+                data_range = selected.range_str(start, end)
+                data = '' if not data_range else None
+                if block_hash == zero_hash:
+                    data = '\x00' * size
+                elif data_range and not crange:
+                    data = self._cached_block(block_hash, blockhash, size)
+                if data is None and not crange:
+                    #  Contiguous blocks are fetched together
+                    if run and start + size - run[0][0] > max_bytes:
+                        fetch_run()
+                    run.append((start, block_hash, size))
+                else:
+                    fetch_run()
+                    if data is None:
+                        submit([(block_hash, size)], data_range)
+                    else:
+                        pending.append(([(block_hash, size)], data))
+                while pending and (len(pending) >= window or isinstance(
+                        pending[0][1], basestring) or pending[0][1].done()):
+                    write(*pending.popleft())
+            fetch_run()
+            while pending:
+                write(*pending.popleft())
+        except (Exception, KeyboardInterrupt):
+            sendlog.info('- - - wait for threads to finish')
+            for blocks, data in pending:
+                if not isinstance(data, basestring):
+                    data.cancel()
+                    data.wait()
+            raise
+
+    def _stream_block(
+            self, obj, local_file, starts, lock, cache_as=None, **restargs):
+        """Stream a remote block directly to one or more file positions
+
+        :param starts: (list) file positions to write the block at
+
+        :param lock: (threading.Lock) guards local_file seek/write
+
+        :param cache_as: (tuple) (hash, hash algorithm) to store the whole
+            block in the block_cache with, if there is a block_cache
+
+        :returns: (int) the size of the block
+        """
+        if not (self.block_cache and cache_as and cache_as[1]):
+            #  Do not keep the whole block in memory for nothing
+            cache_as = None
+        r = self.object_get(obj, success=(200, 206), stream=True, **restargs)
+        written, chunks = 0, []
+        for chunk in r.iter_content():
+            with lock:
+                for start in starts:
+                    local_file.seek(start + written)
+                    local_file.write(chunk)
+            written += len(chunk)
+            if cache_as:
+                chunks.append(chunk)
+        if cache_as:
+            self._cache_block(cache_as[0], cache_as[1], ''.join(chunks))
+        return written
+
+    def _stream_blocks(
+            self, obj, local_file, ranges, lock, blockhash=None, **restargs):
+        """Download one or more ranges of blocks (see _plan_fetches) with one
+        request, and write each block to its file positions
+
+        :param ranges: (list) lists of contiguous blocks, each a tuple of
+            (object position, size, file positions, hash)
+
+        :param lock: (threading.Lock) guards local_file seek/write
+
+        :param blockhash: (str) the hash algorithm to store whole blocks in
+            the block_cache with, if any
+
+        :returns: (int) the bytes of the blocks received
+        """
+        blocks = [block for contiguous in ranges for block in contiguous]
+        starts = [block[0] for block in blocks]
+        restargs['async_headers'] = {'Range': 'bytes=%s' % ','.join([
+            '%s-%s' % (run[0][0], sum(run[-1][:2]) - 1) for run in ranges])}
+        r = self.object_get(obj, success=(200, 206), stream=True, **restargs)
+        written = 0
+        chunks = dict() if (self.block_cache and blockhash) else None
+        for offset, data in _byteranges(r, starts[0]):
+            end = offset + len(data)
+            i = max(bisect_right(starts, offset) - 1, 0)
+            while i < len(blocks) and blocks[i][0] < end:
+                start, size, positions, block_hash = blocks[i]
+                low, high = max(offset, start), min(end, start + size)
+                if low < high:
+                    piece = data[low - offset:high - offset]
+                    with lock:
+                        for position in positions:
+                            local_file.seek(position + low - start)
+                            local_file.write(piece)
+                    written += high - low
+                    if chunks is not None:
+                        chunks.setdefault(i, []).append(piece)
+                i += 1
+        for i, pieces in (chunks or dict()).items():
+            data = ''.join(pieces)
+            if len(data) == blocks[i][1]:
+                self._cache_block(blocks[i][3], blockhash, data)
+        return written
+
+    def _hash_local_blocks(self, fileobj, blocksize, size, blockhash):
+        """:returns: (list) the hashes of the first size bytes of a local
+            file, block by block, calculated in parallel
+        """
+        fileobj.seek(0)
+        return [hash for hash, bytes in self._file_hashes(
+            fileobj, blocksize, blockhash, size)]
+
+    def _missing_blocks(
+            self, remote_hashes, blocksize, total_size, local_file,
+            blockhash=None, resume=False):
+        """Find the blocks of a download which are not in the local file yet.
+        On resume, the whole blocks already in the file are hashed in a
+        parallel pass (or found in the hashmap_cache) before any block is
+        requested.
+
+        :param remote_hashes: (dict) {hash: [block ids]}
+
+        :returns: (list) (hash, [file positions]) of the missing blocks, in
+            the order of their first position
+        """
+        local_hashes = []
+        if resume:
+            file_size = min(fstat(local_file.fileno()).st_size, total_size)
+            if file_size < total_size:
+                #  A partial block is missing, anyway
+                file_size -= file_size % blocksize
+            if file_size:
+                local_hashes = self._hash_local_blocks(
+                    local_file, blocksize, file_size, blockhash)
+        missing = []
+        for block_hash, blockids in remote_hashes.items():
+            unsaved = [blk * blocksize for blk in blockids if not (
+                blk < len(local_hashes) and local_hashes[blk] == block_hash)]
+            if unsaved:
+                missing.append((block_hash, sorted(unsaved)))
+        return sorted(missing, key=lambda m: m[1][0])
+
+    def _check_block_streams(self, futures, blockids, local_file):
+        """check on the calls that stream blocks to a file
+
+        :param futures: (iterable) finished calls of _stream_block
+
+        :param blockids: (dict) future: the file positions of its block
+        """
+        for future in futures:
+            if future.exception():
+                raise future.exception()
+            self._cb_next(len(blockids.pop(future)))
         local_file.flush()
 
+    def _copy_indexed_block(
+            self, block_index, hash, local_file, starts, size, lock):
+        """Copy a block from a local file of the block_index, if it is there
+
+        :returns: (bool) True if the block is copied to the starts positions
+        """
+        found = block_index.find(hash) if block_index else None
+        if not found or found[0] == getattr(local_file, 'name', None):
+            return False
+        src_path, src_offset, src_size = found
+        try:
+            with open(src_path, 'rb') as src:
+                with lock:
+                    local_file.flush()
+                    for start in starts:
+                        _copy_range(
+                            src, src_offset, local_file, start,
+                            min(size, src_size))
+                        if size > src_size:
+                            local_file.seek(start + src_size)
+                            local_file.write('\x00' * (size - src_size))
+        except EnvironmentError as err:
+            sendlog.info('Cannot copy block from %s: %s' % (src_path, err))
+            return False
+        return True
+
     def _dump_blocks_async(
             self, obj, remote_hashes, blocksize, total_size, local_file,
-            blockhash=None, resume=False, filerange=None, **restargs):
-        file_size = fstat(local_file.fileno()).st_size if resume else 0
-        flying = dict()
-        blockid_dict = dict()
+            blockhash=None, resume=False, filerange=None, block_index=None,
+            **restargs):
+        missing = self._missing_blocks(
+            remote_hashes, blocksize, total_size, local_file, blockhash,
+            resume)
+        zero_hash = None if filerange else _zero_hash(blockhash)
+        local_file.seek(0, 2)
+        file_size = local_file.tell()
+        self._cb_next(
+            sum([len(blockids) for blockids in remote_hashes.values()]) -
+            sum([len(unsaved) for block_hash, unsaved in missing]))
+        batch = self.workers.batch()
+        blockid_dict, fetches = dict(), []
+        selected = _RangeSet(filerange, total_size)
         offset = 0
+        lock = Lock()
 
-        self._init_thread_limit()
-        for block_hash, blockids in remote_hashes.items():
-            blockids = [blk * blocksize for blk in blockids]
-            unsaved = [blk for blk in blockids if not (
-                blk < file_size and block_hash == self._hash_from_file(
-                        local_file, blk, blocksize, blockhash))]
-            self._cb_next(len(blockids) - len(unsaved))
-            if unsaved:
+        try:
+            for block_hash, unsaved in missing:
                 key = unsaved[0]
-                self._watch_thread_limit(flying.values())
-                self._thread2file(
-                    flying, blockid_dict, local_file, offset,
-                    **restargs)
+                self._check_block_streams(
+                    batch.completed(), blockid_dict, local_file)
                 end = total_size - 1 if (
                     key + blocksize > total_size) else key + blocksize - 1
                 if end < key:
                     self._cb_next()
                     continue
-                data_range = _range_up(key, end, total_size, filerange)
+                if block_hash == zero_hash:
+                    #  Zeros past the end of the file are left as holes
+                    with lock:
+                        for start in unsaved:
+                            if start + offset < file_size:
+                                local_file.seek(start + offset)
+                                local_file.write('\x00' * (end + 1 - key))
+                    self._cb_next(len(unsaved))
+                    continue
+                data_range = selected.range_str(key, end)
                 if not data_range:
                     self._cb_next()
                     continue
+                if not filerange and self._copy_indexed_block(
+                        block_index, block_hash, local_file,
+                        [blk + offset for blk in unsaved],
+                        end + 1 - key, lock):
+                    self._cb_next(len(unsaved))
+                    continue
+                data = None if filerange else self._cached_block(
+                    block_hash, blockhash, end + 1 - key)
+                if data is not None:
+                    with lock:
+                        for start in unsaved:
+                            local_file.seek(start + offset)
+                            local_file.write(data)
+                    self._cb_next(len(unsaved))
+                    continue
+                if not filerange:
+                    fetches.append((
+                        key, end + 1 - key, [blk + offset for blk in unsaved],
+                        block_hash))
+                    continue
                 restargs[
                     'async_headers'] = {'Range': 'bytes=%s' % data_range}
-                flying[key] = self._get_block_async(obj, **restargs)
-                blockid_dict[key] = unsaved
-
-        for thread in flying.values():
-            thread.join()
-        self._thread2file(flying, blockid_dict, local_file, offset, **restargs)
+                future = batch.submit(
+                    self._stream_block, obj, local_file,
+                    [blk + offset for blk in unsaved], lock, **restargs)
+                blockid_dict[future] = unsaved
+            for ranges in _plan_fetches(
+                    fetches, self.DOWNLOAD_REQUEST_BYTES,
+                    self.DOWNLOAD_RANGES):
+                self._check_block_streams(
+                    batch.completed(), blockid_dict, local_file)
+                if len(ranges) == 1 and len(ranges[0]) == 1:
+                    key, size, starts, block_hash = ranges[0][0]
+                    restargs['async_headers'] = {
+                        'Range': 'bytes=%s-%s' % (key, key + size - 1)}
+                    future = batch.submit(
+                        self._stream_block, obj, local_file, starts, lock,
+                        cache_as=(block_hash, blockhash) if (
+                            self.block_cache and blockhash) else None,
+                        **restargs)
+                else:
+                    future = batch.submit(
+                        self._stream_blocks, obj, local_file, ranges, lock,
+                        blockhash, **restargs)
+                blockid_dict[future] = [start for contiguous in ranges for (
+                    block) in contiguous for start in block[2]]
+            self._check_block_streams(
+                batch.completed(wait=True), blockid_dict, local_file)
+        except (Exception, KeyboardInterrupt):
+            sendlog.info('- - - wait for threads to finish')
+            batch.cancel()
+            raise
+        local_path = getattr(local_file, 'name', None)
+        if block_index is not None and not filerange and isinstance(
+                local_path, basestring) and path.isfile(local_path):
+            for block_hash, blockids in remote_hashes.items():
+                if block_hash == zero_hash:
+                    continue
+                start = blockids[0] * blocksize
+                block_index.add(
+                    block_hash, local_path, start + offset,
+                    min(blocksize, total_size - start))
 
     def download_object(
             self, obj, dst,
@@ -760,12 +1614,14 @@ class PithosClient(PithosRestClient):
             if_match=None,
             if_none_match=None,
             if_modified_since=None,
-            if_unmodified_since=None):
+            if_unmodified_since=None,
+            block_index=None):
         """Download an object (multiple connections, random blocks)
 
         :param obj: (str) remote object path
 
-        :param dst: open file descriptor (wb+)
+        :param dst: open file descriptor (wb+), or a stream which cannot seek
+            (e.g., a pipe), where the blocks are written in order
 
         :param download_cb: optional progress.bar object for downloading
 
@@ -781,7 +1637,11 @@ class PithosClient(PithosRestClient):
 
         :param if_modified_since: (str) formated date
 
-        :param if_unmodified_since: (str) formated date"""
+        :param if_unmodified_since: (str) formated date
+
+        :param block_index: (BlockIndex) shared by a run of downloads, to copy
+            blocks already downloaded to other local files instead of
+            downloading them again"""
         restargs = dict(
             version=version,
             data_range=None if range_str is None else 'bytes=%s' % range_str,
@@ -802,14 +1662,15 @@ class PithosClient(PithosRestClient):
             self.progress_bar_gen = download_cb(len(hash_list))
             self._cb_next()
 
-        if dst.isatty():
-            self._dump_blocks_sync(
+        if not _seekable(dst):
+            self._dump_blocks_ordered(
                 obj,
                 hash_list,
                 blocksize,
                 total_size,
                 dst,
                 range_str,
+                blockhash=blockhash,
                 **restargs)
         else:
             self._dump_blocks_async(
@@ -821,6 +1682,7 @@ class PithosClient(PithosRestClient):
                 blockhash,
                 resume,
                 range_str,
+                block_index=block_index,
                 **restargs)
             if not range_str:
                 dst.truncate(total_size)
@@ -877,35 +1739,47 @@ class PithosClient(PithosRestClient):
             self.progress_bar_gen = download_cb(len(hash_list))
             self._cb_next()
 
-        num_of_blocks = len(remote_hashes)
-        ret = [''] * num_of_blocks
-        self._init_thread_limit()
-        flying = dict()
+        ret = [''] * len(hash_list)
+        batch, blockids = self.workers.batch(), dict()
+        zero_hash = None if range_str else _zero_hash(blockhash)
+        selected = _RangeSet(range_str, total_size)
+
+        def collect(futures):
+            for future in futures:
+                blockid = blockids[future]
+                ret[blockid] = future.result().content
+                if not range_str:
+                    self._cache_block(
+                        hash_list[blockid], blockhash, ret[blockid])
+                self._cb_next()
+
         try:
-            for blockid, blockhash in enumerate(remote_hashes):
+            for blockid in range(len(hash_list)):
                 start = blocksize * blockid
                 is_last = start + blocksize > total_size
                 end = (total_size - 1) if is_last else (start + blocksize - 1)
-                data_range_str = _range_up(start, end, end, range_str)
+                if hash_list[blockid] == zero_hash:
+                    data = '\x00' * (end + 1 - start)
+                else:
+                    data = None if range_str else self._cached_block(
+                        hash_list[blockid], blockhash, end + 1 - start)
+                if data is not None:
+                    ret[blockid] = data
+                    self._cb_next()
+                    continue
+                data_range_str = selected.range_str(start, end)
                 if data_range_str:
-                    self._watch_thread_limit(flying.values())
                     restargs['data_range'] = 'bytes=%s' % data_range_str
-                    flying[blockid] = self._get_block_async(obj, **restargs)
-                for runid, thread in flying.items():
-                    if (blockid + 1) == num_of_blocks:
-                        thread.join()
-                    elif thread.isAlive():
-                        continue
-                    if thread.exception:
-                        raise thread.exception
-                    ret[runid] = thread.value.content
-                    self._cb_next()
-                    flying.pop(runid)
+                    future = batch.submit(
+                        self.object_get, obj, success=(200, 206), **restargs)
+                    blockids[future] = blockid
+                collect(batch.completed())
+            collect(batch.completed(wait=True))
             return ''.join(ret)
-        except KeyboardInterrupt:
+        except (Exception, KeyboardInterrupt):
             sendlog.info('- - - wait for threads to finish')
-            for thread in activethreads():
-                thread.join()
+            batch.cancel()
+            raise
 
     #Command Progress Bar method
     def _cb_next(self, step=1):
@@ -923,6 +1797,267 @@ class PithosClient(PithosRestClient):
             except:
                 break
 
+    # sync_* methods
+    def _local_tree(self, local_dir):
+        """:returns: (set, dict) the subdirectories and {path: full path} of
+            the regular files under local_dir, with /-separated paths relative
+            to local_dir
+        """
+        dirs, files = set(), dict()
+        for top, subdirs, filenames in walk(local_dir):
+            rel_path = path.relpath(top, local_dir)
+            rel_path = '' if rel_path == '.' else '%s/' % (
+                rel_path.replace(path.sep, '/'))
+            dirs.update(rel_path + d for d in subdirs)
+            for name in filenames:
+                fpath = path.join(top, name)
+                if path.isfile(fpath):
+                    files[rel_path + name] = fpath
+        return dirs, files
+
+    def _remote_tree(self, prefix):
+        """:returns: (dict, dict) the directory and file objects under prefix,
+            by their path relative to prefix
+        """
+        dirs, files = dict(), dict()
+        for obj in self.iter_objects(prefix=prefix):
+            name = obj['name'][len(prefix):]
+            if not name:
+                continue
+            ctype = obj.get('content_type', '').split(';')[0]
+            is_dir = ctype in ('application/directory', 'application/folder')
+            (dirs if is_dir else files)[name] = obj
+        return dirs, files
+
+    def sync_plan(
+            self, local_dir, prefix='', direction='upload', delete=False,
+            container_info_cache=None):
+        """Compare a local directory with the objects under a remote prefix.
+        Files are considered equal if they have the same size and top hash
+        (x_object_hash). Local files that keep the last_modified date of the
+        object they were synced from, are not hashed again.
+
+        :param local_dir: (str) the local directory
+
+        :param prefix: (str) the remote directory (e.g., some/dir)
+
+        :param direction: (str) upload (local to remote) or download
+
+        :param delete: (bool) also delete the files that are missing from the
+            source side
+
+        :returns: (list of dicts) the actions (mkdir, upload, download,
+            delete) that bring the destination up to date, in order. Each
+            has an action, a path (relative to both directories), the bytes
+            to transfer and the size of the source file
+
+        :param container_info_cache: (dict) if given, avoid redundant calls to
+            server for container info (block size and hash information)
+        """
+        assert direction in ('upload', 'download'), (
+            'Unknown sync direction %s' % direction)
+        self._assert_container()
+        prefix = prefix.strip('/')
+        prefix = '%s/' % prefix if prefix else ''
+        blocksize, blockhash = self._get_container_block_info(
+            container_info_cache)
+        ldirs, lfiles = self._local_tree(local_dir)
+        rdirs, rfiles = self._remote_tree(prefix)
+        mkdirs, transfers, deletes = [], [], []
+
+        def local_hashes(fpath, size):
+            """:returns: (list, tuple) the (hash, bytes) of the blocks and
+                the identity of the file they hold for (see HashmapCache.key),
+                None if the file may change unnoticed
+            """
+            with open(fpath, 'rb') as f:
+                key = HashmapCache.key(f, blocksize, blockhash)
+                hashes = list(self._file_hashes(f, blocksize, blockhash, size))
+                if key != HashmapCache.key(f, blocksize, blockhash) or (
+                        key[5] / 1e9 > time() - HashmapCache.RACY_WINDOW):
+                    key = None
+                return hashes, key
+
+        def entry(action, name, bytes=0, size=0, **kwargs):
+            return dict(
+                action=action, path=name, bytes=bytes, size=size, **kwargs)
+
+        if direction == 'upload':
+            mkdirs = [entry('mkdir', d) for d in ldirs if d not in rdirs]
+            for name, fpath in lfiles.items():
+                size, obj = path.getsize(fpath), rfiles.get(name)
+                if not obj:
+                    transfers.append(entry('upload', name, size, size))
+                    continue
+                hashes, key = local_hashes(fpath, size)
+                if int(obj['bytes']) == size and obj.get(
+                        'x_object_hash') == _top_hash(
+                            [h for h, b in hashes], blockhash):
+                    continue
+                remote = self.get_object_hashmap(prefix + name)['hashes']
+                if remote == [h for h, b in hashes]:
+                    continue
+                remote = set(remote)
+                transfers.append(entry('upload', name, sum(
+                    b for h, b in hashes if h not in remote), size,
+                    hashes=hashes, file_key=key))
+            if delete:
+                missing = set(rfiles).union(rdirs).difference(
+                    ldirs.union(lfiles))
+                deletes = [entry('delete', name) for name in missing]
+        else:
+            mkdirs = [entry('mkdir', d) for d in rdirs if d not in ldirs]
+            for name, obj in rfiles.items():
+                size = int(obj['bytes'])
+                mtime = _utc_timestamp(obj['last_modified'])
+                fpath = path.join(local_dir, *name.split('/'))
+                if name not in lfiles:
+                    if path.isdir(fpath):
+                        raise ClientError(
+                            'Cannot replace local directory %s with a file' % (
+                                fpath))
+                    transfers.append(entry(
+                        'download', name, size, size, mtime=mtime))
+                    continue
+                lsize = path.getsize(fpath)
+                if lsize == size and int(path.getmtime(fpath)) == mtime:
+                    continue
+                hashes = [h for h, b in local_hashes(
+                    fpath, min(lsize, size))[0]]
+                if lsize == size and obj.get('x_object_hash') == _top_hash(
+                        hashes, blockhash):
+                    continue
+                remote = self.get_object_hashmap(prefix + name)['hashes']
+                if lsize == size and remote == hashes:
+                    continue
+                bytes = sum(min(blocksize, size - i * blocksize) for (
+                    i, hash) in enumerate(remote) if not (
+                        i < len(hashes) and hashes[i] == hash))
+                transfers.append(entry(
+                    'download', name, bytes, size, mtime=mtime))
+            if delete:
+                deletes = [entry('delete', name) for name in lfiles if not (
+                    name in rfiles or name in rdirs)]
+
+        mkdirs.sort(key=lambda e: e['path'])
+        transfers.sort(key=lambda e: e['path'])
+        deletes.sort(key=lambda e: e['path'], reverse=True)
+        return mkdirs + transfers + deletes
+
+    def _sync_upload_file(
+            self, obj, fpath, hashes=None, file_key=None,
+            container_info_cache=None):
+        """Upload a file, sending only the blocks the server does not have
+
+        :param hashes: (list) (hash, bytes) of the file blocks, if known
+
+        :param file_key: (tuple) the identity of the file the hashes were
+            calculated for (see HashmapCache.key), they are not used if the
+            file changed since then
+        """
+        with open(fpath, 'rb') as f:
+            if file_key is None or file_key != HashmapCache.key(
+                    f, *file_key[2:4]):
+                hashes = None
+            return self.upload_object(
+                obj, f,
+                container_info_cache=container_info_cache,
+                block_hashes=hashes)
+
+    def _sync(
+            self, local_dir, prefix, direction, delete, dry_run, sync_cb,
+            plan):
+        cache = dict()
+        if plan is None:
+            plan = self.sync_plan(local_dir, prefix, direction, delete, cache)
+        if dry_run:
+            return plan
+        prefix = prefix.strip('/')
+        prefix = '%s/' % prefix if prefix else ''
+        if sync_cb:
+            sync_gen = sync_cb(len(plan))
+            sync_gen.next()
+        block_index = BlockIndex()
+        for entry in plan:
+            action, name = entry['action'], entry['path']
+            lpath = path.join(local_dir, *name.split('/'))
+            if action == 'mkdir' and direction == 'upload':
+                self.create_directory(prefix + name)
+            elif action == 'mkdir':
+                if not path.isdir(lpath):
+                    makedirs(lpath)
+            elif action == 'upload':
+                self._sync_upload_file(
+                    prefix + name, lpath, entry.get('hashes'),
+                    entry.get('file_key'), cache)
+            elif action == 'download':
+                if not path.isdir(path.dirname(lpath)):
+                    makedirs(path.dirname(lpath))
+                resume = path.exists(lpath)
+                with open(lpath, 'rb+' if resume else 'wb+') as f:
+                    self.download_object(
+                        prefix + name, f,
+                        resume=resume, block_index=block_index)
+                utime(lpath, (time(), entry['mtime']))
+            elif direction == 'upload':
+                self.del_object(prefix + name)
+            else:
+                remove(lpath)
+            if sync_cb:
+                sync_gen.next()
+        return plan
+
+    def sync_upload(
+            self, local_dir, prefix='', delete=False, dry_run=False,
+            sync_cb=None, plan=None):
+        """Make the objects under a remote prefix mirror a local directory.
+        Only new or changed files are uploaded, and only the blocks of them
+        that the server does not already have.
+
+        :param local_dir: (str) the local directory
+
+        :param prefix: (str) the remote directory (e.g., some/dir)
+
+        :param delete: (bool) delete remote objects missing locally
+
+        :param dry_run: (bool) only calculate the plan, transfer nothing
+
+        :param sync_cb: optional progress.bar object for the plan actions
+
+        :param plan: (list) the result of a dry run, to be carried out
+            instead of a new plan
+
+        :returns: (list of dicts) the plan, see sync_plan
+        """
+        return self._sync(
+            local_dir, prefix, 'upload', delete, dry_run, sync_cb, plan)
+
+    def sync_download(
+            self, local_dir, prefix='', delete=False, dry_run=False,
+            sync_cb=None, plan=None):
+        """Make a local directory mirror the objects under a remote prefix.
+        Only new or changed objects are downloaded, and only the blocks of
+        them that differ from the local file. Downloaded files get the
+        last_modified date of their object.
+
+        :param local_dir: (str) the local directory
+
+        :param prefix: (str) the remote directory (e.g., some/dir)
+
+        :param delete: (bool) delete local files missing remotely
+
+        :param dry_run: (bool) only calculate the plan, transfer nothing
+
+        :param sync_cb: optional progress.bar object for the plan actions
+
+        :param plan: (list) the result of a dry run, to be carried out
+            instead of a new plan
+
+        :returns: (list of dicts) the plan, see sync_plan
+        """
+        return self._sync(
+            local_dir, prefix, 'download', delete, dry_run, sync_cb, plan)
+
     def get_object_hashmap(
             self, obj,
             version=None,
@@ -1051,6 +2186,30 @@ class PithosClient(PithosRestClient):
         r = self.account_get()
         return r.json
 
+    def iter_objects(self, page_size=10000, **kwargs):
+        """Iterate over the objects of the container, page by page, decoding
+        each listing while it arrives
+
+        :param page_size: (int) objects per request
+
+        :param kwargs: container_get arguments (e.g., prefix, delimiter,
+            path, marker, meta, show_only_shared, public, until)
+
+        :returns: (generator of dicts) the object listing
+        """
+        marker = kwargs.pop('marker', None)
+        while True:
+            r = self.container_get(
+                limit=page_size, marker=marker, format='json',
+                success=(200, 204), stream=True, **kwargs)
+            count = 0
+            for obj in r.iter_json():
+                count += 1
+                marker = obj.get('name', obj.get('subdir'))
+                yield obj
+            if count < page_size:
+                return
+
     def del_container(self, until=None, delimiter=None):
         """
         :param until: (str) formated date
@@ -1318,49 +2477,28 @@ class PithosClient(PithosRestClient):
         filesize = fstat(source_file.fileno()).st_size
         nblocks = 1 + (filesize - 1) // blocksize
         offset = 0
-        headers = {}
+        headers = []
         if upload_cb:
             self.progress_bar_gen = upload_cb(nblocks)
             self._cb_next()
-        flying = {}
-        self._init_thread_limit()
+        #  Appends land wherever the object ends when they reach the server,
+        #  so they are sent one at a time to keep the blocks in order
         try:
             for i in range(nblocks):
                 block = source_file.read(min(blocksize, filesize - offset))
                 offset += len(block)
-
-                self._watch_thread_limit(flying.values())
-                unfinished = {}
-                flying[i] = SilentEvent(
-                    method=self.object_post,
+                r = self.object_post(
                     obj=obj,
                     update=True,
                     content_range='bytes */*',
                     content_type='application/octet-stream',
                     content_length=len(block),
                     data=block)
-                flying[i].start()
-
-                for key, thread in flying.items():
-                    if thread.isAlive():
-                        if i < (nblocks - 1):
-                            unfinished[key] = thread
-                            continue
-                        thread.join()
-                    if thread.exception:
-                        raise thread.exception
-                    headers[key] = thread.value.headers
-                    self._cb_next()
-                flying = unfinished
-        except KeyboardInterrupt:
-            sendlog.info('- - - wait for threads to finish')
-            for thread in activethreads():
-                thread.join()
+                headers.append(r.headers)
+                self._cb_next()
         finally:
-            from time import sleep
-            sleep(2 * len(activethreads()))
             self._cb_next()
-        return headers.values()
+        return headers
 
     def truncate_object(self, obj, upto_bytes):
         """
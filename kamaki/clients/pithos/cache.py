@@ -0,0 +1,272 @@
+# Copyright 2014 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+
+import sqlite3
+from os import fstat, makedirs, walk, stat, remove, rename, utime, fdopen
+from os.path import dirname, isdir, join
+from stat import S_ISREG
+from threading import Lock
+from time import time
+from hashlib import new as newhashlib
+from binascii import hexlify, unhexlify
+from tempfile import mkstemp
+from errno import ENOENT
+try:
+    from collections import OrderedDict
+except ImportError:
+    from kamaki.clients.utils.ordereddict import OrderedDict
+
+from kamaki.clients import log
+
+
+class HashmapCache(object):
+    """Persistent cache of the block hashes of local files (SQLite)
+
+    Hashmaps are keyed by file identity (device, inode, size, modification
+    time in ns), block size and hash algorithm, so any change of the file
+    invalidates them. With partial set, the hashes of the leading full blocks
+    are reused when a file grows, assuming that only its tail changed (e.g.,
+    append-only files or images). Database errors are logged and treated as
+    cache misses.
+    """
+
+    MAX_ENTRIES = 10000
+    RACY_WINDOW = 2.0   # seconds, files modified more recently are not cached
+
+    def __init__(self, path, partial=False):
+        self.path, self.partial = path, partial
+        self._db, self._lock = None, Lock()
+
+    def _connect(self):
+        if self._db is None:
+            path_dir = dirname(self.path)
+            if path_dir and not isdir(path_dir):
+                makedirs(path_dir, 0700)
+            db = sqlite3.connect(
+                self.path, timeout=10, check_same_thread=False)
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS hashmaps ('
+                'dev INTEGER, inode INTEGER, '
+                'blocksize INTEGER, blockhash TEXT, '
+                'size INTEGER, mtime_ns INTEGER, hashes BLOB, used REAL, '
+                'PRIMARY KEY (dev, inode, blocksize, blockhash))')
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def key(fileobj, blocksize, blockhash):
+        """:returns: (tuple) the identity of a regular file and the hashing
+            settings, None if the file cannot be identified
+        """
+        try:
+            st = fstat(fileobj.fileno())
+        except (AttributeError, EnvironmentError, ValueError):
+            return None
+        if not S_ISREG(st.st_mode):
+            return None
+        return (
+            st.st_dev, st.st_ino, blocksize, blockhash,
+            st.st_size, int(st.st_mtime * 1e9))
+
+    def lookup(self, fileobj, blocksize, blockhash):
+        """
+        :returns: (key, hashes) the key to store the hashmap of the file with
+            and the cached hashes of the file (or of its leading full blocks,
+            if partial), empty if unknown. The key is None for files that
+            cannot be cached, e.g., pipes or files modified right now.
+        """
+        key = self.key(fileobj, blocksize, blockhash)
+        if key is None or key[5] / 1e9 > time() - self.RACY_WINDOW:
+            return None, []
+        try:
+            with self._lock:
+                db = self._connect()
+                row = db.execute(
+                    'SELECT size, mtime_ns, hashes FROM hashmaps WHERE '
+                    'dev=? AND inode=? AND blocksize=? AND blockhash=?',
+                    key[:4]).fetchone()
+                if row and tuple(row[:2]) == key[4:]:
+                    db.execute(
+                        'UPDATE hashmaps SET used=? WHERE '
+                        'dev=? AND inode=? AND blocksize=? AND blockhash=?',
+                        (time(), ) + key[:4])
+                    db.commit()
+        except sqlite3.Error as err:
+            log.warning('Hashmap cache %s: %s' % (self.path, err))
+            return key, []
+        if not row:
+            return key, []
+        size, mtime_ns, data = row
+        digest_size = newhashlib(blockhash).digest_size
+        hashes = [hexlify(data[i:i + digest_size]) for i in xrange(
+            0, len(data), digest_size)]
+        if (size, mtime_ns) == key[4:]:
+            return key, hashes
+        if self.partial and size < key[4]:
+            return key, hashes[:size // blocksize]
+        return key, []
+
+    def store(self, fileobj, key, hashes):
+        """Cache the hashmap of a file, unless the file changed since the key
+        was taken
+        """
+        if not key or key != self.key(fileobj, *key[2:4]):
+            return
+        data = sqlite3.Binary(''.join([unhexlify(h) for h in hashes]))
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute(
+                    'INSERT OR REPLACE INTO hashmaps VALUES (?,?,?,?,?,?,?,?)',
+                    key + (data, time()))
+                db.execute(
+                    'DELETE FROM hashmaps WHERE rowid IN (SELECT rowid FROM '
+                    'hashmaps ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                    (self.MAX_ENTRIES, ))
+                db.commit()
+        except sqlite3.Error as err:
+            log.warning('Hashmap cache %s: %s' % (self.path, err))
+
+
+class BlockCache(object):
+    """Local content-addressed store of downloaded blocks
+
+    Each block is a file named after its hash (<path>/<hash algorithm>/<first
+    two hash digits>/<hash>). Blocks are written to a temporary file which is
+    then renamed, and they are checked against their hash when read, so a
+    crash never leaves a bad block in use. The files are the only bookkeeping:
+    they are indexed once, least recently used first (modification time, set
+    on each hit), and evicted in that order when the cache grows past
+    max_bytes. I/O errors are logged and treated as cache misses.
+    """
+
+    MAX_BYTES = 1024 ** 3
+    STALE_TEMP = 3600   # seconds, then unfinished writes are removed
+
+    def __init__(self, path, max_bytes=None):
+        self.path, self.max_bytes = path, max_bytes or self.MAX_BYTES
+        self._lock, self._index, self.size = Lock(), None, 0
+
+    def _block_path(self, hash, blockhash):
+        return join(self.path, blockhash, hash[:2], hash)
+
+    def _load(self):
+        """:returns: (OrderedDict) {block path: size}, least recently used
+            blocks first
+        """
+        if self._index is None:
+            blocks = []
+            for top, subdirs, files in walk(self.path):
+                for name in files:
+                    bpath = join(top, name)
+                    try:
+                        st = stat(bpath)
+                        if not name.startswith('.'):
+                            blocks.append((st.st_mtime, bpath, st.st_size))
+                        elif st.st_mtime < time() - self.STALE_TEMP:
+                            remove(bpath)
+                    except OSError:
+                        continue
+            blocks.sort()
+            self._index = OrderedDict([(b, size) for t, b, size in blocks])
+            self.size = sum(self._index.values())
+        return self._index
+
+    def _forget(self, bpath):
+        with self._lock:
+            self.size -= self._load().pop(bpath, 0)
+
+    def get(self, hash, blockhash):
+        """:returns: (str) the block data, None if it is not cached"""
+        bpath = self._block_path(hash, blockhash)
+        try:
+            with open(bpath, 'rb') as f:
+                data = f.read()
+            if newhashlib(blockhash, data.rstrip('\x00')).hexdigest() != hash:
+                log.warning('Block cache: removing corrupted %s' % bpath)
+                remove(bpath)
+                self._forget(bpath)
+                return None
+            utime(bpath, None)
+        except EnvironmentError as err:
+            if err.errno != ENOENT:
+                log.warning('Block cache %s: %s' % (self.path, err))
+            self._forget(bpath)
+            return None
+        with self._lock:
+            index = self._load()
+            self.size += len(data) - index.pop(bpath, 0)
+            index[bpath] = len(data)
+        return data
+
+    def put(self, hash, blockhash, data):
+        """Store a block, evict the least recently used ones if needed
+
+        :returns: (bool) True if the block is stored
+        """
+        if len(data) > self.max_bytes:
+            return False
+        bpath = self._block_path(hash, blockhash)
+        with self._lock:
+            if bpath in self._load():
+                return True
+        tmp = None
+        try:
+            bdir = dirname(bpath)
+            if not isdir(bdir):
+                makedirs(bdir, 0700)
+            fd, tmp = mkstemp(dir=bdir, prefix='.')
+            with fdopen(fd, 'wb') as f:
+                f.write(data)
+            rename(tmp, bpath)
+        except EnvironmentError as err:
+            log.warning('Block cache %s: %s' % (self.path, err))
+            if tmp:
+                try:
+                    remove(tmp)
+                except OSError:
+                    pass
+            return False
+        with self._lock:
+            index = self._load()
+            self.size += len(data) - index.pop(bpath, 0)
+            index[bpath] = len(data)
+            while self.size > self.max_bytes:
+                old, size = index.popitem(last=False)
+                self.size -= size
+                try:
+                    remove(old)
+                except OSError:
+                    pass
+        return True
@@ -37,6 +37,34 @@ from kamaki.clients.utils import path4url
 
 class PithosRestClient(StorageClient):
     service_type = 'object-store'
+    PATH_TEMPLATES = (
+        '/', '/{account}', '/{account}/{container}',
+        '/{account}/{container}/{object}')
+    LEVELS = ('service', 'account', 'container', 'object')
+
+    def _classify_request(self, method, path, params, headers):
+        """Tell block uploads and downloads, hashmaps and listings apart
+
+        :returns: (path template, operation type)
+        """
+        level = min(len([s for s in path.split('/') if s]), 3)
+        method = method.upper()
+        content_type, ranged = None, False
+        for k, v in headers.items():
+            content_type = v if k.lower() == 'content-type' else content_type
+            ranged = ranged or k.lower() == 'range'
+        if method == 'POST' and level == 2 and 'update' in params and (
+                content_type == 'application/octet-stream'):
+            operation = 'block PUT'
+        elif method == 'GET' and level == 3 and 'hashmap' in params:
+            operation = 'hashmap GET'
+        elif method == 'GET' and level == 3 and ranged:
+            operation = 'block GET'
+        elif method == 'GET' and level < 3:
+            operation = 'listing'
+        else:
+            operation = '%s %s' % (method, self.LEVELS[level])
+        return self.PATH_TEMPLATES[level], operation
 
     def account_head(
             self,
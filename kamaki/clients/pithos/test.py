@@ -32,11 +32,12 @@
 # or implied, of GRNET S.A.
 
 from unittest import TestCase
-from mock import patch, call
+from mock import patch, call, Mock
 from tempfile import NamedTemporaryFile
 from os import urandom
 from itertools import product
 from random import randint
+from time import time
 
 try:
     from collections import OrderedDict
@@ -153,6 +154,9 @@ class FR(object):
     status = None
     status_code = 200
 
+    def iter_content(self, chunk_size=None):
+        yield self.content
+
 
 class PithosRestClient(TestCase):
 
@@ -168,6 +172,25 @@ class PithosRestClient(TestCase):
         FR.json = dict()
         FR.content = FR.json
 
+    def test_classify_request(self):
+        block = {'Content-Type': 'application/octet-stream'}
+        for args, expected in (
+                (('post', '/acc/cnt', dict(update='', format='json'), block),
+                    ('/{account}/{container}', 'block PUT')),
+                (('post', '/acc/cnt', dict(update=''), {}),
+                    ('/{account}/{container}', 'POST container')),
+                (('GET', '/acc/cnt/dir/obj', dict(hashmap='True'), {}),
+                    ('/{account}/{container}/{object}', 'hashmap GET')),
+                (('GET', '/acc/cnt/obj', {}, {'Range': 'bytes=0-3'}),
+                    ('/{account}/{container}/{object}', 'block GET')),
+                (('GET', '/acc/cnt/obj', {}, {}),
+                    ('/{account}/{container}/{object}', 'GET object')),
+                (('GET', '/acc/cnt', dict(format='json'), {}),
+                    ('/{account}/{container}', 'listing')),
+                (('GET', '', dict(format='json'), {}), ('/', 'listing')),
+                (('HEAD', '/acc', {}, {}), ('/{account}', 'HEAD account'))):
+            self.assertEqual(self.client._classify_request(*args), expected)
+
     @patch('%s.set_param' % rest_pkg)
     @patch('%s.set_header' % rest_pkg)
     @patch('%s.head' % rest_pkg, return_value=FR())
@@ -747,22 +770,393 @@ class PithosRestClient(TestCase):
 
 class PithosMethods(TestCase):
 
-    def test__range_up(self):
-        from kamaki.clients.pithos import _range_up
+    def test__RangeSet(self):
+        from kamaki.clients.pithos import _RangeSet
         for args, expected in (
-                ((0, 100, 1000, '10'), '0-10'),
-                ((0, 100, 1000, '-10'), ''),
-                ((900, 1000, 1000, '-10'), '990-1000'),
-                ((150, 250, 1000, '10'), ''),
-                ((10, 200, 1000, '130-170'), '130-170'),
-                ((150, 200, 1000, '130-170'), '150-170'),
-                ((100, 150, 1000, '130-170'), '130-150'),
-                ((200, 250, 1000, '130-170'), ''),
-                ((100, 250, 1000, '30-170,200-270'), '100-170,200-250'),
-                ((40, 950, 1000, '-170,200-270,50',), '830-950,200-270,40-50'),
-                ((740, 900, 1000, '-170,200-270,50',), '830-900'),
-                ((42, 333, 800, '100,50-200,-600',), '42-100,50-200,200-333')):
-            self.assertEqual(_range_up(*args), expected)
+                (('10', 1000, 0, 100), '0-10'),
+                (('-10', 1000, 0, 100), ''),
+                (('-10', 1000, 900, 999), '990-999'),
+                (('10', 1000, 150, 250), ''),
+                (('130-170', 1000, 10, 200), '130-170'),
+                (('130-170', 1000, 150, 200), '150-170'),
+                (('130-170', 1000, 100, 150), '130-150'),
+                (('130-170', 1000, 200, 250), ''),
+                (('30-170,200-270', 1000, 100, 250), '100-170,200-250'),
+                (('-170,200-270,50', 1000, 40, 950), '40-50,200-270,830-950'),
+                (('-170,200-270,50', 1000, 740, 900), '830-900'),
+                (('100,50-200,-600', 800, 42, 333), '42-333'),
+                (('-2000,5', 1000, 0, 999), '0-999'),
+                (('990-2000', 1000, 900, 999), '990-999'),
+                ((None, 1000, 5, 10), '5-10'),
+                (('', 0, 0, 0), '')):
+            a_range, size, start, end = args
+            self.assertEqual(
+                _RangeSet(a_range, size).range_str(start, end), expected)
+        ranges = _RangeSet('0-9,10-19,30-39,35-50,-10', 100)
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual(ranges.intersect(15, 95), [(15, 19), (30, 50), (
+            90, 95)])
+        self.assertEqual(ranges.intersect(20, 29), [])
+
+    def test__pithos_hash(self):
+        from kamaki.clients.pithos import _pithos_hash
+        from hashlib import sha256
+        for block in (
+                '', '\x00' * 10, 'data', 'data\x00\x00', '\x00data',
+                'data' + '\x00' * 4096, 'data' + '\x00' * 10000,
+                urandom(5000) + '\x00' * 8193, '\x00' * 8192):
+            self.assertEqual(
+                _pithos_hash(block, 'sha256'),
+                sha256(block.rstrip('\x00')).hexdigest())
+            self.assertEqual(
+                _pithos_hash(buffer(block), 'sha256'),
+                _pithos_hash(block, 'sha256'))
+
+    def test__BlockSource(self):
+        from kamaki.clients.pithos import _BlockSource
+        from StringIO import StringIO
+        from os import pipe, fdopen
+        data = urandom(1000)
+        tmpFile = NamedTemporaryFile()
+        tmpFile.write(data)
+        tmpFile.flush()
+        rfd, wfd = pipe()
+        with fdopen(wfd, 'w') as w:
+            w.write(data)
+        with fdopen(rfd) as pipe_file:
+            for fileobj in (tmpFile, StringIO(data), pipe_file):
+                source = _BlockSource(fileobj)
+                blocks = list(source.blocks(300, 950, sparse=True))
+                self.assertEqual([len(b) for b in blocks], [300, 300, 300, 50])
+                self.assertEqual(
+                    ''.join([b.tobytes() for b in blocks]), data[:950])
+        source = _BlockSource(tmpFile)
+        self.assertEqual(len(list(source.blocks(300, 2000))), 4)
+        self.assertEqual(len(list(source.blocks(300, 2000, sparse=True))), 4)
+        self.assertEqual(source.block(100, 10), data[100:110])
+        self.assertEqual(_BlockSource(StringIO(data)).block(990, 100), (
+            data[990:]))
+        with NamedTemporaryFile() as empty:
+            source = _BlockSource(empty)
+            self.assertEqual(list(source.blocks(300, 0)), [])
+
+        #  Blocks are read into reused buffers, without copies
+        blocks = _BlockSource(tmpFile).blocks(300, 950, buffers=2)
+        first = next(blocks)
+        self.assertTrue(isinstance(first, memoryview))
+        self.assertEqual(first.tobytes(), data[:300])
+        self.assertEqual(next(blocks).tobytes(), data[300:600])
+        self.assertEqual(next(blocks).tobytes(), data[600:900])
+        self.assertEqual(first.tobytes(), data[600:900])
+        self.assertEqual(next(blocks).tobytes(), data[900:950])
+
+        #  Files truncated while they are read end early
+        tmpFile.truncate(500)
+        tmpFile.flush()
+        source = _BlockSource(tmpFile)
+        self.assertEqual(source.block(400, 300), data[400:500])
+        self.assertEqual(source.block(600, 300), '')
+        self.assertEqual(''.join([b.tobytes() for b in source.blocks(
+            300, 950, sparse=True)]), data[:500])
+
+    def test__data_extents(self):
+        from kamaki.clients.pithos import _data_extents, _BlockSource
+        bs = 64 * 1024
+        tmpFile = NamedTemporaryFile()
+        tmpFile.write('a' * 10)
+        tmpFile.seek(3 * bs)
+        tmpFile.write('b' * bs)
+        tmpFile.truncate(5 * bs)
+        tmpFile.flush()
+        tmpFile.seek(7)
+        extents = _data_extents(tmpFile, 0, 5 * bs)
+        self.assertEqual(tmpFile.tell(), 7)
+        with patch('kamaki.clients.pithos._SEEK_DATA', None):
+            self.assertEqual(_data_extents(tmpFile, 0, 5 * bs), None)
+        blocks = list(_BlockSource(tmpFile).blocks(bs, 5 * bs, sparse=True))
+        self.assertEqual(blocks[0].tobytes(), 'a' * 10 + '\x00' * (bs - 10))
+        self.assertEqual(blocks[3].tobytes(), 'b' * bs)
+        if extents is None or len(extents) < 2:
+            #  The file system does not report holes
+            return
+        self.assertEqual(extents[0][0], 0)
+        self.assertEqual(extents[-1][1], 4 * bs)
+        self.assertEqual(blocks[1:3] + blocks[4:], ['', '', ''])
+        self.assertEqual(_data_extents(tmpFile, 4 * bs, 5 * bs), [])
+
+    def test__plan_fetches(self):
+        from kamaki.clients.pithos import _plan_fetches
+        blocks = [(0, 8, 'a'), (8, 8, 'b'), (24, 8, 'c'), (32, 4, 'd')]
+        self.assertEqual(_plan_fetches(blocks, 16), [
+            [blocks[:2]], [blocks[2:]]])
+        self.assertEqual(_plan_fetches(blocks, 8), [
+            [blocks[:1]], [blocks[1:2]], [blocks[2:3]], [blocks[3:]]])
+        self.assertEqual(_plan_fetches(blocks, 64, 2), [
+            [blocks[:2], blocks[2:]]])
+        self.assertEqual(_plan_fetches(blocks[:1] + blocks[2:3], 64), [
+            [blocks[:1]], [blocks[2:3]]])
+        self.assertEqual(_plan_fetches([], 64), [])
+
+    def test__byteranges(self):
+        from kamaki.clients.pithos import _byteranges
+        r = FR()
+        r.headers = {'content-range': 'bytes 10-13/100'}
+        r.content = 'abcd'
+        self.assertEqual(list(_byteranges(r, 5)), [(10, 'abcd')])
+        r.headers = dict()
+        self.assertEqual(list(_byteranges(r, 5)), [(5, 'abcd')])
+        r.headers = {
+            'content-type': 'multipart/byteranges; boundary=THIS_STRING'}
+        r.content = '\r\n'.join([
+            '--THIS_STRING', 'Content-Type: text/plain',
+            'Content-Range: bytes 0-3/100', '', 'ab\r\n',
+            '--THIS_STRING', 'Content-range: bytes 20-22/100', '', 'xyz',
+            '--THIS_STRING--', ''])
+        self.assertEqual(
+            list(_byteranges(r)), [(0, 'ab\r\n'), (20, 'xyz')])
+
+    def test__hash_blocks(self):
+        from kamaki.clients.pithos import _pithos_hash, _hash_blocks
+        from kamaki.clients.pithos import _BlockSource
+        from kamaki.clients import WorkerPool
+        from StringIO import StringIO
+        data = urandom(1000)
+        blocks = list(_BlockSource(StringIO(data)).blocks(64, 900))
+        self.assertEqual(''.join([b.tobytes() for b in blocks]), data[:900])
+        self.assertEqual(len(blocks[-1]), 900 % 64)
+        self.assertEqual(list(_BlockSource(StringIO(data)).blocks(
+            64, 2000))[-1].tobytes(), data[960:])
+        pool = WorkerPool(3)
+        self.assertEqual(
+            list(_hash_blocks(blocks, 'sha256', pool)),
+            [_pithos_hash(block, 'sha256') for block in blocks])
+        hashes = _hash_blocks(iter(blocks), 'sha256', pool)
+        hashes.next()
+        hashes.close()
+        self.assertEqual(list(_hash_blocks([], 'sha256', pool)), [])
+        pool.shutdown()
+
+    def test__BlockRegistry(self):
+        from kamaki.clients.pithos import _BlockRegistry
+        from kamaki.clients import Future
+        registry, futures = _BlockRegistry(), []
+
+        def submit(hash):
+            futures.append(Future(str, hash))
+            return futures[-1]
+
+        f1, submitted = registry.claim('h1', submit)
+        self.assertTrue(submitted)
+        self.assertEqual(registry.claim('h1', submit), (f1, False))
+        f1._run()
+        self.assertEqual(registry.claim('h1', submit), (f1, False))
+        f2, submitted = registry.claim('h2', submit)
+        f2.cancel()
+        f3, submitted = registry.claim('h2', submit)
+        self.assertTrue(submitted)
+        f3.method = Mock(side_effect=ClientError('failed'))
+        f3._run()
+        self.assertEqual(registry.claim('h2', submit), (futures[-1], True))
+        self.assertEqual(len(futures), 4)
+        self.assertEqual(len(registry), 2)
+
+    def test__copy_range(self):
+        from kamaki.clients.pithos import _copy_range
+        src, dst = NamedTemporaryFile(), NamedTemporaryFile()
+        src.write('0123456789')
+        src.flush()
+        dst.write('x' * 10)
+        dst.flush()
+        _copy_range(src, 2, dst, 4, 3)
+        _copy_range(src, 8, dst, 0, 3)
+        dst.flush()
+        dst.seek(0)
+        self.assertEqual(dst.read(), '89\x00x234xxx')
+        with patch('kamaki.clients.pithos._libc_copy_file_range', None):
+            _copy_range(src, 0, dst, 7, 4)
+        dst.flush()
+        dst.seek(0)
+        self.assertEqual(dst.read(), '89\x00x2340123')
+
+    def test__seekable(self):
+        from kamaki.clients.pithos import _seekable
+        from os import pipe, fdopen, close
+        self.assertTrue(_seekable(NamedTemporaryFile()))
+        r, w = pipe()
+        self.addCleanup(close, r)
+        with fdopen(w, 'wb') as pipe_out:
+            self.assertFalse(_seekable(pipe_out))
+        tty = Mock()
+        tty.isatty.return_value = True
+        self.assertFalse(_seekable(tty))
+        self.assertFalse(_seekable(object()))
+
+    def test_BlockIndex(self):
+        index = pithos.BlockIndex()
+        index.add('h1', 'f1', 0, 8)
+        index.add('h1', 'f2', 8, 8)
+        self.assertEqual(index.find('h1'), ('f1', 0, 8))
+        self.assertEqual(index.find('h2'), None)
+        self.assertEqual(len(index), 1)
+
+    def test__top_hash(self):
+        from kamaki.clients.pithos import _top_hash
+        from hashlib import sha256
+        from binascii import hexlify, unhexlify
+        hashes = [sha256(c).hexdigest() for c in 'abc']
+        self.assertEqual(_top_hash([], 'sha256'), sha256('').hexdigest())
+        self.assertEqual(_top_hash(hashes[:1], 'sha256'), hashes[0])
+        a, b, c = [unhexlify(h) for h in hashes]
+        self.assertEqual(_top_hash(hashes[:2], 'sha256'), sha256(
+            a + b).hexdigest())
+        self.assertEqual(_top_hash(hashes, 'sha256'), hexlify(sha256(
+            sha256(a + b).digest() + sha256(c + '\x00' * 32).digest(
+                )).digest()))
+
+    def test__utc_timestamp(self):
+        from kamaki.clients.pithos import _utc_timestamp
+        self.assertEqual(
+            _utc_timestamp('2013-02-07T11:51:55.702751+00:00'), 1360237915)
+
+
+class HashmapCache(TestCase):
+
+    def setUp(self):
+        from kamaki.clients.pithos.cache import HashmapCache
+        from tempfile import mkdtemp
+        self.dir = mkdtemp()
+        self.path = '%s/kamaki/hashmaps.db' % self.dir
+        self.cache = HashmapCache(self.path)
+        self.files = []
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.dir)
+
+    def _file(self, data, age=100):
+        from os import utime
+        f = NamedTemporaryFile()
+        f.write(data)
+        f.flush()
+        utime(f.name, (time() - age, time() - age))
+        self.files.append(f)
+        return f
+
+    def test_lookup_and_store(self):
+        f = self._file('a' * 20)
+        key, hashes = self.cache.lookup(f, 8, 'sha256')
+        self.assertEqual(hashes, [])
+        self.assertEqual(key[2:5], (8, 'sha256', 20))
+        hashes = [pithos._pithos_hash(
+            'a' * size, 'sha256') for size in (8, 8, 4)]
+        self.cache.store(f, key, hashes)
+        self.assertEqual(self.cache.lookup(f, 8, 'sha256'), (key, hashes))
+        self.assertEqual(self.cache.lookup(f, 8, 'sha1')[1], [])
+        self.assertEqual(self.cache.lookup(f, 4, 'sha256')[1], [])
+
+        #  Changed files are not found, unless only their tail changed
+        f.write('b' * 10)
+        f.flush()
+        self.assertEqual(self.cache.lookup(f, 8, 'sha256'), (None, []))
+        self.cache.store(f, key, hashes)
+        from os import utime
+        utime(f.name, (time() - 50, time() - 50))
+        self.assertEqual(self.cache.lookup(f, 8, 'sha256')[1], [])
+        self.cache.partial = True
+        self.assertEqual(self.cache.lookup(f, 8, 'sha256')[1], hashes[:2])
+
+        #  A stale key is not stored
+        key = self.cache.lookup(f, 8, 'sha256')[0]
+        f.write('c')
+        f.flush()
+        utime(f.name, (time() - 50, time() - 50))
+        self.cache.store(f, key, ['00' * 32])
+        self.assertEqual(self.cache.lookup(f, 8, 'sha256')[1], hashes[:2])
+
+    def test_limits_and_errors(self):
+        self.cache.MAX_ENTRIES = 2
+        files = [self._file('%s' % i) for i in range(3)]
+        for f in files:
+            key, hashes = self.cache.lookup(f, 8, 'sha256')
+            self.cache.store(f, key, ['ab' * 32])
+        self.assertEqual(self.cache.lookup(files[0], 8, 'sha256')[1], [])
+        self.assertEqual(
+            self.cache.lookup(files[2], 8, 'sha256')[1], ['ab' * 32])
+        from StringIO import StringIO
+        self.assertEqual(
+            self.cache.lookup(StringIO('data'), 8, 'sha256'), (None, []))
+
+        from kamaki.clients.pithos.cache import HashmapCache
+        broken = HashmapCache(self.dir)
+        key, hashes = broken.lookup(files[0], 8, 'sha256')
+        self.assertEqual(hashes, [])
+        broken.store(files[0], key, ['ab' * 32])
+
+
+class BlockCache(TestCase):
+
+    def setUp(self):
+        from kamaki.clients.pithos.cache import BlockCache
+        from tempfile import mkdtemp
+        self.dir = mkdtemp()
+        self.path = '%s/blocks' % self.dir
+        self.cache = BlockCache(self.path, max_bytes=20)
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.dir)
+
+    def _hash(self, data):
+        return pithos._pithos_hash(data, 'sha256')
+
+    def test_get_and_put(self):
+        from os import path, listdir
+        data = 'abc\x00\x00'
+        self.assertEqual(self.cache.get(self._hash(data), 'sha256'), None)
+        self.assertTrue(self.cache.put(self._hash(data), 'sha256', data))
+        self.assertEqual(self.cache.get(self._hash(data), 'sha256'), data)
+        self.assertEqual(self.cache.get(self._hash(data), 'sha1'), None)
+        bpath = path.join(
+            self.path, 'sha256', self._hash(data)[:2], self._hash(data))
+        self.assertTrue(path.isfile(bpath))
+        self.assertEqual(listdir(path.dirname(bpath)), [self._hash(data)])
+        self.assertTrue(self.cache.put(self._hash(data), 'sha256', data))
+        self.assertEqual(self.cache.size, 5)
+
+        #  Corrupted blocks are removed
+        with open(bpath, 'wb') as f:
+            f.write('abd')
+        self.assertEqual(self.cache.get(self._hash(data), 'sha256'), None)
+        self.assertFalse(path.exists(bpath))
+        self.assertEqual(self.cache.size, 0)
+        self.assertFalse(self.cache.put('h', 'sha256', 'x' * 21))
+
+    def test_eviction(self):
+        from os import utime
+        from kamaki.clients.pithos.cache import BlockCache
+        blocks = ['%s' % i * 8 for i in range(3)]
+        for block in blocks[:2]:
+            self.cache.put(self._hash(block), 'sha256', block)
+        self.cache.get(self._hash(blocks[0]), 'sha256')
+        self.cache.put(self._hash(blocks[2]), 'sha256', blocks[2])
+        self.assertEqual(self.cache.size, 16)
+        self.assertEqual(self.cache.get(self._hash(blocks[1]), 'sha256'), None)
+        self.assertEqual(
+            self.cache.get(self._hash(blocks[0]), 'sha256'), blocks[0])
+
+        #  A new instance finds the blocks, least recently used first
+        bpath = self.cache._block_path(self._hash(blocks[2]), 'sha256')
+        utime(bpath, (time() - 100, time() - 100))
+        with open('%s/.tmp' % self.path, 'w') as f:
+            f.write('x' * 100)
+        utime('%s/.tmp' % self.path, (time() - 7200, time() - 7200))
+        cache = BlockCache(self.path, max_bytes=20)
+        self.assertTrue(cache.put(self._hash('x' * 8), 'sha256', 'x' * 8))
+        self.assertEqual(cache.size, 16)
+        self.assertEqual(cache.get(self._hash(blocks[2]), 'sha256'), None)
+        self.assertEqual(cache.get(self._hash(blocks[0]), 'sha256'), blocks[0])
+        from os import path
+        self.assertFalse(path.exists('%s/.tmp' % self.path))
 
 
 class PithosClient(TestCase):
@@ -841,6 +1235,18 @@ class PithosClient(TestCase):
         for i in range(len(r)):
             self.assert_dicts_are_equal(r[i], container_list[i])
 
+    @patch('%s.container_get' % pithos_pkg)
+    def test_iter_objects(self, get):
+        pages = [object_list[:2], object_list[2:4], object_list[4:]]
+        get.side_effect = [
+            Mock(iter_json=lambda page=page: iter(page)) for page in pages]
+        r = list(self.client.iter_objects(page_size=2, prefix='p'))
+        self.assertEqual(r, object_list)
+        markers = [None] + [o['name'] for o in object_list[1::2]]
+        self.assertEqual(get.mock_calls, [call(
+            limit=2, marker=m, format='json', success=(200, 204),
+            stream=True, prefix='p') for m in markers[:len(pages)]])
+
     @patch('%s.get_container_info' % pithos_pkg, return_value=container_info)
     @patch('%s.container_post' % pithos_pkg, return_value=FR())
     @patch('%s.object_put' % pithos_pkg, return_value=FR())
@@ -965,6 +1371,112 @@ class PithosClient(TestCase):
         self.assertEqual(OP.mock_calls[-1][2]['if_etag_not_match'], '*')
         self.assertEqual(OP.mock_calls[-1][2]['etag'], etag)
 
+    @patch('%s.get_container_info' % pithos_pkg, return_value=container_info)
+    @patch('%s.container_post' % pithos_pkg, return_value=FR())
+    @patch('%s.object_put' % pithos_pkg, return_value=FR())
+    def test_upload_object_small(self, OP, CP, GCI):
+        from kamaki.clients.pithos import _pithos_hash
+        FR.headers = dict(etag='3746')
+        tmpFile = NamedTemporaryFile()
+        tmpFile.write('x' * 1000)
+        tmpFile.flush()
+        steps = dict()
+
+        def progress(name):
+            def progress_gen(n):
+                steps[name] = [n, 0]
+                for i in range(n + 1):
+                    steps[name][1] += 1
+                    yield
+            return progress_gen
+
+        r = self.client.upload_object(
+            obj, tmpFile, content_type='t', etag='e',
+            hash_cb=progress('hash'), upload_cb=progress('upload'))
+        self.assertEqual(r, FR.headers)
+        self.assertEqual(steps, dict(hash=[1, 2], upload=[1, 2]))
+        self.assertEqual(len(OP.mock_calls), 1)
+        args, kwargs = OP.mock_calls[0][1:3]
+        self.assertEqual(args, (obj, ))
+        self.assertEqual(kwargs.pop('data').tobytes(), 'x' * 1000)
+        self.assertEqual(kwargs, dict(
+            etag='e', if_etag_match=None, if_etag_not_match=None,
+            content_encoding=None, content_disposition=None,
+            content_type='t', permissions=None, public=None, success=201))
+
+        #  A single block: create from the hashmap, or send it as data
+        tmpFile.write('y' * self.client.SMALL_OBJECT_SIZE)
+        tmpFile.flush()
+        size = 1000 + self.client.SMALL_OBJECT_SIZE
+        OP.reset_mock()
+        FR.status_code = 201
+        self.client.upload_object(obj, tmpFile, upload_cb=progress('upload'))
+        self.assertEqual(len(OP.mock_calls), 1)
+        self.assertEqual(steps['upload'], [1, 2])
+        self.assertEqual(OP.mock_calls[0][2]['json'], dict(bytes=size, hashes=[
+            _pithos_hash('x' * 1000 + 'y' * (size - 1000), 'sha256')]))
+
+        OP.reset_mock()
+        FR.status_code = 409
+        FR.json = ['s0m3h@5h']
+        steps.clear()
+        self.client.upload_object(
+            obj, tmpFile, if_not_exist=True, upload_cb=progress('upload'))
+        self.assertEqual(len(OP.mock_calls), 2)
+        self.assertEqual(steps['upload'], [1, 2])
+        self.assertTrue(OP.mock_calls[0][2]['hashmap'])
+        self.assertEqual(len(OP.mock_calls[1][2]['data']), size)
+        self.assertEqual(OP.mock_calls[1][2]['if_etag_not_match'], '*')
+        self.assertEqual(CP.mock_calls, [])
+
+    @patch('%s.get_container_info' % pithos_pkg, return_value=container_info)
+    @patch('%s.upload_object' % pithos_pkg)
+    def test_upload_objects(self, UO, GCI):
+        from threading import Lock
+        from time import sleep
+        state, lock = dict(files=0, bytes=0, max_files=0, max_bytes=0), Lock()
+
+        def upload(obj, f, size=None, container_info_cache=None, **kwargs):
+            self.assertEqual(container_info_cache, {
+                self.client.container: container_info})
+            with lock:
+                state['files'] += 1
+                state['bytes'] += size
+                state['max_files'] = max(state['max_files'], state['files'])
+                state['max_bytes'] = max(state['max_bytes'], state['bytes'])
+            self.assertFalse(f.closed)
+            sleep(0.01)
+            with lock:
+                state['files'] -= 1
+                state['bytes'] -= size
+            return dict(obj=obj, content_type=kwargs.get('content_type'))
+
+        UO.side_effect = upload
+        tmpFile = self._create_temp_file(0)
+        sources = [(tmpFile, 'o%s' % i, dict(size=10)) for i in range(20)]
+        sources.append((tmpFile.name, 'big', dict(size=100, content_type='t')))
+        upload_cb = Mock()
+        r = self.client.upload_objects(
+            sources, max_files=4, max_bytes=30, upload_cb=upload_cb)
+        self.assertEqual(len(r), 21)
+        self.assertEqual(r['big'], dict(obj='big', content_type='t'))
+        self.assertEqual(GCI.mock_calls, [call()])
+        self.assertEqual(state['max_files'], 3)
+        self.assertEqual(state['max_bytes'], 100)
+        upload_cb.assert_called_once_with(21)
+        self.assertEqual(len(upload_cb.return_value.next.mock_calls), 22)
+        registries = set(c[2]['block_registry'] for c in UO.mock_calls)
+        self.assertEqual(len(registries), 1)
+
+        state.update(max_files=0, max_bytes=0)
+        r = self.client.upload_objects(sources[:10], max_files=4)
+        self.assertEqual(len(r), 10)
+        self.assertEqual(state['max_files'], 4)
+
+        UO.side_effect = ClientError('upload failed', 500)
+        self.assertRaises(
+            ClientError, self.client.upload_objects, sources, max_files=2)
+
     @patch('%s.get_container_info' % pithos_pkg, return_value=container_info)
     @patch('%s.container_post' % pithos_pkg, return_value=FR())
     @patch('%s.object_put' % pithos_pkg, return_value=FR())
@@ -1311,6 +1823,264 @@ class PithosClient(TestCase):
                 GET.mock_calls[-1][2][k],
                 v or kwargs.get(k))
 
+    @patch('%s.get_object_hashmap' % pithos_pkg, return_value=dict(
+        block_hash='sha256', block_size=8, bytes=20, hashes=[
+            pithos._pithos_hash(d, 'sha256') for d in ('a' * 8, 'b', 'c')]))
+    @patch('%s.object_get' % pithos_pkg, return_value=FR())
+    def test_download_with_block_cache(self, GET, GOH):
+        hashes = GOH.return_value['hashes']
+        cache = self.client.block_cache = Mock()
+        cache.get.side_effect = lambda hash, blockhash: dict([
+            (hashes[0], 'a' * 8), (hashes[1], 'b')]).get(hash)
+        FR.content = 'c' * 4
+        self.assertEqual(
+            self.client.download_to_string(obj), 'a' * 8 + 'b' + '\x00' * 7 + (
+                'c' * 4))
+        self.assertEqual(len(GET.mock_calls), 1)
+        self.assertEqual(GET.mock_calls[0][2]['data_range'], 'bytes=16-19')
+        cache.put.assert_called_once_with(hashes[2], 'sha256', 'c' * 4)
+
+        #  Ranges are not cached
+        GET.reset_mock()
+        self.client.download_to_string(obj, range_str='0-3')
+        self.assertEqual(len(cache.get.mock_calls), 3)
+        self.assertEqual(len(cache.put.mock_calls), 1)
+
+        #  Sync and async dumps
+        tmpFile = NamedTemporaryFile()
+        GET.reset_mock()
+        self.client.download_object(obj, tmpFile)
+        tmpFile.seek(0)
+        self.assertEqual(tmpFile.read(), 'a' * 8 + 'b' + '\x00' * 7 + 'c' * 4)
+        self.assertEqual(len(GET.mock_calls), 1)
+        self.assertEqual(cache.put.mock_calls[-1], call(
+            hashes[2], 'sha256', 'c' * 4))
+        from StringIO import StringIO
+        dst = StringIO()
+        dst.isatty = lambda: True
+        self.client.download_object(obj, dst)
+        self.assertEqual(dst.getvalue(), 'a' * 8 + 'b' + '\x00' * 7 + 'c' * 4)
+        self.assertEqual(len(GET.mock_calls), 2)
+        self.assertEqual(len(cache.put.mock_calls), 3)
+
+    @patch('%s.get_object_hashmap' % pithos_pkg)
+    @patch('%s.object_get' % pithos_pkg, return_value=FR())
+    def test_download_with_block_index(self, GET, GOH):
+        GOH.side_effect = [
+            dict(block_hash='sha256', block_size=8, bytes=16, hashes=[
+                'hA', 'hB']),
+            dict(block_hash='sha256', block_size=8, bytes=12, hashes=[
+                'hB', 'hC'])]
+        index = pithos.BlockIndex()
+        file1, file2 = NamedTemporaryFile(), NamedTemporaryFile()
+        self.client.DOWNLOAD_REQUEST_BYTES = 8
+        FR.content = 'x' * 8
+        self.client.download_object(obj, file1, block_index=index)
+        self.assertEqual(len(GET.mock_calls), 2)
+        self.assertEqual(index.find('hB'), (file1.name, 8, 8))
+        file1.seek(8)
+        file1.write('z' * 8)
+        file1.flush()
+
+        GET.reset_mock()
+        FR.content = 'y' * 4
+        self.client.download_object(obj, file2, block_index=index)
+        self.assertEqual(len(GET.mock_calls), 1)
+        self.assertEqual(
+            GET.mock_calls[0][2]['async_headers'], {'Range': 'bytes=8-11'})
+        file2.seek(0)
+        self.assertEqual(file2.read(), 'z' * 8 + 'y' * 4)
+        self.assertEqual(index.find('hC'), (file2.name, 8, 4))
+
+    @patch('%s._cache_block' % pithos_pkg)
+    @patch('%s.object_get' % pithos_pkg, return_value=FR())
+    def test_stream_block(self, GET, CB):
+        from threading import Lock
+        FR.content = 'a' * 8
+        tmpFile = NamedTemporaryFile()
+        self.assertEqual(self.client._stream_block(
+            obj, tmpFile, [0, 8], Lock(), cache_as=('hA', 'sha256')), 8)
+        tmpFile.seek(0)
+        self.assertEqual(tmpFile.read(), 'a' * 16)
+        #  Blocks are collected only for a block_cache
+        self.assertEqual(CB.mock_calls, [])
+        self.client.block_cache = Mock()
+        self.client._stream_block(
+            obj, tmpFile, [0], Lock(), cache_as=('hA', 'sha256'))
+        CB.assert_called_once_with('hA', 'sha256', 'a' * 8)
+
+    @patch('%s.get_object_hashmap' % pithos_pkg)
+    @patch('%s.object_get' % pithos_pkg, return_value=FR())
+    def test_download_ranges(self, GET, GOH):
+        GOH.return_value = dict(
+            block_hash='sha256', block_size=8, bytes=20, hashes=[
+                'hA', 'hB', 'hC'])
+        FR.content = 'x'
+        self.client.download_to_string(obj, range_str='-4')
+        self.assertEqual(
+            [c[2]['data_range'] for c in GET.mock_calls], ['bytes=16-19'])
+
+        GET.reset_mock()
+        dst = Mock()
+        dst.isatty.return_value = True
+        self.client.download_object(obj, dst, range_str='2,6-9,-1')
+        self.assertEqual(
+            [c[2]['data_range'] for c in GET.mock_calls],
+            ['bytes=0-2,6-7', 'bytes=8-9', 'bytes=19-19'])
+
+        GET.reset_mock()
+        self.client.download_object(
+            obj, NamedTemporaryFile(), range_str='10-12,14-15')
+        self.assertEqual(
+            [c[2]['async_headers'] for c in GET.mock_calls],
+            [{'Range': 'bytes=10-12,14-15'}])
+
+    @patch('%s.get_object_hashmap' % pithos_pkg)
+    @patch('%s.object_get' % pithos_pkg)
+    def test_download_coalesced(self, GET, GOH):
+        data = 'a' * 8 + 'b' * 8 + 'a' * 8 + 'c' * 8 + 'd' * 4
+        GOH.return_value = dict(
+            block_hash='sha256', block_size=8, bytes=36, hashes=[
+                'hA', 'hB', 'hA', 'hC', 'hD'])
+
+        def get(obj, async_headers=None, **kwargs):
+            r = FR()
+            ranges = async_headers['Range'][6:].split(',')
+            parts = [map(int, rng.split('-')) for rng in ranges]
+            r.content = ''.join([data[a:b + 1] for a, b in parts])
+            if len(parts) > 1:
+                r.headers = {
+                    'content-type': 'multipart/byteranges; boundary=xx'}
+                r.content = ''.join([
+                    '--xx\r\nContent-Range: bytes %s-%s/36\r\n\r\n%s\r\n' % (
+                        a, b, data[a:b + 1]) for a, b in parts]) + '--xx--'
+            return r
+
+        GET.side_effect = get
+        cache = self.client.block_cache = Mock()
+        cache.get.return_value = None
+        self.client.DOWNLOAD_REQUEST_BYTES = 16
+        tmpFile = NamedTemporaryFile()
+        self.client.download_object(obj, tmpFile)
+        tmpFile.seek(0)
+        self.assertEqual(tmpFile.read(), data)
+        self.assertEqual(
+            sorted([c[2]['async_headers']['Range'] for c in GET.mock_calls]),
+            ['bytes=0-15', 'bytes=24-35'])
+        self.assertEqual(sorted([c[1] for c in cache.put.mock_calls]), [
+            ('hA', 'sha256', 'a' * 8), ('hB', 'sha256', 'b' * 8),
+            ('hC', 'sha256', 'c' * 8), ('hD', 'sha256', 'd' * 4)])
+
+        #  Multi-range requests, around a cached block
+        GET.reset_mock()
+        cache.get.side_effect = lambda h, bh: 'b' * 8 if h == 'hB' else None
+        self.client.DOWNLOAD_RANGES = 2
+        self.client.DOWNLOAD_REQUEST_BYTES = 64
+        tmpFile = NamedTemporaryFile()
+        self.client.download_object(obj, tmpFile)
+        tmpFile.seek(0)
+        self.assertEqual(tmpFile.read(), data)
+        self.assertEqual(
+            [c[2]['async_headers']['Range'] for c in GET.mock_calls],
+            ['bytes=0-7,24-35'])
+
+        #  Streams
+        GET.reset_mock()
+        cache.get.side_effect = None
+        dst = Mock()
+        dst.isatty.return_value = True
+        self.client.DOWNLOAD_REQUEST_BYTES = 16
+        GET.side_effect = lambda obj, data_range=None, **kw: get(
+            obj, dict(Range=data_range))
+        self.client.download_object(obj, dst)
+        self.assertEqual(
+            ''.join([c[1][0] for c in dst.write.mock_calls]), data)
+        self.assertEqual([c[2]['data_range'] for c in GET.mock_calls], [
+            'bytes=0-15', 'bytes=16-31', 'bytes=32-35'])
+
+    @patch('%s.get_object_hashmap' % pithos_pkg)
+    @patch('%s.object_get' % pithos_pkg, return_value=FR())
+    def test_download_zero_blocks(self, GET, GOH):
+        from kamaki.clients.pithos import _zero_hash
+        zero = _zero_hash('sha256')
+        GOH.return_value = dict(
+            block_hash='sha256', block_size=4096, bytes=3 * 4096 + 10,
+            hashes=[zero, 'hA', zero, zero])
+        FR.content = 'a' * 4096
+        tmpFile = NamedTemporaryFile()
+        self.client.download_object(obj, tmpFile)
+        self.assertEqual(len(GET.mock_calls), 1)
+        tmpFile.seek(0)
+        self.assertEqual(
+            tmpFile.read(), '\x00' * 4096 + 'a' * 4096 + '\x00' * 4106)
+
+        #  Zeros overwrite existing data
+        GET.reset_mock()
+        tmpFile.seek(0)
+        tmpFile.write('x' * 4096)
+        tmpFile.flush()
+        self.client.download_object(obj, tmpFile)
+        tmpFile.seek(0)
+        self.assertEqual(tmpFile.read(4096), '\x00' * 4096)
+
+        GET.reset_mock()
+        self.assertEqual(
+            self.client.download_to_string(obj),
+            '\x00' * 4096 + 'a' * 4096 + '\x00' * 4106)
+        dst = Mock()
+        dst.isatty.return_value = True
+        self.client.download_object(obj, dst)
+        self.assertEqual(''.join([c[1][0] for c in dst.write.mock_calls]), (
+            '\x00' * 4096 + 'a' * 4096 + '\x00' * 4106))
+        self.assertEqual(len(GET.mock_calls), 2)
+
+    @patch('%s.get_object_hashmap' % pithos_pkg)
+    @patch('%s.object_get' % pithos_pkg)
+    def test_download_ordered(self, GET, GOH):
+        from time import sleep
+        from threading import Lock
+        GOH.return_value = dict(
+            block_hash='sha256', block_size=8, bytes=20, hashes=[
+                'hA', 'hB', 'hC'])
+        lock, running = Lock(), [0, 0]
+
+        def get(obj, data_range=None, **kwargs):
+            start, end = map(int, data_range[6:].split('-'))
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            #  The first block arrives last
+            sleep(0.05 if start == 0 else 0)
+            with lock:
+                running[0] -= 1
+            r = FR()
+            r.content = chr(ord('a') + start // 8) * (end + 1 - start)
+            return r
+
+        GET.side_effect = get
+        self.client.MAX_THREADS = 3
+        self.client.DOWNLOAD_REQUEST_BYTES = 8
+        self.client.concurrency.limit = 3
+        dst = Mock()
+        dst.isatty.return_value = False
+        dst.tell.side_effect = IOError(29, 'Illegal seek')
+        self.client.download_object(obj, dst)
+        self.assertEqual(
+            [c[1][0] for c in dst.write.mock_calls],
+            ['a' * 8, 'b' * 8, 'c' * 4])
+        self.assertFalse(dst.truncate.called)
+        self.assertTrue(running[1] > 1)
+
+        #  No more than window blocks are fetched ahead
+        dst.reset_mock()
+        running[1] = 0
+        self.client._dump_blocks_ordered(
+            obj, ['hA', 'hB', 'hC'], 8, 20, dst, None, window=1)
+        self.assertEqual(running[1], 1)
+        self.assertEqual(
+            ''.join(c[1][0] for c in dst.write.mock_calls),
+            'a' * 8 + 'b' * 8 + 'c' * 4)
+
     @patch('%s.get_object_hashmap' % pithos_pkg, return_value=object_hashmap)
     @patch('%s.object_get' % pithos_pkg, return_value=FR())
     def test_download_object(self, GET, GOH):
@@ -1397,6 +2167,258 @@ class PithosClient(TestCase):
             else:
                 self.assertEqual(GET.mock_calls[-1][2][k], v)
 
+    @patch('%s._put_block' % pithos_pkg)
+    def test_upload_missing_blocks(self, PB):
+        from kamaki.clients.pithos import _BlockRegistry
+        from kamaki.clients import Future
+        tmpFile = NamedTemporaryFile()
+        tmpFile.write('a' * 8 + 'b' * 8 + 'c' * 8)
+        tmpFile.flush()
+        hmap = dict(a=(0, 8), b=(8, 8), c=(16, 8))
+        registry = _BlockRegistry()
+        self.assertEqual(self.client._upload_missing_blocks(
+            ['a', 'b'], hmap, tmpFile, registry=registry), {})
+        self.assertEqual(
+            sorted((c[1][0].tobytes(), c[1][1]) for c in PB.mock_calls),
+            [('a' * 8, 'a'), ('b' * 8, 'b')])
+
+        #  Blocks sent (or being sent) by other uploads of the run
+        PB.reset_mock()
+        failed = Future(Mock(side_effect=ClientError('failed')))
+        failed._run()
+        registry.claim('c', lambda hash: failed)
+        upload_gen = Mock()
+        self.assertEqual(self.client._upload_missing_blocks(
+            ['a', 'b', 'c'], hmap, tmpFile, upload_gen, registry), {})
+        self.assertEqual(
+            [(c[1][0].tobytes(), c[1][1]) for c in PB.mock_calls],
+            [('c' * 8, 'c')])
+        self.assertEqual(len(upload_gen.next.mock_calls), 3)
+
+        PB.side_effect = ClientError('failed')
+        r = self.client._upload_missing_blocks(['a', 'c'], hmap, tmpFile)
+        self.assertEqual(sorted(r), ['a', 'c'])
+
+    def test_file_hashes(self):
+        from kamaki.clients.pithos import _pithos_hash
+        data = 'a' * 8 + 'b' * 8 + 'c' * 3
+        hashes = [_pithos_hash(data[i:i + 8], 'sha256') for i in (0, 8, 16)]
+        tmpFile = NamedTemporaryFile()
+        tmpFile.write(data)
+        tmpFile.flush()
+        self.assertEqual(list(self.client._file_hashes(
+            tmpFile, 8, 'sha256', 19)), zip(hashes, (8, 8, 3)))
+
+        key = (1, 2, 8, 'sha256', 19, 0)
+        self.client.hashmap_cache = Mock()
+        self.client.hashmap_cache.lookup.return_value = (key, ['ff'])
+        self.assertEqual(list(self.client._file_hashes(
+            tmpFile, 8, 'sha256', 19)), zip(['ff'] + hashes[1:], (8, 8, 3)))
+        self.client.hashmap_cache.store.assert_called_once_with(
+            tmpFile, key, ['ff'] + hashes[1:])
+
+        #  Only whole files are cached
+        self.client.hashmap_cache.lookup.return_value = (key, hashes)
+        self.assertEqual(list(self.client._file_hashes(
+            tmpFile, 8, 'sha256', 16)), zip(hashes[:2], (8, 8)))
+        self.assertEqual(len(self.client.hashmap_cache.store.mock_calls), 1)
+
+    def test__missing_blocks(self):
+        from kamaki.clients.pithos import _pithos_hash
+        data = 'a' * 8 + 'b' * 8 + 'a' * 8 + 'c' * 3
+        hashes = [_pithos_hash(data[i:i + 8], 'sha256') for i in (
+            0, 8, 16, 24)]
+        remote_hashes = {hashes[0]: [0, 2], hashes[1]: [1], hashes[3]: [3]}
+        tmpFile = NamedTemporaryFile()
+        self.assertEqual(self.client._missing_blocks(
+            remote_hashes, 8, 27, tmpFile, 'sha256'), [
+                (hashes[0], [0, 16]), (hashes[1], [8]), (hashes[3], [24])])
+
+        tmpFile.write(data[:8] + 'x' * 8 + data[16:24] + 'c')
+        tmpFile.flush()
+        with patch(
+                '%s._hash_local_blocks' % pithos_pkg,
+                return_value=hashes[:1] + ['x', hashes[0]]) as HLB:
+            self.assertEqual(self.client._missing_blocks(
+                remote_hashes, 8, 27, tmpFile, 'sha256', resume=True), [
+                    (hashes[1], [8]), (hashes[3], [24])])
+            #  The partial last block is not hashed
+            HLB.assert_called_once_with(tmpFile, 8, 24, 'sha256')
+
+    def test_file_hashes_sparse(self):
+        from kamaki.clients.pithos import _pithos_hash, _zero_hash
+        bs = 64 * 1024
+        tmpFile = NamedTemporaryFile()
+        tmpFile.write('a' * bs)
+        tmpFile.truncate(3 * bs + 10)
+        tmpFile.flush()
+        self.assertEqual(list(self.client._file_hashes(
+            tmpFile, bs, 'sha256', 3 * bs + 10)), [
+                (_pithos_hash('a' * bs, 'sha256'), bs),
+                (_zero_hash('sha256'), bs),
+                (_zero_hash('sha256'), bs),
+                (_zero_hash('sha256'), 10)])
+
+    @patch('%s._stream_block' % pithos_pkg, return_value=8)
+    def test_dump_blocks_async_resume(self, SB):
+        from kamaki.clients.pithos import _pithos_hash
+        data = 'a' * 8 + 'b' * 8 + 'c' * 3
+        hashes = [_pithos_hash(data[i:i + 8], 'sha256') for i in (0, 8, 16)]
+        remote_hashes = dict([(h, [i]) for i, h in enumerate(hashes)])
+        tmpFile = NamedTemporaryFile()
+        tmpFile.write(data[:8] + 'x' * 8 + data[16:])
+        tmpFile.flush()
+        self.client.DOWNLOAD_REQUEST_BYTES = 8
+        self.client._dump_blocks_async(
+            obj, remote_hashes, 8, 19, tmpFile, 'sha256', resume=True)
+        self.assertEqual(len(SB.mock_calls), 1)
+        self.assertEqual(SB.mock_calls[0][1][2], [8])
+
+        self.client._dump_blocks_async(
+            obj, remote_hashes, 8, 19, tmpFile, 'sha256')
+        self.assertEqual(sorted([c[1][2] for c in SB.mock_calls[1:]]), [
+            [0], [8], [16]])
+
+    def _sync_tree(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from os import path, mkdir
+        from kamaki.clients.pithos import _pithos_hash, _top_hash
+        root = mkdtemp()
+        self.addCleanup(rmtree, root)
+        mkdir(path.join(root, 'sub'))
+        mkdir(path.join(root, 'empty'))
+        for name, data in (
+                ('same', 'a' * 8 + 'b' * 3), ('changed', 'a' * 8 + 'c' * 8),
+                ('new', 'xyz'), ('sub/f', 'q')):
+            with open(path.join(root, *name.split('/')), 'wb') as f:
+                f.write(data)
+        hashes = dict([(data, _pithos_hash(data, 'sha256')) for data in (
+            'a' * 8, 'b' * 3, 'b' * 8, 'c' * 8)])
+        remote = [
+            dict(name='d/same', bytes=11, x_object_hash=_top_hash(
+                [hashes['a' * 8], hashes['b' * 3]], 'sha256')),
+            dict(name='d/changed', bytes=16, x_object_hash='x'),
+            dict(name='d/gone', bytes=1, x_object_hash='y'),
+            dict(name='d/sub', content_type='application/directory'),
+            dict(name='d/olddir', content_type='application/directory')]
+        for obj in remote:
+            obj.setdefault('content_type', 'application/octet-stream')
+            obj.setdefault('bytes', 0)
+            obj['last_modified'] = '2013-02-07T11:51:55.702751+00:00'
+        return root, remote, dict(
+            block_hash='sha256', block_size=8, bytes=16,
+            hashes=[hashes['a' * 8], hashes['b' * 8]])
+
+    @patch('%s.get_object_hashmap' % pithos_pkg)
+    @patch('%s.iter_objects' % pithos_pkg)
+    @patch('%s.get_container_info' % pithos_pkg, return_value={
+        'x-container-block-size': 8, 'x-container-block-hash': 'sha256'})
+    def test_sync_plan(self, GCI, IO, GOH):
+        root, remote, changed_hashmap = self._sync_tree()
+        IO.return_value = remote
+        GOH.return_value = changed_hashmap
+        plan = self.client.sync_plan(root, '/d/', delete=True)
+        IO.assert_called_once_with(prefix='d/')
+        GOH.assert_called_once_with('d/changed')
+        self.assertEqual(
+            [(e['action'], e['path'], e['bytes'], e['size']) for e in plan], [
+                ('mkdir', 'empty', 0, 0),
+                ('upload', 'changed', 8, 16),
+                ('upload', 'new', 3, 3),
+                ('upload', 'sub/f', 1, 1),
+                ('delete', 'olddir', 0, 0),
+                ('delete', 'gone', 0, 0)])
+        self.assertEqual(len(plan[1]['hashes']), 2)
+
+        IO.return_value = remote
+        plan = self.client.sync_plan(root, 'd', direction='download')
+        self.assertEqual(
+            [(e['action'], e['path'], e['bytes'], e['size']) for e in plan], [
+                ('mkdir', 'olddir', 0, 0),
+                ('download', 'changed', 8, 16),
+                ('download', 'gone', 1, 1)])
+        self.assertEqual(plan[-1]['mtime'], 1360237915)
+
+        #  Files stamped with the remote date are not hashed
+        from os import path, utime
+        utime(path.join(root, 'changed'), (1360237915, 1360237915))
+        plan = self.client.sync_plan(
+            root, 'd', direction='download', delete=True)
+        self.assertEqual([(e['action'], e['path']) for e in plan], [
+            ('mkdir', 'olddir'), ('download', 'gone'),
+            ('delete', 'sub/f'), ('delete', 'new')])
+        self.assertRaises(
+            AssertionError, self.client.sync_plan, root, direction='both')
+
+    @patch('%s.download_object' % pithos_pkg)
+    @patch('%s.del_object' % pithos_pkg)
+    @patch('%s.create_directory' % pithos_pkg)
+    @patch('%s._upload_missing_blocks' % pithos_pkg, return_value={})
+    @patch('%s.object_put' % pithos_pkg, return_value=FR())
+    @patch('%s._create_object_or_get_missing_hashes' % pithos_pkg)
+    @patch('%s.get_object_hashmap' % pithos_pkg)
+    @patch('%s.iter_objects' % pithos_pkg)
+    @patch('%s.get_container_info' % pithos_pkg, return_value={
+        'x-container-block-size': 8, 'x-container-block-hash': 'sha256'})
+    def test_sync(self, GCI, IO, GOH, COGMH, OP, UMB, CD, DO, DOB):
+        from os import path, utime
+        root, remote, changed_hashmap = self._sync_tree()
+        IO.return_value = remote
+        GOH.return_value = changed_hashmap
+        COGMH.side_effect = [(['c0'], {})]
+        utime(path.join(root, 'changed'), (1000000000, 1000000000))
+        plan = self.client.sync_upload(root, 'd', delete=True, dry_run=True)
+        self.assertEqual(len(plan), 6)
+        for m in (COGMH, CD, DO, DOB):
+            self.assertEqual(m.mock_calls, [])
+
+        sync_cb = Mock()
+        with patch('%s._file_hashes' % pithos_pkg) as FH:
+            self.assertEqual(self.client.sync_upload(
+                root, 'd', delete=True, sync_cb=sync_cb, plan=plan), plan)
+            #  The hashes of the plan are reused
+            self.assertEqual(FH.mock_calls, [])
+        self.assertEqual(GCI.mock_calls, [call(), call()])
+        self.assertEqual(len(IO.mock_calls), 1)
+        sync_cb.assert_called_once_with(6)
+        self.assertEqual(len(sync_cb.return_value.next.mock_calls), 7)
+        CD.assert_called_once_with('d/empty')
+        self.assertEqual(DO.mock_calls, [call('d/olddir'), call('d/gone')])
+        self.assertEqual([c[1][0] for c in COGMH.mock_calls], ['d/changed'])
+        self.assertEqual(COGMH.mock_calls[0][1][1], dict(
+            bytes=16, hashes=[h for h, b in plan[1]['hashes']]))
+        self.assertEqual(UMB.mock_calls[0][1][:2], (['c0'], {
+            plan[1]['hashes'][0][0]: (0, 8), plan[1]['hashes'][1][0]: (8, 8)}))
+        #  Small files are sent as data, then the hashmap of changed
+        self.assertEqual(
+            sorted([c[1][0] for c in OP.mock_calls]),
+            ['d/changed', 'd/new', 'd/sub/f'])
+        self.assertEqual(DOB.mock_calls, [])
+
+        #  Files changed after the plan are hashed again
+        from kamaki.clients.pithos import _pithos_hash
+        with open(path.join(root, 'changed'), 'wb') as f:
+            f.write('e' * 16)
+        utime(path.join(root, 'changed'), (1000000001, 1000000001))
+        COGMH.reset_mock()
+        COGMH.side_effect = [(None, {})]
+        self.client.sync_upload(root, 'd', plan=plan[1:2])
+        self.assertEqual(COGMH.mock_calls[0][1][1], dict(
+            bytes=16, hashes=[_pithos_hash('e' * 8, 'sha256')] * 2))
+
+        IO.return_value = remote
+        plan = self.client.sync_download(root, 'd', delete=True)
+        self.assertTrue(path.isdir(path.join(root, 'olddir')))
+        self.assertFalse(path.exists(path.join(root, 'new')))
+        self.assertEqual(
+            [(c[1][0], c[2]['resume']) for c in DOB.mock_calls],
+            [('d/changed', True), ('d/gone', False)])
+        self.assertEqual(len(set(
+            c[2]['block_index'] for c in DOB.mock_calls)), 1)
+        self.assertEqual(
+            int(path.getmtime(path.join(root, 'gone'))), 1360237915)
+
     def test_get_object_hashmap(self):
         FR.json = object_hashmap
         for empty in (304, 412):
@@ -1720,6 +2742,12 @@ class PithosClient(TestCase):
                 obj, tmpFile,
                 upload_cb=append_gen if turn else None)
             self.assertEqual((turn + 1) * num_of_blocks, len(post.mock_calls))
+            tmpFile.seek(0, 0)
+            self.assertEqual(
+                ''.join([
+                    kw['data'] for kw in [
+                        c[2] for c in post.mock_calls[-num_of_blocks:]]]),
+                tmpFile.read())
             (args, kwargs) = post.mock_calls[-1][1:3]
             self.assertEqual(kwargs['obj'], obj)
             self.assertEqual(kwargs['content_length'], len(kwargs['data']))
@@ -1839,5 +2867,11 @@ if __name__ == '__main__':
     if not argv[1:] or argv[1] == 'PithosMethods':
         not_found = False
         runTestCase(PithosRestClient, 'Pithos Methods', argv[2:])
+    if not argv[1:] or argv[1] == 'HashmapCache':
+        not_found = False
+        runTestCase(HashmapCache, 'Hashmap Cache', argv[2:])
+    if not argv[1:] or argv[1] == 'BlockCache':
+        not_found = False
+        runTestCase(BlockCache, 'Block Cache', argv[2:])
     if not_found:
         print('TestCase %s not found' % argv[1])
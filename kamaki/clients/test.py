@@ -33,10 +33,10 @@
 
 from mock import patch, call
 from unittest import makeSuite, TestSuite, TextTestRunner, TestCase
-from time import sleep
+from time import sleep, time
 from inspect import getmembers, isclass
 from itertools import product
-from random import randint
+from json import loads as json_loads
 
 from kamaki.clients.utils.test import Utils
 from kamaki.clients.astakos.test import AstakosClient
@@ -47,7 +47,8 @@ from kamaki.clients.cyclades.test import CycladesRestClient
 from kamaki.clients.image.test import ImageClient
 from kamaki.clients.storage.test import StorageClient
 from kamaki.clients.pithos.test import (
-    PithosClient, PithosRestClient, PithosMethods)
+    PithosClient, PithosRestClient, PithosMethods, HashmapCache,
+    BlockCache)
 
 
 class ClientError(TestCase):
@@ -123,15 +124,83 @@ class RequestManager(TestCase):
             self.assertEqual(req.headers, headers)
         self.assertRaises(AssertionError, self.RM, 'GOT', '', '', '', {}, {})
 
+    @patch('httplib.HTTPConnection.connect')
     @patch('httplib.HTTPConnection.getresponse')
     @patch('httplib.HTTPConnection.request')
-    def test_perform(self, request, getresponse):
+    def test_perform(self, request, getresponse, connect):
         from httplib import HTTPConnection
-        self.RM('GET', 'http://example.com', '/').perform(
-            HTTPConnection('http', 'example.com'))
+        conn = HTTPConnection('http', 'example.com')
+        self.RM('GET', 'http://example.com', '/', connect_timeout=4.2).perform(
+            conn)
         expected = dict(body=None, headers={}, url='/', method='GET')
         request.assert_called_once_with(**expected)
         getresponse.assert_called_once_with()
+        connect.assert_called_once_with()
+        self.assertEqual(conn.timeout, 4.2)
+
+        from socket import timeout
+        from kamaki.clients import ClientError
+        getresponse.side_effect = timeout('timed out')
+        self.assertRaises(
+            ClientError,
+            self.RM('GET', 'http://example.com', '/').perform, conn)
+
+    def test_timeout(self):
+        from kamaki.clients import ClientError
+        from time import time
+        rm = self.RM('GET', 'http://example.com', '/')
+        self.assertEqual(rm.timeout(4.2), 4.2)
+        rm = self.RM('GET', 'http://example.com', '/', total_timeout=10)
+        rm.started = time()
+        self.assertEqual(rm.timeout(4.2), 4.2)
+        self.assertTrue(1.0 < rm.timeout(None) <= 10.0)
+        rm.started = time() - 8
+        self.assertTrue(rm.timeout(4.2) <= 2.0)
+        rm.started = time() - 11
+        self.assertRaises(ClientError, rm.timeout, 4.2)
+
+    def test__get_body(self):
+        from StringIO import StringIO
+        for data in (None, 'some data', bytearray('some data')):
+            body = self.RM('PUT', '', '', data=data)._get_body()
+            self.assertEqual(body, data)
+        for data in (StringIO('some data'), iter(['some ', 'data'])):
+            body = self.RM('PUT', '', '', data=data)._get_body()
+            self.assertEqual(''.join(iter(body.read, '')), 'some data')
+
+        #  Sent again, e.g., on a new connection
+        from kamaki.clients import ClientError
+        req = self.RM('PUT', '', '', data=StringIO('some data'))
+        req._get_body().read()
+        self.assertEqual(req._get_body().read(), 'some data')
+        req = self.RM('PUT', '', '', data=iter(['some data']))
+        req._get_body().read()
+        self.assertRaises(ClientError, req._get_body)
+        for data in (
+                'some data', StringIO('some data'), iter(['some ', 'data'])):
+            body = self.RM(
+                'PUT', '', '',
+                data=data,
+                headers={'Transfer-Encoding': 'chunked'})._get_body()
+            chunks = ''.join(iter(body.read, ''))
+            self.assertTrue(chunks.endswith('0\r\n\r\n'))
+            if isinstance(data, str):
+                self.assertEqual(chunks, '9\r\nsome data\r\n0\r\n\r\n')
+            else:
+                self.assertTrue('data\r\n' in chunks)
+
+    def test__body_size(self):
+        from kamaki.clients import _body_size
+        from StringIO import StringIO
+        from tempfile import TemporaryFile
+        self.assertEqual(_body_size('some data'), 9)
+        self.assertEqual(_body_size(bytearray(42)), 42)
+        self.assertEqual(_body_size(iter(['some data'])), None)
+        self.assertEqual(_body_size(StringIO('some data')), None)
+        with TemporaryFile() as f:
+            f.write('some data')
+            f.seek(5)
+            self.assertEqual(_body_size(f), 4)
 
 
 class FakeResp(object):
@@ -149,12 +218,25 @@ class FakeResp(object):
         return self.HEADERS.items()
 
 
+class FakeStreamResp(FakeResp):
+
+    def __init__(self):
+        self._unread = self.READ
+
+    def read(self, amt=None):
+        amt = len(self._unread) if amt is None else amt
+        data, self._unread = self._unread[:amt], self._unread[amt:]
+        return data
+
+
 class ResponseManager(TestCase):
 
     def setUp(self):
         from kamaki.clients import ResponseManager, RequestManager
+        from kamaki.clients import ClientError
         from httplib import HTTPConnection
         self.RM = ResponseManager(RequestManager('GET', 'http://ok', '/'))
+        self.CE = ClientError
         self.HTTPC = HTTPConnection
 
     def tearDown(self):
@@ -201,6 +283,149 @@ class ResponseManager(TestCase):
         self.assertEqual(self.RM.json, FakeResp.HEADERS)
         self.assertTrue(isinstance(perform.call_args[0][0], self.HTTPC))
 
+    def test_iter_content(self):
+        from kamaki.clients import ResponseManager, RequestManager
+        for chunk_size in (1, 4, 100):
+            with patch(
+                    'kamaki.clients.RequestManager.perform',
+                    return_value=FakeStreamResp()):
+                rm = ResponseManager(
+                    RequestManager('GET', 'http://ok', '/'), stream=True)
+                chunks = list(rm.iter_content(chunk_size))
+                self.assertEqual(''.join(chunks), FakeResp.READ)
+                self.assertTrue(max(len(c) for c in chunks) <= chunk_size)
+                self.assertEqual(rm._pooled, None)
+        with patch(
+                'kamaki.clients.RequestManager.perform',
+                return_value=FakeResp()):
+            self.assertEqual(
+                ''.join(self.RM.iter_content(3)), FakeResp.READ)
+
+    @patch(
+        'kamaki.clients.RequestManager.perform', return_value=FakeStreamResp())
+    def test_read(self, perform):
+        from kamaki.clients import ResponseManager, RequestManager
+        rm = ResponseManager(
+            RequestManager('GET', 'http://ok', '/'), stream=True)
+        self.assertEqual(rm.read(4), FakeResp.READ[:4])
+        self.assertTrue(rm._pooled)
+        buf = bytearray(5)
+        self.assertEqual(rm.readinto(buf), 5)
+        self.assertEqual(str(buf), FakeResp.READ[4:9])
+        self.assertEqual(rm.read(), FakeResp.READ[9:])
+        self.assertEqual(rm._pooled, None)
+        with patch(
+                'kamaki.clients.RequestManager.perform',
+                return_value=FakeResp()):
+            self.assertEqual(self.RM.read(4), FakeResp.READ[:4])
+            self.assertEqual(self.RM.read(), FakeResp.READ[4:])
+
+    @patch(
+        'kamaki.clients.RequestManager.perform', return_value=FakeStreamResp())
+    def test_close(self, perform):
+        from kamaki.clients import ResponseManager, RequestManager
+        rm = ResponseManager(
+            RequestManager('GET', 'http://ok', '/'), stream=True)
+        self.assertEqual(rm.status_code, FakeResp.status)
+        self.assertTrue(rm._pooled)
+        with patch('httplib.HTTPConnection.close') as close:
+            rm.close()
+            close.assert_called_once_with()
+        self.assertEqual(rm._pooled, None)
+
+    def test_concurrency(self):
+        from kamaki.clients import ResponseManager, RequestManager
+        from kamaki.clients import ConcurrencyController
+        for stream, resp in ((False, FakeResp), (True, FakeStreamResp)):
+            cc = ConcurrencyController(4)
+            with patch(
+                    'kamaki.clients.RequestManager.perform',
+                    return_value=resp()):
+                rm = ResponseManager(
+                    RequestManager('GET', 'http://ok', '/'),
+                    stream=stream, concurrency=cc)
+                self.assertEqual(rm.content, FakeResp.READ)
+            stats = cc.state()['endpoints']['ok']
+            self.assertEqual(stats['requests'], 1)
+            self.assertEqual(stats['congested'], 0)
+            self.assertTrue(stats['rtt'] >= 0)
+
+        cc = ConcurrencyController(4)
+        with patch(
+                'kamaki.clients.RequestManager.perform',
+                side_effect=self.CE('too slow')):
+            rm = ResponseManager(
+                RequestManager('GET', 'http://ok', '/'), concurrency=cc)
+            self.assertRaises(self.CE, rm._get_response)
+        self.assertEqual(cc.state()['endpoints']['ok']['congested'], 1)
+
+    def test_observers(self):
+        from kamaki.clients import ResponseManager, RequestManager
+        events = []
+
+        def broken_observer(event):
+            raise Exception('observer bug')
+        observers = [events.append, broken_observer]
+        for stream, resp in ((False, FakeResp), (True, FakeStreamResp)):
+            with patch(
+                    'kamaki.clients.RequestManager.perform',
+                    return_value=resp()):
+                rm = ResponseManager(
+                    RequestManager('GET', 'http://ok', '/a/b?x=y'),
+                    stream=stream, observers=observers)
+                self.assertEqual(rm.content, FakeResp.READ)
+            event = events[-1]
+            self.assertEqual(event.method, 'GET')
+            self.assertEqual(event.operation, 'GET')
+            self.assertEqual(event.path, '/a/b')
+            self.assertEqual(event.netloc, 'ok')
+            self.assertEqual(event.status, FakeResp.status)
+            self.assertEqual(event.received, len(FakeResp.READ))
+            self.assertEqual(event.error, None)
+            for phase in event.PHASES:
+                self.assertTrue(event.total >= getattr(event, phase) >= 0)
+        self.assertEqual(len(events), 2)
+
+        error = self.CE('too slow')
+        with patch(
+                'kamaki.clients.RequestManager.perform', side_effect=error):
+            rm = ResponseManager(
+                RequestManager('GET', 'http://ok', '/'), observers=observers)
+            self.assertRaises(self.CE, rm._get_response)
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[-1].status, None)
+        self.assertEqual(events[-1].error, error)
+
+    @patch('kamaki.clients.RequestManager.perform', return_value=FakeResp())
+    def test_json_cache(self, perform):
+        FakeResp.READ = '[{"a": 1}, 2]'
+        with patch('kamaki.clients.loads', side_effect=json_loads) as loads:
+            self.assertEqual(self.RM.json, [{'a': 1}, 2])
+            self.assertTrue(self.RM.json is self.RM.json)
+            self.assertEqual(len(loads.mock_calls), 1)
+
+    def test_iter_json(self):
+        from kamaki.clients import ResponseManager, RequestManager
+        FakeResp.READ = '[{"a": 1}, 2, "three"]'
+        for stream, resp in ((False, FakeResp), (True, FakeStreamResp)):
+            with patch(
+                    'kamaki.clients.RequestManager.perform',
+                    return_value=resp()):
+                rm = ResponseManager(
+                    RequestManager('GET', 'http://ok', '/'), stream=stream)
+                items = rm.iter_json(4)
+                self.assertEqual(items.next(), {'a': 1})
+                self.assertEqual(list(items), [2, 'three'])
+                self.assertEqual(rm._pooled, None)
+        FakeResp.READ = '{"a": 1}'
+        with patch(
+                'kamaki.clients.RequestManager.perform',
+                return_value=FakeStreamResp()):
+            rm = ResponseManager(
+                RequestManager('GET', 'http://ok', '/'), stream=True)
+            self.assertRaises(self.CE, list, rm.iter_json())
+            self.assertEqual(rm._pooled, None)
+
     @patch('kamaki.clients.RequestManager.perform', return_value=FakeResp())
     def test_all(self, perform):
         self.assertEqual(self.RM.content, FakeResp.READ)
@@ -265,6 +490,363 @@ class SilentEvent(TestCase):
                 self.assertFalse(t.exception)
 
 
+class ConcurrencyController(TestCase):
+
+    def setUp(self):
+        from kamaki.clients import ConcurrencyController
+        self.cc = ConcurrencyController(max_limit=10)
+
+    def test_slow_start(self):
+        self.assertEqual(self.cc.window, 1)
+        for exp in (2, 3, 4):
+            self.cc.record('host', time(), status=200)
+            self.assertEqual(self.cc.window, exp)
+        for i in range(10):
+            self.cc.record('host', time(), status=201)
+        self.assertEqual(self.cc.window, 10)
+        self.assertTrue(self.cc.slow_start)
+        self.cc.record('host', time(), status=404)
+        self.assertEqual(self.cc.window, 10)
+        self.cc.record('host', time(), status=500)
+        self.assertEqual(self.cc.window, 10)
+
+    def test_congestion(self):
+        self.cc.limit = 8.0
+        started = time()
+        sleep(0.01)
+        self.cc.record('host', time(), status=503)
+        self.assertEqual(self.cc.window, 4)
+        self.assertFalse(self.cc.slow_start)
+        #  Requests started before the decrease do not decrease it further
+        self.cc.record('host', started, status=502)
+        self.cc.record('host', started, failed=True)
+        self.assertEqual(self.cc.window, 4)
+        sleep(0.01)
+        self.cc.record('host', time(), status=413)
+        self.assertEqual(self.cc.window, 2)
+        sleep(0.01)
+        self.cc.record('host', time(), failed=True)
+        sleep(0.01)
+        self.cc.record('host', time(), failed=True)
+        self.assertEqual(self.cc.window, 1)
+        #  Additive increase: about +1 per window of successful requests
+        for exp in (2, 2, 2, 3, 3, 3, 4):
+            self.cc.record('host', time(), status=200)
+            self.assertEqual(self.cc.window, exp)
+
+    def test_state(self):
+        self.cc.record('host1', time() - 2, status=200, rtt=1.0, size=100)
+        self.cc.record('host1', time() - 2, status=200, rtt=2.0, size=100)
+        self.cc.record('host2', time(), status=503)
+        state = self.cc.state()
+        self.assertEqual(state['window'], 1)
+        self.assertFalse(state['slow_start'])
+        host1, host2 = state['endpoints']['host1'], state['endpoints']['host2']
+        self.assertEqual(host1['requests'], 2)
+        self.assertEqual(host1['congested'], 0)
+        self.assertEqual(host1['rtt'], 1.125)
+        self.assertTrue(40 < host1['throughput'] <= 50)
+        self.assertEqual(host2['requests'], 1)
+        self.assertEqual(host2['congested'], 1)
+        self.assertEqual(host2['rtt'], None)
+
+
+class ConnectionPool(TestCase):
+
+    def setUp(self):
+        from kamaki.clients import ConnectionPool
+        self.pool = ConnectionPool('http', 'example.com', 2)
+
+    def _connect(self, conn):
+        from socket import socketpair
+        conn.sock, conn._peer = socketpair()
+
+    def test_counters(self):
+        conn = self.pool.pool_get()
+        self.assertEqual(conn.sock, None)
+        self._connect(conn)
+        self.pool.pool_put(conn)
+        self.assertEqual(self.pool.pool_get(), conn)
+        stats = self.pool.stats()
+        for k, v in dict(
+                gets=2, hits=1, misses=1, waits=0, discarded=0,
+                size=2, idle=0).items():
+            self.assertEqual(stats[k], v)
+
+        #  A connection closed by the server is discarded
+        conn._peer.close()
+        self.pool.pool_put(conn)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+        other = self.pool.pool_get()
+        self.assertNotEqual(other, conn)
+        stats = self.pool.stats()
+        self.assertEqual(stats['discarded'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertTrue(
+            stats['max_age'] >= stats['total_discarded_age'] > 0)
+        self.pool.pool_get()
+        self.assertEqual(self.pool.stats()['waits'], 0)
+
+    @patch('httplib.HTTPConnection.connect')
+    def test_prewarm(self, connect):
+        connect.side_effect = lambda: None
+        self.assertEqual(self.pool.prewarm(5), 0)
+        self.assertEqual(len(connect.mock_calls), 2)
+        self.assertEqual(self.pool.stats()['idle'], 2)
+
+        from socket import socketpair
+        connect.side_effect = None
+        conns = [self.pool.pool_get() for i in range(2)]
+        for conn in conns:
+            conn.sock = socketpair()[0]
+            self.pool.pool_put(conn)
+        conns[0].sock = None
+        self.assertEqual(self.pool.prewarm(2, timeout=3.0), 0)
+        self.assertEqual(conns[0].timeout, 3.0)
+
+    @patch('httplib.HTTPConnection.connect')
+    @patch('httplib.HTTPConnection.getresponse')
+    @patch('httplib.HTTPConnection.request')
+    def test_resend(self, request, getresponse, connect):
+        from httplib import BadStatusLine
+        from StringIO import StringIO
+        from kamaki.clients import ClientError, RequestManager
+        sent = []
+        request.side_effect = lambda *args, **kwargs: sent.append(
+            ''.join(iter(kwargs['body'].read, '')))
+        getresponse.side_effect = [BadStatusLine(''), FakeResp()]
+        conn = self.pool.pool_get()
+        data = StringIO('some data')
+        RequestManager(
+            'PUT', 'http://example.com', '/', data=data).perform(conn)
+        self.assertEqual(sent, ['some data', 'some data'])
+
+        #  A body that cannot be read again is not sent truncated
+        sent = []
+        getresponse.side_effect = [BadStatusLine(''), FakeResp()]
+        self.assertRaises(ClientError, RequestManager(
+            'PUT', 'http://example.com', '/',
+            data=iter(['some ', 'data'])).perform, conn)
+        self.assertEqual(sent, ['some data'])
+
+    def test_get_connection_pool(self):
+        from kamaki.clients import get_connection_pool
+        from kamaki.clients import get_connection_pool_stats
+        pool = get_connection_pool('https', 'pool.example.com')
+        self.assertEqual(pool.size, 100)
+        self.assertEqual(
+            get_connection_pool('https', 'pool.example.com'), pool)
+        from objpool import PoolLimitError
+        conn = pool.pool_get()
+        self.assertEqual(
+            get_connection_pool('https', 'pool.example.com', 3), pool)
+        self.assertEqual(pool.size, 100)
+        resized = get_connection_pool('https', 'pool.example.com', 102)
+        self.assertEqual(resized, pool)
+        pool.pool_put(conn)
+        conns = [pool.pool_get(blocking=False) for i in range(102)]
+        self.assertRaises(PoolLimitError, pool.pool_get, blocking=False)
+        for conn in conns:
+            pool.pool_put(conn)
+        stats = get_connection_pool_stats()['https://pool.example.com']
+        self.assertEqual(stats['gets'], 103)
+        self.assertEqual(stats['size'], 102)
+
+    def test_waits(self):
+        from threading import Thread
+        conns = [self.pool.pool_get() for i in range(2)]
+        self.assertEqual(self.pool.stats()['waits'], 0)
+        waiting = Thread(target=self.pool.pool_get)
+        waiting.start()
+        sleep(0.1)
+        self.pool.pool_put(conns[0])
+        waiting.join()
+        self.assertEqual(self.pool.stats()['waits'], 1)
+
+
+class RequestStats(TestCase):
+
+    def setUp(self):
+        from kamaki.clients import RequestStats, RequestEvent
+        self.stats = RequestStats()
+        self.RE = RequestEvent
+
+    def event(self, operation, status=200, error=None, **timings):
+        event = self.RE('GET', '/p', 'ok', operation)
+        event.status, event.error = status, error
+        event.sent, event.received = 10, 100
+        for phase, value in timings.items():
+            setattr(event, phase, value)
+        return event
+
+    def test_summary(self):
+        for ttfb in (0.001, 0.02, 0.02, 0.3, 100.0):
+            self.stats(self.event(
+                'block GET', ttfb=ttfb, transfer=0.5, total=ttfb + 0.5))
+        self.stats(self.event('listing', status=404, total=0.01))
+        self.stats(self.event('listing', status=None, error=Exception()))
+        summary = self.stats.summary()
+        self.assertEqual(sorted(summary), ['block GET', 'listing'])
+
+        blocks = summary['block GET']
+        self.assertEqual(blocks['requests'], 5)
+        self.assertEqual(blocks['errors'], 0)
+        self.assertEqual(blocks['sent'], 50)
+        self.assertEqual(blocks['received'], 500)
+        self.assertEqual(blocks['statuses'], {200: 5})
+        self.assertEqual(blocks['throughput'], 550 / 2.5)
+        self.assertAlmostEqual(blocks['mean']['ttfb'], 100.341 / 5)
+        self.assertEqual(blocks['p50']['ttfb'], 0.025)
+        self.assertEqual(blocks['p90']['ttfb'], float('inf'))
+        self.assertEqual(blocks['p50']['queued'], 0.001)
+        histogram = dict(blocks['histograms']['ttfb'])
+        self.assertEqual(sum(histogram.values()), 5)
+        for bound, count in ((0.001, 1), (0.025, 2), (0.5, 1), (
+                float('inf'), 1)):
+            self.assertEqual(histogram[bound], count)
+
+        listing = summary['listing']
+        self.assertEqual(listing['errors'], 2)
+        self.assertEqual(listing['statuses'], {404: 1, 'error': 1})
+        self.assertEqual(listing['throughput'], None)
+
+        self.assertEqual(self.stats.percentile('other', 'ttfb', 50), None)
+        self.stats.reset()
+        self.assertEqual(self.stats.summary(), {})
+
+
+class RetryPolicy(TestCase):
+
+    def setUp(self):
+        from kamaki.clients import RetryPolicy
+        self.policy = RetryPolicy(3, backoff=1.0, max_backoff=3.0)
+
+    def test_parse_retry_after(self):
+        from email.utils import formatdate
+        parse = self.policy.parse_retry_after
+        self.assertEqual(parse('120'), 120.0)
+        self.assertEqual(parse('-3'), 0.0)
+        self.assertEqual(parse(None), None)
+        self.assertEqual(parse('soon'), None)
+        self.assertTrue(55 < parse(formatdate(time() + 60)) <= 60)
+        self.assertEqual(parse(formatdate(time() - 60)), 0.0)
+
+    def test_delay(self):
+        for attempt, cap in ((1, 1.0), (2, 2.0), (3, 3.0), (9, 3.0)):
+            for i in range(20):
+                self.assertTrue(0.0 <= self.policy.delay(attempt) <= cap)
+        self.assertEqual(self.policy.delay(1, 42.0), 42.0)
+        self.assertEqual(self.policy.delay(1, 301.0), None)
+
+    def test_retry_delay(self):
+        from socket import timeout
+        from kamaki.clients import ClientError
+        for args, kwargs, retry in (
+                (('GET', 503), {}, True),
+                (('GET', 500), {}, False),
+                (('POST', 502), {}, False),
+                (('POST', 502), dict(idempotent=True), True),
+                (('PUT', 429), {}, True),
+                (('PUT', None, timeout()), {}, True),
+                (('PUT', None, ClientError('Connection failed')), {}, True),
+                (('PUT', None, ClientError('Not found', 404)), {}, False),
+                (('MOVE', None, timeout()), {}, False)):
+            delay = self.policy.retry_delay(1, *args, **kwargs)
+            self.assertEqual(delay is not None, retry)
+        self.assertEqual(self.policy.retry_delay(4, 'GET', 503), None)
+        self.assertEqual(
+            self.policy.retry_delay(1, 'GET', 503, retry_after='2'), 2.0)
+        self.assertEqual(self.policy.stats['attempts'], 11)
+        self.assertEqual(self.policy.stats['retries'], 6)
+        self.assertEqual(self.policy.stats['outcomes']['timeout'], 2)
+
+
+class WorkerPool(TestCase):
+
+    def setUp(self):
+        from kamaki.clients import WorkerPool
+        self.pool = WorkerPool(3)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_submit(self):
+        from threading import Event
+        from kamaki.clients import ClientError
+        release = Event()
+
+        def wait_and_double(x):
+            release.wait(4)
+            if x < 0:
+                raise ValueError(x)
+            return 2 * x
+        futures = [self.pool.submit(wait_and_double, i) for i in range(3)]
+        self.assertFalse(any(f.done() for f in futures))
+        release.set()
+        self.assertEqual([f.result() for f in futures], [0, 2, 4])
+        self.assertTrue(len(self.pool._workers) <= 3)
+        failed = self.pool.submit(wait_and_double, -1)
+        self.assertRaises(ValueError, failed.result)
+        self.assertTrue(isinstance(failed.exception(), ValueError))
+
+        release.clear()
+        blocked = [self.pool.submit(wait_and_double, i) for i in range(3)]
+        queued = self.pool.submit(wait_and_double, 7)
+        self.assertTrue(queued.cancel())
+        self.assertRaises(ClientError, queued.result)
+        release.set()
+        self.assertEqual([f.result() for f in blocked], [0, 2, 4])
+        self.assertFalse(blocked[0].cancel())
+
+    def test_map(self):
+        def slow_inverse(x):
+            sleep(0.01 * x)
+            return -x
+        kwarg_list = [dict(x=i) for i in range(8, 0, -1)]
+        self.assertEqual(
+            list(self.pool.map(slow_inverse, kwarg_list)),
+            [-i for i in range(8, 0, -1)])
+        self.assertEqual(
+            sorted(self.pool.map(slow_inverse, kwarg_list, ordered=False)),
+            range(-8, 0))
+
+    def test_batch(self):
+        calls = []
+
+        def call(x):
+            calls.append(x)
+            return x
+        batch = self.pool.batch()
+        for i in range(10):
+            batch.submit(call, i)
+        done = [f.result() for f in batch.completed(wait=True)]
+        self.assertEqual(sorted(done), range(10))
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(list(batch.completed()), [])
+
+    def test_controller(self):
+        from threading import Event
+        from kamaki.clients import ConcurrencyController
+        self.pool.controller = ConcurrencyController(3)
+        release = Event()
+        futures = [self.pool.submit(release.wait, 4) for i in range(3)]
+        self.assertEqual(self.pool.limit, 1)
+        self.assertEqual(len(self.pool._workers), 1)
+        release.set()
+        [f.result() for f in futures]
+        self.pool.controller.limit = 3.0
+        self.assertEqual(self.pool.limit, 3)
+
+    def test_resize_and_shutdown(self):
+        self.pool.resize(1)
+        self.assertEqual(self.pool.submit(sum, [1, 2]).result(), 3)
+        self.assertEqual(len(self.pool._workers), 1)
+        self.pool.shutdown()
+        self.assertTrue(self.pool.is_shut_down)
+        self.assertEqual(self.pool._workers, [])
+        self.assertRaises(AssertionError, self.pool.submit, sum, [1])
+
+
 class FR(object):
     json = None
     text = None
@@ -305,49 +887,60 @@ class Client(TestCase):
         DATE_FORMATS = ['%a %b %d %H:%M:%S %Y']
         self.assertEqual(self.client.DATE_FORMATS, DATE_FORMATS)
 
-    def test__init_thread_limit(self):
-        exp = 'Nothing set here'
-        for faulty in (-1, 0.5, 'a string', {}):
-            self.assertRaises(
-                AssertionError,
-                self.client._init_thread_limit,
-                faulty)
-            self.assertEqual(exp, getattr(self.client, '_thread_limit', exp))
-            self.assertEqual(exp, getattr(self.client, '_elapsed_old', exp))
-            self.assertEqual(exp, getattr(self.client, '_elapsed_new', exp))
-        self.client._init_thread_limit(42)
-        self.assertEqual(42, self.client._thread_limit)
-        self.assertEqual(0.0, self.client._elapsed_old)
-        self.assertEqual(0.0, self.client._elapsed_new)
-
-    def test__watch_thread_limit(self):
-        waits = (
-            dict(args=((0.1, 1), (0.1, 2), (0.2, 1), (0.7, 1), (0.3, 2))),
-            dict(args=((1.0 - (i / 10.0), (i + 1)) for i in range(7))),
-            dict(max=1, args=tuple([(randint(1, 10) / 3.0, 1), ] * 10)),
-            dict(
-                limit=5,
-                args=tuple([
-                    (1.0 + (i / 10.0), (5 - i - 1)) for i in range(4)] + [
-                    (2.0, 1), (1.9, 2), (2.0, 1), (2.0, 2)])),
-            dict(args=tuple(
-                [(1.0 - (i / 10.0), (i + 1)) for i in range(7)] + [
-                (0.1, 7), (0.2, 6), (0.4, 5), (0.3, 6), (0.2, 7), (0.1, 7)])),)
-        for wait_dict in waits:
-            if 'max' in wait_dict:
-                self.client.MAX_THREADS = wait_dict['max']
-            else:
-                self.client.MAX_THREADS = 7
-            if 'limit' in wait_dict:
-                self.client._init_thread_limit(wait_dict['limit'])
-            else:
-                self.client._init_thread_limit()
-                self.client._watch_thread_limit(list())
-                self.assertEqual(1, self.client._thread_limit)
-            for wait, exp_limit in wait_dict['args']:
-                self.client._elapsed_new = wait
-                self.client._watch_thread_limit(list())
-                self.assertEqual(exp_limit, self.client._thread_limit)
+    def test_workers(self):
+        self.client.MAX_THREADS = 2
+        pool = self.client.workers
+        self.assertEqual(pool.size, 2)
+        self.client.MAX_THREADS = 4
+        self.assertEqual(self.client.workers, pool)
+        self.assertEqual(pool.size, 4)
+        pool.shutdown()
+        self.assertNotEqual(self.client.workers, pool)
+
+    @patch('kamaki.clients.sleep')
+    def test_observers(self, sleep):
+        from kamaki.clients import RetryPolicy
+        events, observer = [], lambda e: events.append(e)
+        self.client.add_observer(observer)
+        self.client.add_observer(observer)
+        self.assertEqual(self.client.observers, [observer])
+        resps = [FakeResp(), FakeResp()]
+        resps[0].status = 503
+        with patch(
+                'kamaki.clients.RequestManager.perform', side_effect=resps):
+            self.client.request(
+                'get', '/p', retry_policy=RetryPolicy(1), success=42,
+                operation='probe')
+        self.assertEqual([(e.operation, e.retries, e.status) for e in (
+            events)], [('probe', 0, 503), ('probe', 1, 42)])
+
+        with patch(
+                'kamaki.clients.RequestManager.perform',
+                return_value=FakeResp()):
+            self.client.request('head', '/p', success=42)
+            self.assertEqual(events[-1].operation, 'HEAD')
+            self.client.remove_observer(observer)
+            self.client.request('head', '/p', success=42)
+        self.assertEqual(len(events), 3)
+
+    @patch('kamaki.clients.ConnectionPool.prewarm')
+    def test_prewarm_connections(self, prewarm):
+        self.assertEqual(self.client.prewarm_connections(), None)
+        self.client.CONNECTION_PREWARM = 4
+        self.client.prewarm_connections().join()
+        prewarm.assert_called_once_with(4, self.client.CONNECT_TIMEOUT)
+        self.client.prewarm_connections(2).join()
+        self.assertEqual(prewarm.mock_calls[-1], call(2, 60.0))
+
+    def test_async_run(self):
+        def double(x):
+            return 2 * x
+        self.client.MAX_THREADS = 3
+        self.assertEqual(
+            self.client.async_run(double, [dict(x=i) for i in range(5)]),
+            [0, 2, 4, 6, 8])
+        self.assertRaises(
+            TypeError, self.client.async_run, double, [dict(y=1)])
 
     def test__raise_for_status(self):
         r = FR()
@@ -387,10 +980,33 @@ class Client(TestCase):
             self.assertEqual(
                 SP.mock_calls[-1], call(name, value, iff=condition))
 
+    def test_context(self):
+        from threading import Thread
+        self.client.set_header('X-Main', 'main')
+        self.client.set_param('main', 'yes')
+        seen = dict()
+
+        def other_thread():
+            self.client.set_header('X-Other', 'other')
+            seen['headers'] = dict(self.client.headers)
+            seen['params'] = dict(self.client.params)
+        t = Thread(target=other_thread)
+        t.start()
+        t.join()
+        self.assert_dicts_are_equal(seen['headers'], {'X-Other': 'other'})
+        self.assert_dicts_are_equal(seen['params'], {})
+        self.assert_dicts_are_equal(self.client.headers, {'X-Main': 'main'})
+        self.assert_dicts_are_equal(self.client.params, {'main': 'yes'})
+        self.client._reset_context()
+        self.assert_dicts_are_equal(self.client.headers, {})
+        self.assertEqual(self.client.response_headers, [])
+
     @patch('kamaki.clients.RequestManager', return_value=FR)
     @patch('kamaki.clients.ResponseManager', return_value=FakeResp())
     @patch('kamaki.clients.ResponseManager.__init__')
     def test_request(self, Requ, RespInit, Resp):
+        from kamaki.clients import RequestEvent
+        RespInit.return_value.event = RequestEvent('GET', '/')
         for args in product(
                 ('get', '', dict(method='get')),
                 ('/some/path', None, ['some', 'path']),
@@ -412,7 +1028,87 @@ class Client(TestCase):
             self.client.request(method, path, **kwargs)
             self.assertEqual(
                 RespInit.mock_calls[-1],
-                call(FR, connection_retry_limit=0, poolsize=None))
+                call(
+                    FR, connection_retry_limit=0, poolsize=None, stream=False,
+                    concurrency=self.client.concurrency,
+                    observers=self.client.observers))
+
+        for data, exp_headers in (
+                ('some data', {'Content-Length': '9'}),
+                (iter(['some data']), {'Transfer-Encoding': 'chunked'})):
+            self.client.request('put', '/some/path', data=data, success=None)
+            headers = Resp.mock_calls[-1][2]['headers']
+            for k, v in exp_headers.items():
+                self.assertEqual(headers[k], v)
+
+    @patch('kamaki.clients.sleep')
+    def test_request_retries(self, sleep):
+        from socket import error as SocketError
+        from errno import ECONNREFUSED
+        from kamaki.clients import RetryPolicy
+
+        def resp(status, headers=dict()):
+            r = FakeResp()
+            r.status, r.HEADERS = status, headers
+            return r
+        policy = RetryPolicy(2)
+        perform = 'kamaki.clients.RequestManager.perform'
+        for method, responses, idempotent, attempts in (
+                ('get', [resp(503), resp(200)], None, 2),
+                ('post', [resp(503), resp(200)], None, 2),
+                ('post', [resp(502), resp(200)], None, 0),
+                ('post', [resp(502), resp(200)], True, 2),
+                ('get', [resp(404), resp(200)], None, 0),
+                ('get', [resp(503)] * 3, None, 0),
+                ('post', [SocketError(ECONNREFUSED, 'refused'), resp(200)],
+                    None, 2),
+                ('post', [self.CE('timeout'), resp(200)], None, 0),
+                ('put', [self.CE('timeout'), resp(200)], None, 2)):
+            with patch(perform, side_effect=responses):
+                if attempts:
+                    r = self.client.request(
+                        method, '/p', retry_policy=policy,
+                        idempotent=idempotent)
+                    self.assertEqual(r.attempts, attempts)
+                else:
+                    self.assertRaises(
+                        (self.CE, SocketError), self.client.request,
+                        method, '/p', retry_policy=policy,
+                        idempotent=idempotent)
+        self.assertEqual(policy.stats['retries'], 7)
+        self.assertEqual(policy.stats['failures'], 4)
+        self.assertEqual(policy.stats['outcomes'][503], 5)
+
+        #  Retry-After is honored, bodies that cannot be resent are not
+        with patch(perform, side_effect=[
+                resp(503, {'Retry-After': '7'}), resp(200)]):
+            self.client.request('get', '/p', retry_policy=policy)
+            self.assertEqual(sleep.mock_calls[-1], call(7.0))
+        with patch(perform, side_effect=[resp(503), resp(200)]):
+            self.assertRaises(
+                self.CE, self.client.request, 'put', '/p',
+                data=iter(['data']), retry_policy=policy)
+        #  No retries by default
+        with patch(perform, side_effect=[resp(503), resp(200)]):
+            self.assertRaises(self.CE, self.client.request, 'get', '/p')
+
+        #  The total timeout counts from the first attempt
+        responses, starts = [resp(503), resp(200)], []
+
+        def perform_attempt(req, conn):
+            starts.append(req.started)
+            return responses.pop(0)
+
+        with patch(perform, autospec=True, side_effect=perform_attempt):
+            self.client.request(
+                'get', '/p', retry_policy=policy, total_timeout=60)
+        self.assertEqual(len(starts), 2)
+        self.assertTrue(starts[0] and starts[0] == starts[1])
+        with patch(perform, side_effect=[
+                resp(503, {'Retry-After': '7'}), resp(200)]):
+            self.assertRaises(
+                self.CE, self.client.request, 'get', '/p',
+                retry_policy=policy, total_timeout=5)
 
     @patch('kamaki.clients.Client.request', return_value='lala')
     def _test_foo(self, foo, request):
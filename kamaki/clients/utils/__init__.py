@@ -31,6 +31,10 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
+from json import JSONDecoder
+
+_JSON_WHITESPACE = ' \t\n\r'
+
 
 def _matches(val1, val2, exactMath=True):
     """Case Insensitive match"""
@@ -105,3 +109,77 @@ def readall(openfile, size, retries=7):
                 continue
         return buf
     raise IOError('Failed to read %s bytes from file' % size)
+
+
+class FileSlice(object):
+    """A read-only file-like view of the next size bytes of a file object"""
+
+    def __init__(self, fileobj, size):
+        self.fileobj, self.remains = fileobj, max(size, 0)
+
+    def __len__(self):
+        return self.remains
+
+    def read(self, size=None):
+        if size is None or size < 0 or size > self.remains:
+            size = self.remains
+        data = self.fileobj.read(size) if size else ''
+        self.remains -= len(data)
+        return data
+
+
+def iter_json_list(chunks, decoder=None):
+    """Decode a JSON list incrementally, while its data arrive
+
+    :param chunks: (iterable of str) the JSON document, in pieces
+
+    :param decoder: (JSONDecoder) default is the json module decoder
+
+    :returns: (generator) the items of the list, one by one. An empty
+        document is an empty list.
+
+    :raises ValueError: if the document is not a well formed JSON list
+    """
+    decoder = decoder or JSONDecoder()
+    chunks = iter(chunks)
+    buf, pos, started, items, expect_item = '', 0, False, 0, True
+    while True:
+        chunk = next(chunks, None)
+        final = chunk is None
+        if not final:
+            buf, pos = buf[pos:] + chunk, 0
+        size = len(buf)
+        while True:
+            while pos < size and buf[pos] in _JSON_WHITESPACE:
+                pos += 1
+            if pos == size:
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('Not a JSON list')
+                started, pos = True, pos + 1
+            elif buf[pos] == ']' and not (expect_item and items):
+                if buf[pos + 1:].strip(_JSON_WHITESPACE) or any(
+                        c.strip(_JSON_WHITESPACE) for c in chunks):
+                    raise ValueError('Extra data after the JSON list')
+                return
+            elif not expect_item:
+                if buf[pos] != ',':
+                    raise ValueError('Expected "," at %s' % pos)
+                pos, expect_item = pos + 1, True
+            else:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    break
+                #  A number at the end of the data may continue in next chunk
+                if end == size and not final:
+                    break
+                pos, items, expect_item = end, items + 1, False
+                yield item
+        if final:
+            if started:
+                raise ValueError('Unterminated JSON list')
+            return
@@ -140,6 +140,34 @@ class Utils(TestCase):
             self.assertEqual(utils.readall(f, 1), '')
             self.assertRaises(IOError, utils.readall, f, 1, 0)
 
+    def test_FileSlice(self):
+        tstr = '1234567890'
+        with TemporaryFile() as f:
+            f.write(tstr)
+            f.flush()
+            f.seek(2)
+            fslice = utils.FileSlice(f, 6)
+            self.assertEqual(len(fslice), 6)
+            self.assertEqual(fslice.read(4), tstr[2:6])
+            self.assertEqual(len(fslice), 2)
+            self.assertEqual(fslice.read(), tstr[6:8])
+            self.assertEqual(fslice.read(), '')
+            self.assertEqual(f.read(), tstr[8:])
+
+    def test_iter_json_list(self):
+        from json import dumps
+        doc = [dict(name=u'\u03b1', bytes=12345), 67890, 'str, ]', [], {}]
+        text = dumps(doc, indent=1)
+        for size in (1, 2, 7, 100, len(text)):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            self.assertEqual(list(utils.iter_json_list(chunks)), doc)
+        for text, items in (
+                ('', []), ('[]', []), (' [ ] ', []), ('[1,2]', [1, 2])):
+            self.assertEqual(list(utils.iter_json_list([text])), items)
+        for text in ('{}', '[1,]', '[1 2]', '[1', '[1]x', '[,1]', '[{]'):
+            self.assertRaises(
+                ValueError, list, utils.iter_json_list(iter(text)))
+
 if __name__ == '__main__':
     from sys import argv
     from kamaki.clients.test import runTestCase